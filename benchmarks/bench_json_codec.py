@@ -0,0 +1,93 @@
+"""
+Microbenchmark: JSON CPU time of one OpenAI chat request with a long history.
+
+  legacy  - the previous code path: json.loads of the request, json.dumps(...).encode() of the
+            converted body on every attempt, and the response decoded to str before parsing.
+  stdlib  - json_loads/json_dumps backed by the standard library, body serialized once.
+  orjson  - the same with orjson (skipped if it is not installed).
+
+Each request is converted, sent `--attempts` times (retries on other keys) and its non-streaming
+response converted back to the OpenAI format.
+
+Usage: python benchmarks/bench_json_codec.py [--history-kb 100 400] [--attempts N] [--rounds N]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import gemini_key_manager as gkm # noqa: E402
+
+
+def make_request_body(history_kb):
+    """An OpenAI chat request whose message history is about `history_kb` KB of JSON."""
+    messages = [{"role": "system", "content": "You are a helpful assistant. Réponds brièvement."}]
+    turn = 0
+    while len(json.dumps(messages)) < history_kb * 1024:
+        role = "user" if turn % 2 == 0 else "assistant"
+        text = f"Turn {turn}: " + " ".join(f"word{i} naïve café" for i in range(60))
+        messages.append({"role": role, "content": text})
+        turn += 1
+    return json.dumps({"model": "gemini-pro", "messages": messages, "temperature": 0.7}).encode('utf-8')
+
+
+def make_response_body():
+    return json.dumps({
+        "candidates": [{"content": {"parts": [{"text": "Antwort " * 2000}], "role": "model"}, "finishReason": "STOP"}],
+        "usageMetadata": {"promptTokenCount": 30000, "candidatesTokenCount": 2000, "totalTokenCount": 32000},
+    }).encode('utf-8')
+
+
+def legacy_request(request_bytes, response_bytes, attempts):
+    gemini_body, model, _ = gkm.convert_openai_to_gemini_request(json.loads(request_bytes))
+    for _ in range(attempts):
+        json.dumps(gemini_body).encode('utf-8')
+    gemini_response = json.loads(response_bytes.decode('utf-8', errors='replace'))
+    openai_response = {"model": model, "choices": [{"message": {"content": gkm.extract_candidate_text(gemini_response["candidates"][0])}}]}
+    return json.dumps(openai_response, ensure_ascii=False).encode('utf-8')
+
+
+def codec_request(request_bytes, response_bytes, attempts):
+    gemini_body, model, _ = gkm.convert_openai_to_gemini_request(gkm.json_loads(request_bytes))
+    gkm.json_dumps(gemini_body) # Serialized once, every attempt reuses the bytes
+    return gkm.convert_gemini_response_to_openai(response_bytes, model)
+
+
+def time_per_request(func, request_bytes, response_bytes, attempts, rounds):
+    func(request_bytes, response_bytes, attempts) # Warm-up
+    start = time.process_time()
+    for _ in range(rounds):
+        func(request_bytes, response_bytes, attempts)
+    return (time.process_time() - start) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--history-kb", type=int, nargs="+", default=[100, 400])
+    parser.add_argument("--attempts", type=int, default=3, help="upstream attempts per request (1 + retries)")
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    logging_level = gkm.logging.getLogger().level
+    gkm.logging.getLogger().setLevel(gkm.logging.WARNING) # The converters log at INFO
+    codecs = ["stdlib"] + (["orjson"] if gkm.orjson is not None else [])
+    response_bytes = make_response_body()
+    try:
+        for history_kb in args.history_kb:
+            request_bytes = make_request_body(history_kb)
+            legacy = time_per_request(legacy_request, request_bytes, response_bytes, args.attempts, args.rounds)
+            print(f"history={len(request_bytes) // 1024}KB attempts={args.attempts}")
+            print(f"  legacy  {legacy * 1e3:8.3f} ms CPU/request")
+            for codec in codecs:
+                gkm.JSON_CODEC = codec
+                gkm.configure_json_codec()
+                elapsed = time_per_request(codec_request, request_bytes, response_bytes, args.attempts, args.rounds)
+                print(f"  {codec:<7} {elapsed * 1e3:8.3f} ms CPU/request ({(legacy - elapsed) * 1e3:+.3f} ms saved)")
+    finally:
+        gkm.logging.getLogger().setLevel(logging_level)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Microbenchmark: KeyPool vs. the previous itertools.cycle + linear exhaustion scans.
+
+Three scenarios are measured for 10, 100 and 1000 keys:
+  steady   - no key is exhausted; each request runs the "all exhausted?" check and picks a key.
+  halfdown - same as steady, but the first half of the keys is already exhausted for the model (mid-day).
+  429storm - every key returns 429 in turn; each attempt picks a key, marks it exhausted and
+             checks whether all keys are exhausted, until none is left (one full storm per run).
+
+Usage: python benchmarks/bench_key_pool.py [--requests N] [--storms N]
+"""
+import argparse
+import os
+import sys
+import time
+from itertools import cycle
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import gemini_key_manager as gkm # noqa: E402
+
+MODEL = "gemini-pro"
+
+
+class LegacyKeyRotation:
+    """The rotation logic proxy() used before KeyPool: one shared cycle plus linear scans."""
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.key_cycler = cycle(self.keys)
+        self.exhausted_keys_today = {}
+
+    def all_exhausted(self, model):
+        for key_in_list in self.keys:
+            if model not in self.exhausted_keys_today.get(key_in_list, set()):
+                return False
+        return True
+
+    def next_key(self, model):
+        for _ in range(len(self.keys)):
+            next_key = next(self.key_cycler)
+            if model in self.exhausted_keys_today.get(next_key, set()):
+                continue
+            return next_key
+        return None
+
+    def mark_exhausted(self, api_key, model):
+        self.exhausted_keys_today.setdefault(api_key, set()).add(model)
+        return self.all_exhausted(model)
+
+
+def steady(pool, requests, exhausted_keys=()):
+    for key in exhausted_keys:
+        pool.mark_exhausted(key, MODEL)
+    start = time.perf_counter()
+    for _ in range(requests):
+        if not pool.all_exhausted(MODEL):
+            pool.next_key(MODEL)
+    return time.perf_counter() - start
+
+
+def storm(make_pool, keys, storms):
+    elapsed = 0.0
+    for _ in range(storms):
+        pool = make_pool(keys)
+        start = time.perf_counter()
+        while True:
+            key = pool.next_key(MODEL)
+            if key is None or pool.mark_exhausted(key, MODEL):
+                break
+        elapsed += time.perf_counter() - start
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100000, help="requests per steady-state run")
+    parser.add_argument("--storms", type=int, default=5, help="full 429 storms per run")
+    args = parser.parse_args()
+
+    implementations = [("legacy", LegacyKeyRotation), ("KeyPool", gkm.KeyPool)]
+    print(f"{'keys':>6} {'scenario':>9} {'impl':>8} {'total s':>10} {'us/op':>10}")
+    for key_count in (10, 100, 1000):
+        keys = [f"key-{i:05d}" for i in range(key_count)]
+        for name, make_pool in implementations:
+            seconds = steady(make_pool(keys), args.requests)
+            print(f"{key_count:>6} {'steady':>9} {name:>8} {seconds:>10.4f} {seconds / args.requests * 1e6:>10.3f}")
+        for name, make_pool in implementations:
+            seconds = steady(make_pool(keys), args.requests, exhausted_keys=keys[:key_count // 2])
+            print(f"{key_count:>6} {'halfdown':>9} {name:>8} {seconds:>10.4f} {seconds / args.requests * 1e6:>10.3f}")
+        for name, make_pool in implementations:
+            seconds = storm(make_pool, keys, args.storms)
+            operations = key_count * args.storms
+            print(f"{key_count:>6} {'429storm':>9} {name:>8} {seconds:>10.4f} {seconds / operations * 1e6:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Microbenchmark: cost of the metrics recorded on the request path, and of a scrape.
+
+  per-request - the metric updates one proxied request performs (request bytes, upstream
+                status and TTFB, response size and duration, client status), timed on one
+                thread and on several threads recording at once.
+  scrape      - rendering METRICS_PATH with the given number of keys and models in use.
+
+Usage: python benchmarks/bench_metrics.py [--requests N] [--threads N] [--keys N] [--models N]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import gemini_key_manager as gkm # noqa: E402
+
+
+def record_one_request(proxy_req):
+    """The metric updates of one non-streaming request, in the order the proxy makes them."""
+    gkm.REQUEST_BYTES.inc(("gemini",), 120)
+    gkm.UPSTREAM_RESPONSES.inc((proxy_req.model, "200"))
+    gkm.UPSTREAM_TTFB.observe(0.42, (proxy_req.model,))
+    gkm.record_response_sent(proxy_req, 900)
+    gkm.record_client_request(proxy_req.path, 200)
+
+
+def make_request(model):
+    return gkm.ProxyRequest(
+        path=f"v1beta/models/{model}:generateContent", method="POST", is_openai_format=False,
+        target_path=f"v1beta/models/{model}:generateContent", model=model, outgoing_headers={},
+        query_params={}, gemini_request_body_json=None, native_request_body=b"{}",
+        use_stream_endpoint=False, start_time=time.time())
+
+
+def time_requests(thread_count, requests, proxy_req):
+    barrier = threading.Barrier(thread_count)
+
+    def worker():
+        barrier.wait()
+        for _ in range(requests):
+            record_one_request(proxy_req)
+
+    threads = [threading.Thread(target=worker) for _ in range(thread_count)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (time.perf_counter() - start) / (thread_count * requests)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200000, help="requests recorded per thread")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--keys", type=int, default=200)
+    parser.add_argument("--models", type=int, default=5)
+    args = parser.parse_args()
+
+    proxy_req = make_request("gemini-pro")
+    for thread_count in (1, args.threads):
+        per_request = time_requests(thread_count, args.requests // thread_count, proxy_req)
+        print(f"per-request threads={thread_count:<3} {per_request * 1e6:6.2f} us")
+
+    keys = [f"key-{i:05d}" for i in range(args.keys)]
+    models = [f"gemini-model-{i}" for i in range(args.models)]
+    # In-memory state only: init_key_state() would load and persist the usage file
+    gkm.usage_state = gkm.UsageState()
+    gkm.key_pool = gkm.KeyPool(keys)
+    gkm.all_api_keys = keys
+    for key in keys:
+        for model in models:
+            gkm.usage_state.record_usage(key, model)
+            gkm.key_stats.start(key, model)
+            gkm.key_stats.finish(key, model, 0.3, error=False)
+    rounds = 20
+    start = time.perf_counter()
+    for _ in range(rounds):
+        body = gkm.metrics_registry.render()
+    elapsed = (time.perf_counter() - start) / rounds
+    print(f"scrape      keys={args.keys} models={args.models} {elapsed * 1e3:6.1f} ms, {len(body)} bytes")
+
+
+if __name__ == "__main__":
+    main()
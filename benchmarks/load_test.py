@@ -0,0 +1,504 @@
+"""
+Load test: drives the proxy's OpenAI and native routes at fixed concurrency against a stub upstream.
+
+By default it starts benchmarks/stub_upstream.py and the proxy (in a temporary directory with
+--keys fake keys, GEMINI_API_BASE_URL pointing at the stub), then runs every scenario at every
+concurrency level for --duration seconds after a --warmup:
+
+  openai         - POST /v1/chat/completions
+  openai-stream  - POST /v1/chat/completions with "stream": true
+  native         - POST /v1beta/models/<model>:generateContent
+  native-stream  - POST /v1beta/models/<model>:streamGenerateContent?alt=sse
+  embeddings     - POST /v1/embeddings with one input (merged into batchEmbedContents calls)
+  native-embed   - POST /v1beta/models/<embedding model>:embedContent, one upstream call each
+
+and reports requests per second, p50/p95/p99 latency, time to first byte of the response body
+(time to first token for streams), and the proxy's CPU time and peak RSS. Every request carries
+a unique prompt, so the response cache and request coalescing never answer it; --system-prompt-kb
+adds a large system prompt shared by all of them, as agents send (see CONTEXT_CACHE_ENABLED).
+
+Compare embeddings with native-embed for the effect of embedding batching; with --key-rpm the
+stub's per-key quota makes the saved upstream calls visible as fewer 429s.
+
+The results are written as JSON (--output). --compare prints them next to an earlier run.
+--accept-encoding sends that Accept-Encoding header (e.g. gzip); the response bytes reported are
+then the bytes on the wire. --gzip makes the stub gzip encode its responses, like the real API.
+--proxy-args passes options to the proxy it starts, e.g. '--server waitress' or '--workers 4'
+(CPU and RSS then include the worker processes). Use --proxy-url (and --proxy-pid for CPU/RSS)
+to load a proxy that is already running.
+The load generator is itself Python: keep an eye on its own CPU when the proxy looks saturated.
+Without injected failures every request against the stub should succeed; if any fails, the
+script warns and exits with status 1.
+
+Usage: python benchmarks/load_test.py [--scenarios openai native embeddings ...] [--concurrency 1 16 64]
+                                      [--duration S] [--latency S] [--chunks N] [--key-rpm N] [--rate-limit-ratio R]
+                                      [--trailing-error-ratio R] [--error-ratio R] [--failing-key SUFFIX ...]
+                                      [--gzip] [--accept-encoding CODINGS] [--proxy-args "OPTIONS"] [--output FILE] [--compare FILE]
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+from urllib.parse import urlsplit
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+PLACEHOLDER_TOKEN = "PLACEHOLDER_GEMINI_TOKEN"
+SCENARIOS = ("openai", "openai-stream", "native", "native-stream", "embeddings", "native-embed")
+EMBEDDING_MODEL = "text-embedding-004"
+
+try:
+    import psutil # Optional, used for CPU/RSS where /proc is not available
+except ImportError:
+    psutil = None
+# Errors reading the statistics of a process that has exited
+PROCESS_ERRORS = (OSError, ValueError) + ((psutil.Error,) if psutil is not None else ())
+
+
+def build_request(scenario, model, prompt, system_prompt=None):
+    """Returns (method, path, headers, body) of one request of `scenario`."""
+    if scenario == "embeddings":
+        headers = {"Authorization": f"Bearer {PLACEHOLDER_TOKEN}", "Content-Type": "application/json"}
+        return "POST", "/v1/embeddings", headers, json.dumps({"model": EMBEDDING_MODEL, "input": prompt}).encode('utf-8')
+    if scenario == "native-embed":
+        headers = {"x-goog-api-key": PLACEHOLDER_TOKEN, "Content-Type": "application/json"}
+        body = {"model": f"models/{EMBEDDING_MODEL}", "content": {"parts": [{"text": prompt}]}}
+        return "POST", f"/v1beta/models/{EMBEDDING_MODEL}:embedContent", headers, json.dumps(body).encode('utf-8')
+    if scenario.startswith("openai"):
+        messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+        messages.append({"role": "user", "content": prompt})
+        body = {"model": model, "messages": messages, "stream": scenario == "openai-stream"}
+        headers = {"Authorization": f"Bearer {PLACEHOLDER_TOKEN}", "Content-Type": "application/json"}
+        return "POST", "/v1/chat/completions", headers, json.dumps(body).encode('utf-8')
+    body = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+    if system_prompt:
+        body["systemInstruction"] = {"parts": [{"text": system_prompt}]}
+    headers = {"x-goog-api-key": PLACEHOLDER_TOKEN, "Content-Type": "application/json"}
+    if scenario == "native-stream":
+        return "POST", f"/v1beta/models/{model}:streamGenerateContent?alt=sse", headers, json.dumps(body).encode('utf-8')
+    return "POST", f"/v1beta/models/{model}:generateContent", headers, json.dumps(body).encode('utf-8')
+
+
+def wait_for_port(host, port, timeout, process=None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Process exited with code {process.returncode} before listening on port {port}")
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing is listening on {host}:{port} after {timeout}s")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(values):
+    """Returns p50/p95/p99/mean/max of `values` in milliseconds (nearest-rank), or None if empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered) + 0.5)) - 1))]
+
+    return {
+        "p50": round(rank(50) * 1e3, 3), "p95": round(rank(95) * 1e3, 3), "p99": round(rank(99) * 1e3, 3),
+        "mean": round(sum(ordered) / len(ordered) * 1e3, 3), "max": round(ordered[-1] * 1e3, 3),
+    }
+
+
+def proc_stat_fields(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        return f.read().rsplit(")", 1)[1].split() # The command name may contain spaces
+
+
+class ProcessSampler:
+    """
+    CPU time and peak RSS of a process and its child processes (e.g. gunicorn workers), from
+    /proc (Linux) or psutil.
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._process = psutil.Process(pid) if psutil is not None and pid else None
+
+    def available(self):
+        return self._process is not None or (self.pid and os.path.exists(f"/proc/{self.pid}/stat"))
+
+    def pids(self):
+        if self._process is not None:
+            return [self.pid] + [child.pid for child in self._process.children(recursive=True)]
+        children = {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    children.setdefault(int(proc_stat_fields(entry)[1]), []).append(int(entry)) # ppid
+                except (OSError, IndexError):
+                    pass
+        pids, index = [self.pid], 0
+        while index < len(pids):
+            pids.extend(children.get(pids[index], ()))
+            index += 1
+        return pids
+
+    def _sum(self, measure):
+        total = 0
+        for pid in self.pids():
+            try:
+                total += measure(pid)
+            except PROCESS_ERRORS: # A worker may exit (and be replaced) between listing and reading
+                if pid == self.pid:
+                    raise
+        return total
+
+    def cpu_seconds(self):
+        return self._sum(self._cpu_seconds)
+
+    def rss_bytes(self):
+        return self._sum(self._rss_bytes)
+
+    def _cpu_seconds(self, pid):
+        if self._process is not None:
+            times = psutil.Process(pid).cpu_times()
+            return times.user + times.system
+        fields = proc_stat_fields(pid)
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK") # utime + stime
+
+    def _rss_bytes(self, pid):
+        if self._process is not None:
+            return psutil.Process(pid).memory_info().rss
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def start(self, interval=0.2):
+        self.peak_rss = self.rss_bytes()
+
+        def sample():
+            while not self._stop.wait(interval):
+                try:
+                    self.peak_rss = max(self.peak_rss, self.rss_bytes())
+                except (OSError, ValueError):
+                    return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=sample, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+
+class LoadWorker(threading.Thread):
+    """Sends requests of one scenario back to back until `deadline`, reusing its connection when possible."""
+
+    def __init__(self, proxy_url, scenario, model, deadline, timeout, system_prompt=None, accept_encoding=None):
+        super().__init__(daemon=True)
+        parts = urlsplit(proxy_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.scenario = scenario
+        self.model = model
+        self.deadline = deadline
+        self.timeout = timeout
+        self.system_prompt = system_prompt
+        self.accept_encoding = accept_encoding
+        self.samples = [] # (latency, time to first body byte, status, response bytes)
+        self.errors = {}
+        self._connection = None
+
+    def run(self):
+        while time.perf_counter() < self.deadline:
+            try:
+                self.samples.append(self.send_one())
+            except (OSError, http.client.HTTPException) as e:
+                self.errors[type(e).__name__] = self.errors.get(type(e).__name__, 0) + 1
+                self.close()
+        self.close()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def send_one(self):
+        method, path, headers, body = build_request(self.scenario, self.model, f"Benchmark prompt {uuid.uuid4().hex}", self.system_prompt)
+        if self.accept_encoding:
+            headers["Accept-Encoding"] = self.accept_encoding # The body is counted as received, not decoded
+        if self._connection is None:
+            self._connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        start = time.perf_counter()
+        self._connection.request(method, path, body=body, headers=headers)
+        response = self._connection.getresponse()
+        first_byte = None
+        received = 0
+        while not response.isclosed():
+            data = response.read1(65536)
+            if not data:
+                break
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            received += len(data)
+        # read1() never marks a Content-Length response complete, and the next request on the
+        # connection would fail with ResponseNotReady; read() does (and returns b"" by now)
+        received += len(response.read())
+        latency = time.perf_counter() - start
+        if response.will_close:
+            self.close()
+        return latency, first_byte, response.status, received
+
+
+def run_scenario(proxy_url, scenario, concurrency, duration, warmup, model, timeout, sampler, system_prompt=None, accept_encoding=None):
+    if warmup > 0:
+        warm_workers = [LoadWorker(proxy_url, scenario, model, time.perf_counter() + warmup, timeout, system_prompt, accept_encoding) for _ in range(concurrency)]
+        for worker in warm_workers:
+            worker.start()
+        for worker in warm_workers:
+            worker.join()
+
+    cpu_before = sampler.cpu_seconds() if sampler else None
+    if sampler:
+        sampler.start()
+    start = time.perf_counter()
+    workers = [LoadWorker(proxy_url, scenario, model, start + duration, timeout, system_prompt, accept_encoding) for _ in range(concurrency)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    if sampler:
+        sampler.stop()
+
+    samples = [sample for worker in workers for sample in worker.samples]
+    statuses = {}
+    for sample in samples:
+        statuses[str(sample[2])] = statuses.get(str(sample[2]), 0) + 1
+    errors = {}
+    for worker in workers:
+        for name, count in worker.errors.items():
+            errors[name] = errors.get(name, 0) + count
+    ok = [sample for sample in samples if sample[2] == 200]
+    result = {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "duration_s": round(elapsed, 3),
+        "requests": len(samples),
+        "status_counts": statuses,
+        "connection_errors": errors,
+        "rps": round(len(ok) / elapsed, 2),
+        "latency_ms": percentiles([sample[0] for sample in ok]),
+        "ttfb_ms": percentiles([sample[1] for sample in ok if sample[1] is not None]),
+        "response_bytes_mean": round(sum(sample[3] for sample in ok) / len(ok), 1) if ok else 0,
+    }
+    if sampler:
+        cpu = sampler.cpu_seconds() - cpu_before
+        result["proxy_cpu_s"] = round(cpu, 3)
+        result["proxy_cpu_percent"] = round(cpu / elapsed * 100, 1)
+        result["proxy_cpu_ms_per_request"] = round(cpu / len(ok) * 1e3, 3) if ok else None
+        result["proxy_peak_rss_mb"] = round(sampler.peak_rss / 2**20, 1)
+    return result
+
+
+def start_stub(args, port):
+    command = [sys.executable, os.path.join(BENCHMARK_DIR, "stub_upstream.py"), "--port", str(port),
+               "--latency", str(args.latency), "--chunks", str(args.chunks), "--chunk-interval", str(args.chunk_interval),
+               "--key-rpm", str(args.key_rpm), "--rate-limit-ratio", str(args.rate_limit_ratio), "--retry-delay", str(args.retry_delay),
+               "--trailing-error-ratio", str(args.trailing_error_ratio), "--error-ratio", str(args.error_ratio),
+               *(["--gzip"] if args.gzip else []), "--failing-key", *args.failing_key]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    wait_for_port("127.0.0.1", port, 10, process)
+    return process
+
+
+def start_proxy(args, workdir, stub_port, proxy_port):
+    # The proxy keeps key.txt and its usage files next to the script: run a copy in `workdir`
+    # so the fake keys and their usage never touch the checkout
+    shutil.copy(os.path.join(REPO_DIR, "gemini_key_manager.py"), workdir)
+    with open(os.path.join(workdir, "key.txt"), "w") as f:
+        f.write("".join(f"benchmark-key-{i:04d}\n" for i in range(args.keys)))
+    env = dict(os.environ, GEMINI_API_BASE_URL=f"http://127.0.0.1:{stub_port}", LISTEN_PORT=str(proxy_port))
+    log = open(os.path.join(workdir, "proxy.out"), "wb")
+    process = subprocess.Popen([sys.executable, os.path.join(workdir, "gemini_key_manager.py"), *shlex.split(args.proxy_args)],
+                               cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    wait_for_port("127.0.0.1", proxy_port, 30, process)
+    return process
+
+
+def stop_process(process, sig_name="SIGTERM"):
+    if process is None or process.poll() is not None:
+        return
+    process.send_signal(getattr(signal, sig_name))
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def format_row(result):
+    latency = result["latency_ms"] or {}
+    ttfb = result["ttfb_ms"] or {}
+    cpu = f"{result['proxy_cpu_ms_per_request']:7.3f}" if result.get("proxy_cpu_ms_per_request") is not None else "      -"
+    rss = f"{result['proxy_peak_rss_mb']:7.1f}" if "proxy_peak_rss_mb" in result else "      -"
+    non_200 = sum(count for status, count in result["status_counts"].items() if status != "200") + sum(result["connection_errors"].values())
+    return (f"{result['scenario']:<14} {result['concurrency']:>4} {result['rps']:9.1f} "
+            f"{latency.get('p50', 0):8.1f} {latency.get('p95', 0):8.1f} {latency.get('p99', 0):8.1f} "
+            f"{ttfb.get('p50', 0):8.1f} {cpu} {rss} {non_200:>6}")
+
+
+HEADER = f"{'scenario':<14} {'conc':>4} {'rps':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'ttfb50':>8} {'cpu/req':>7} {'rss MB':>7} {'errors':>6}"
+
+
+def clean_run_errors(args, results):
+    """
+    Returns the number of non-200 answers and connection errors of a run against a stub started
+    without injected failures, where every request should succeed; None for other runs.
+    """
+    if args.proxy_url or args.key_rpm or args.rate_limit_ratio or args.trailing_error_ratio or args.error_ratio or args.failing_key:
+        return None
+    return sum(sum(count for status, count in result["status_counts"].items() if status != "200")
+               + sum(result["connection_errors"].values()) for result in results)
+
+
+def print_comparison(baseline, current):
+    """Prints rps and latency percentiles of `current` next to `baseline` for the runs both contain."""
+    previous = {(r["scenario"], r["concurrency"]): r for r in baseline["results"]}
+    print(f"\nCompared with {baseline.get('git_commit') or '?'} ({baseline.get('started')}):")
+    print(f"{'scenario':<14} {'conc':>4} {'rps':>16} {'p50 ms':>16} {'p95 ms':>16} {'p99 ms':>16}")
+
+    def delta(old, new):
+        if not old:
+            return f"{new:>16.1f}"
+        return f"{new:9.1f} ({(new - old) / old * 100:+4.0f}%)"
+
+    for result in current["results"]:
+        old = previous.get((result["scenario"], result["concurrency"]))
+        if old is None or not result["latency_ms"] or not old["latency_ms"]:
+            continue
+        print(f"{result['scenario']:<14} {result['concurrency']:>4} {delta(old['rps'], result['rps'])} "
+              + " ".join(delta(old["latency_ms"][p], result["latency_ms"][p]) for p in ("p50", "p95", "p99")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16, 64])
+    parser.add_argument("--duration", type=float, default=10, help="measured seconds per scenario and concurrency")
+    parser.add_argument("--warmup", type=float, default=2, help="unmeasured seconds before each measurement")
+    parser.add_argument("--model", default="gemini-pro")
+    parser.add_argument("--timeout", type=float, default=60, help="client timeout per request")
+    parser.add_argument("--system-prompt-kb", type=int, default=0,
+                        help="size of a system prompt shared by all requests (exercises context caching)")
+    parser.add_argument("--keys", type=int, default=20, help="fake keys given to a proxy started by this script")
+    parser.add_argument("--accept-encoding", help="Accept-Encoding header sent with every request, e.g. gzip")
+    parser.add_argument("--proxy-args", default="", help="command line options for a proxy started by this script, "
+                        "e.g. '--server waitress' or '--workers 4 --set USAGE_STATE_BACKEND=sqlite'")
+    parser.add_argument("--proxy-url", help="load an already running proxy instead of starting stub and proxy")
+    parser.add_argument("--proxy-pid", type=int, help="pid of the --proxy-url proxy, for CPU and RSS")
+    stub = parser.add_argument_group("stub upstream (see stub_upstream.py)")
+    stub.add_argument("--latency", type=float, default=0.05)
+    stub.add_argument("--chunks", type=int, default=10)
+    stub.add_argument("--chunk-interval", type=float, default=0.02)
+    stub.add_argument("--key-rpm", type=int, default=0)
+    stub.add_argument("--rate-limit-ratio", type=float, default=0.0)
+    stub.add_argument("--retry-delay", type=float, default=1.0)
+    stub.add_argument("--trailing-error-ratio", type=float, default=0.0)
+    stub.add_argument("--error-ratio", type=float, default=0.0)
+    stub.add_argument("--failing-key", nargs="*", default=[], help="suffixes of fake keys (benchmark-key-NNNN) that always get 503")
+    stub.add_argument("--gzip", action="store_true", help="gzip encode the stub's responses")
+    parser.add_argument("--output", help="results file (default: benchmarks/results/load_<time>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare with")
+    args = parser.parse_args()
+
+    started = datetime.now()
+    output = args.output or os.path.join(BENCHMARK_DIR, "results", f"load_{started:%Y%m%d_%H%M%S}.json")
+    stub_process = proxy_process = None
+    workdir = tempfile.TemporaryDirectory(prefix="gemini-proxy-load-")
+    try:
+        if args.proxy_url:
+            proxy_url, proxy_pid = args.proxy_url.rstrip("/"), args.proxy_pid
+        else:
+            stub_port, proxy_port = free_port(), free_port()
+            stub_process = start_stub(args, stub_port)
+            proxy_process = start_proxy(args, workdir.name, stub_port, proxy_port)
+            proxy_url, proxy_pid = f"http://127.0.0.1:{proxy_port}", proxy_process.pid
+        sampler = ProcessSampler(proxy_pid) if proxy_pid else None
+        if sampler and not sampler.available():
+            print("CPU/RSS of the proxy are not reported: install psutil or run on Linux.")
+            sampler = None
+
+        system_prompt = None
+        if args.system_prompt_kb:
+            system_prompt = " ".join(f"Rule {i}: answer precisely." for i in range(args.system_prompt_kb * 1024 // 26 + 1))[:args.system_prompt_kb * 1024]
+
+        print(HEADER)
+        results = []
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                result = run_scenario(proxy_url, scenario, concurrency, args.duration, args.warmup,
+                                      args.model, args.timeout, sampler, system_prompt, args.accept_encoding)
+                results.append(result)
+                print(format_row(result), flush=True)
+    finally:
+        stop_process(proxy_process)
+        stop_process(stub_process, "SIGINT")
+        workdir.cleanup()
+
+    report = {
+        "started": started.isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "options": vars(args),
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {output}")
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), report)
+    errors = clean_run_errors(args, results)
+    if errors:
+        print(f"\nWARNING: {errors} requests failed although the stub injected no failures; "
+              "the figures above are not trustworthy.", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Thread stress test for UsageState and KeyPool.
+
+Checks (exits non-zero if one fails):
+  counts    - many threads record usage for many keys/models at once; every counter must be exact.
+  rollover  - many threads see the date change at the same moment; exactly one performs the rollover.
+  exhaustion- threads exhaust disjoint keys of one model concurrently; exactly one sees "all exhausted".
+
+It also reports recording throughput with one shared lock (shards=1) vs. the sharded default,
+to show that the sharded state does not serialize requests behind one global lock. Under the
+GIL the difference is small; it grows when a lock holder is preempted or on free-threaded builds.
+
+Usage: python benchmarks/stress_usage_state.py [--threads N] [--keys N] [--ops N]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import gemini_key_manager as gkm # noqa: E402
+
+MODELS = ("gemini-pro", "gemini-flash", "gemini-embedding")
+
+
+def run_threads(count, target):
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def runner(index):
+        barrier.wait()
+        results[index] = target(index)
+
+    threads = [threading.Thread(target=runner, args=(i,)) for i in range(count)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, results
+
+
+def check_counts(shards, thread_count, keys, ops):
+    state = gkm.UsageState(shards=shards)
+
+    def worker(index):
+        for i in range(ops):
+            key = keys[(index * 7 + i) % len(keys)]
+            state.record_usage(key, MODELS[i % len(MODELS)])
+
+    elapsed, _ = run_threads(thread_count, worker)
+
+    expected_counts = {}
+    expected_models = {}
+    for index in range(thread_count):
+        for i in range(ops):
+            key = keys[(index * 7 + i) % len(keys)]
+            model = MODELS[i % len(MODELS)]
+            expected_counts[key] = expected_counts.get(key, 0) + 1
+            expected_models.setdefault(key, {})
+            expected_models[key][model] = expected_models[key].get(model, 0) + 1
+    snapshot = state.snapshot()
+    exact = snapshot["counts"] == expected_counts and snapshot["model_counts"] == expected_models
+    return exact, elapsed
+
+
+def check_rollover(thread_count):
+    state = gkm.UsageState()
+    state.record_usage("key-a", MODELS[0])
+    tomorrow = state.usage_date + timedelta(days=1)
+    _, results = run_threads(thread_count, lambda index: state.rollover_if_needed(tomorrow))
+    return results.count(True) == 1 and state.snapshot()["counts"] == {}
+
+
+def check_exhaustion(thread_count, keys):
+    pool = gkm.KeyPool(keys)
+    per_thread = [keys[i::thread_count] for i in range(thread_count)]
+
+    def worker(index):
+        return [pool.mark_exhausted(key, MODELS[0]) for key in per_thread[index]]
+
+    _, results = run_threads(thread_count, worker)
+    all_exhausted_seen = sum(result.count(True) for result in results)
+    return all_exhausted_seen == 1 and pool.all_exhausted(MODELS[0]) and not pool.all_exhausted(MODELS[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--keys", type=int, default=200)
+    parser.add_argument("--ops", type=int, default=20000, help="usage records per thread")
+    args = parser.parse_args()
+
+    sys.setswitchinterval(1e-5) # Switch threads as often as possible to provoke races
+    keys = [f"key-{i:05d}" for i in range(args.keys)]
+    failures = 0
+
+    total_ops = args.threads * args.ops
+    for shards in (1, gkm.USAGE_LOCK_SHARDS):
+        exact, elapsed = check_counts(shards, args.threads, keys, args.ops)
+        failures += not exact
+        print(f"counts     shards={shards:<3} exact={exact} {total_ops / elapsed:>10.0f} ops/s")
+
+    ok = check_rollover(args.threads)
+    failures += not ok
+    print(f"rollover   exactly one rollover: {ok}")
+
+    ok = check_exhaustion(args.threads, keys)
+    failures += not ok
+    print(f"exhaustion exactly one 'all exhausted': {ok}")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
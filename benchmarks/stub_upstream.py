@@ -0,0 +1,309 @@
+"""
+Stub Gemini API for benchmarks and load tests.
+
+Serves the parts of the Gemini API the proxy forwards to, with configurable behaviour:
+  GET  v1beta/models[/<model>]             - a small model list / model
+  POST .../<model>:generateContent         - one candidate after --latency seconds
+  POST .../<model>:streamGenerateContent   - --chunks chunks (SSE with alt=sse, else a JSON array),
+                                             the first after --latency, then every --chunk-interval
+  POST .../<model>:countTokens, :embedContent, :batchEmbedContents
+  POST/PATCH/DELETE v1beta/cachedContents[/<id>] - context caches, owned by the key that created them;
+                                             generation requests may reference one with "cachedContent"
+
+Prompt token counts in usageMetadata are estimated as 4 bytes per token, plus the tokens of a
+referenced cache (also reported as cachedContentTokenCount).
+
+--key-rpm answers a key's POST requests beyond that many per minute with a per-minute 429, like
+the real quotas; --rate-limit-ratio answers a random fraction of POST requests with one (both with
+a RetryInfo delay of --retry-delay). --trailing-error-ratio appends a Google error JSON to that fraction
+of streamed responses, as the real API sometimes does. --error-ratio answers a random fraction of
+POST requests with a 503, and keys ending with a --failing-key suffix get a 503 for every POST
+(a broken key or backend), to exercise retries and circuit breakers. --gzip gzip encodes responses
+for requests with Accept-Encoding: gzip, like the real API (streams flushed chunk by chunk).
+Request bodies sent with Content-Encoding: gzip are always accepted.
+
+Point the proxy at it with GEMINI_API_BASE_URL=http://127.0.0.1:<port>.
+
+Usage: python benchmarks/stub_upstream.py [--port N] [--latency S] [--chunks N] [--chunk-interval S]
+                                          [--chunk-tokens N] [--key-rpm N] [--rate-limit-ratio R]
+                                          [--trailing-error-ratio R] [--retry-delay S] [--error-ratio R]
+                                          [--failing-key SUFFIX ...] [--gzip]
+"""
+import argparse
+import gzip
+import json
+import random
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubStats:
+    """Counts of the responses sent, reported on shutdown, the per-key quota windows and the context caches."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {}
+        self._windows = {} # key -> (minute, requests in that minute)
+        self.caches = {} # name -> [api_key, tokens, expiry time]
+
+    def record(self, kind):
+        with self._lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def over_quota(self, api_key, rpm):
+        """Counts a request of `api_key`; True if it exceeds `rpm` requests in the current minute."""
+        minute = int(time.time() // 60)
+        with self._lock:
+            window_minute, count = self._windows.get(api_key, (minute, 0))
+            count = count + 1 if window_minute == minute else 1
+            self._windows[api_key] = (minute, count)
+            return count > rpm
+
+
+def candidate_chunk(index, tokens, final, prompt_tokens=12, cached_tokens=0):
+    candidate = {"content": {"parts": [{"text": "".join(f"tok{index}_{i} " for i in range(tokens))}], "role": "model"}}
+    if final:
+        candidate["finishReason"] = "STOP"
+    usage = {"promptTokenCount": prompt_tokens, "candidatesTokenCount": (index + 1) * tokens, "totalTokenCount": prompt_tokens + (index + 1) * tokens}
+    if cached_tokens:
+        usage["cachedContentTokenCount"] = cached_tokens
+    return {"candidates": [candidate], "usageMetadata": usage}
+
+
+def parse_ttl(value, default=3600):
+    try:
+        return float(str(value).rstrip("s"))
+    except ValueError:
+        return default
+
+
+def rate_limit_body(retry_delay):
+    return {"error": {"code": 429, "message": "Resource has been exhausted (e.g. check quota).", "status": "RESOURCE_EXHAUSTED", "details": [
+        {"@type": "type.googleapis.com/google.rpc.QuotaFailure", "violations": [{"quotaId": "GenerateRequestsPerMinutePerProjectPerModel-FreeTier"}]},
+        {"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": f"{retry_delay:g}s"},
+    ]}}
+
+
+TRAILING_ERROR = b'\n{"error": {"code": 500, "message": "An internal error has occurred.", "status": "INTERNAL"}}\n'
+UNAVAILABLE = {"error": {"code": 503, "message": "The model is overloaded. Please try again later.", "status": "UNAVAILABLE"}}
+CACHE_NOT_FOUND = {"error": {"code": 403, "message": "CachedContent not found (or permission denied)", "status": "PERMISSION_DENIED"}}
+CACHE_CONFLICT = {"error": {"code": 400, "status": "INVALID_ARGUMENT",
+                            "message": "CachedContent can not be used with GenerateContent request setting system_instruction, tools or tool_config."}}
+
+
+def make_handler(options, stats):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # Keep-alive, like the real API
+        # Headers and body are separate writes: without TCP_NODELAY the body would wait for the
+        # proxy's delayed ACK (~40 ms) and dominate the measured latency
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def gzip_response(self):
+            return options.gzip and "gzip" in self.headers.get("Accept-Encoding", "")
+
+        def read_body(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if self.headers.get("Content-Encoding", "").lower() == "gzip":
+                body = gzip.decompress(body)
+            return body
+
+        def send_json(self, status, payload, kind):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=UTF-8")
+            if self.gzip_response():
+                body = gzip.compress(body)
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            stats.record(kind)
+
+        def write_chunk(self, data):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def do_GET(self):
+            path = self.path.split("?", 1)[0].strip("/")
+            if path.endswith("/models"):
+                self.send_json(200, {"models": [{"name": "models/gemini-pro"}, {"name": "models/gemini-flash"}]}, "models")
+            else:
+                self.send_json(200, {"name": "models/" + path.rsplit("/", 1)[-1]}, "models")
+
+        def cached_tokens(self, body):
+            """Returns (tokens of the cache `body` references, error payload) for a generation request."""
+            if b'"cachedContent"' not in body:
+                return 0, None
+            request = json.loads(body)
+            with stats._lock:
+                cache = stats.caches.get(request.get("cachedContent"))
+            if cache is None or cache[0] != self.headers.get("x-goog-api-key") or cache[2] < time.time():
+                return 0, CACHE_NOT_FOUND
+            if any(field in request for field in ("systemInstruction", "tools", "toolConfig")):
+                return 0, CACHE_CONFLICT
+            return cache[1], None
+
+        def create_cache(self, body):
+            request = json.loads(body)
+            tokens = len(json.dumps({key: value for key, value in request.items() if key != "ttl"})) // 4
+            if tokens < options.cache_min_tokens:
+                self.send_json(400, {"error": {"code": 400, "status": "INVALID_ARGUMENT", "message":
+                    f"Cached content is too small. total_token_count={tokens}, min_total_token_count={options.cache_min_tokens}"}}, "cachedContents 400")
+                return
+            name = f"cachedContents/{uuid.uuid4().hex[:16]}"
+            ttl = parse_ttl(request.get("ttl"))
+            with stats._lock:
+                stats.caches[name] = [self.headers.get("x-goog-api-key"), tokens, time.time() + ttl]
+            self.send_json(200, {"name": name, "model": request.get("model"), "usageMetadata": {"totalTokenCount": tokens},
+                                 "expireTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + ttl))}, "cachedContents create")
+
+        def do_PATCH(self):
+            body = self.read_body()
+            name = self.path.partition("?")[0].split("/v1beta/", 1)[-1]
+            with stats._lock:
+                cache = stats.caches.get(name)
+                found = cache is not None and cache[0] == self.headers.get("x-goog-api-key") and cache[2] >= time.time()
+                if found:
+                    cache[2] = time.time() + parse_ttl(json.loads(body).get("ttl"))
+            if found:
+                self.send_json(200, {"name": name}, "cachedContents update")
+            else:
+                self.send_json(403, CACHE_NOT_FOUND, "cachedContents 403")
+
+        def do_DELETE(self):
+            name = self.path.partition("?")[0].split("/v1beta/", 1)[-1]
+            with stats._lock:
+                cache = stats.caches.get(name)
+                found = cache is not None and cache[0] == self.headers.get("x-goog-api-key")
+                if found:
+                    del stats.caches[name]
+            if found:
+                self.send_json(200, {}, "cachedContents delete")
+            else:
+                self.send_json(403, CACHE_NOT_FOUND, "cachedContents 403")
+
+        def do_POST(self):
+            body = self.read_body()
+            path, _, query = self.path.partition("?")
+            if path.endswith("/cachedContents"):
+                self.create_cache(body)
+                return
+            action = path.rsplit(":", 1)[-1]
+            over_quota = options.key_rpm and stats.over_quota(self.headers.get("x-goog-api-key", ""), options.key_rpm)
+            if over_quota or random.random() < options.rate_limit_ratio:
+                self.send_json(429, rate_limit_body(options.retry_delay), "429")
+                return
+            api_key = self.headers.get("x-goog-api-key", "")
+            if random.random() < options.error_ratio or any(api_key.endswith(suffix) for suffix in options.failing_key):
+                self.send_json(503, UNAVAILABLE, "503")
+                return
+            cached_tokens = 0
+            if action in ("generateContent", "streamGenerateContent"):
+                cached_tokens, error = self.cached_tokens(body)
+                if error is not None:
+                    self.send_json(error["error"]["code"], error, f"{action} {error['error']['code']}")
+                    return
+            prompt_tokens = len(body) // 4 + cached_tokens
+            if action == "streamGenerateContent":
+                self.stream("alt=sse" in query, prompt_tokens, cached_tokens)
+                return
+            time.sleep(options.latency)
+            if action == "countTokens":
+                self.send_json(200, {"totalTokens": max(1, len(body) // 4)}, "countTokens")
+            elif action in ("embedContent", "batchEmbedContents"):
+                request_count = 1
+                if action == "batchEmbedContents":
+                    try:
+                        request_count = len(json.loads(body).get("requests", []))
+                    except ValueError:
+                        pass
+                embeddings = [{"values": [round(random.random(), 6) for _ in range(options.embedding_size)]} for _ in range(request_count)]
+                payload = {"embedding": embeddings[0]} if action == "embedContent" else {"embeddings": embeddings}
+                self.send_json(200, payload, action)
+            else:
+                self.send_json(200, candidate_chunk(0, options.chunk_tokens * options.chunks, True, prompt_tokens, cached_tokens),
+                               "generateContent" + (" cached" if cached_tokens else ""))
+
+        def stream(self, sse, prompt_tokens, cached_tokens):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream" if sse else "application/json; charset=UTF-8")
+            self.send_header("Transfer-Encoding", "chunked")
+            compressor = None
+            if self.gzip_response():
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+                self.send_header("Content-Encoding", "gzip")
+            self.end_headers()
+
+            def send(data):
+                if compressor:
+                    data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                self.write_chunk(data)
+
+            for index in range(options.chunks):
+                time.sleep(options.latency if index == 0 else options.chunk_interval)
+                data = json.dumps(candidate_chunk(index, options.chunk_tokens, index == options.chunks - 1, prompt_tokens, cached_tokens)).encode('utf-8')
+                if sse:
+                    send(b"data: " + data + b"\r\n\r\n")
+                else:
+                    send((b"[" if index == 0 else b",\r\n") + data)
+            if not sse:
+                send(b"]")
+            kind = "streamGenerateContent" + (" cached" if cached_tokens else "")
+            if random.random() < options.trailing_error_ratio:
+                send(TRAILING_ERROR)
+                kind += "+trailing_error"
+            if compressor:
+                self.write_chunk(compressor.flush())
+            self.write_chunk(b"")
+            stats.record(kind)
+
+    return StubHandler
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 4096
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8999)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before a response (or the first chunk)")
+    parser.add_argument("--chunks", type=int, default=10, help="chunks per streamed response")
+    parser.add_argument("--chunk-interval", type=float, default=0.02, help="seconds between streamed chunks")
+    parser.add_argument("--chunk-tokens", type=int, default=8, help="tokens of text per chunk")
+    parser.add_argument("--embedding-size", type=int, default=768)
+    parser.add_argument("--cache-min-tokens", type=int, default=1024, help="smallest context cache accepted")
+    parser.add_argument("--key-rpm", type=int, default=0, help="requests per minute allowed per key (0: unlimited)")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="fraction of POSTs answered with 429")
+    parser.add_argument("--retry-delay", type=float, default=1.0, help="RetryInfo delay of injected 429s")
+    parser.add_argument("--trailing-error-ratio", type=float, default=0.0, help="fraction of streams ending with an error JSON")
+    parser.add_argument("--error-ratio", type=float, default=0.0, help="fraction of POSTs answered with 503")
+    parser.add_argument("--failing-key", nargs="*", default=[], help="suffixes of keys whose POSTs always get 503")
+    parser.add_argument("--gzip", action="store_true", help="gzip encode responses for clients accepting it")
+    return parser
+
+
+def main():
+    options = build_parser().parse_args()
+    stats = StubStats()
+    server = StubServer((options.host, options.port), make_handler(options, stats))
+    print(f"Stub Gemini API listening on http://{options.host}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Responses sent: {stats.counts}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,55 @@
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.connection import HTTPConnection
 from flask import Flask, request, Response
-from itertools import cycle
+from werkzeug.wsgi import ClosingIterator
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import http.cookiejar
 import logging
 import logging.handlers
 import os
+import socket
 import sys
+import threading
 from datetime import date, datetime, timezone # Import date, datetime, timezone
 import json # Import json for usage tracking
+import hashlib
+import re
+import math
+import random
+import heapq
 import time
+import asyncio
+import bisect
+import contextvars
+import queue
+import sqlite3
+import tempfile
+import argparse
+import importlib.util
+from contextlib import contextmanager
+try:
+    from zoneinfo import ZoneInfo # Python 3.9+; used for the provider's daily reset time
+except ImportError:
+    ZoneInfo = None
+import atexit
+import signal
+from urllib.parse import parse_qsl
 import uuid # For generating OpenAI response IDs
+import base64 # For base64-encoded OpenAI embeddings
+import struct
+import zlib
 
 # --- Configuration ---
 # Placeholder token that clients will use in the 'x-goog-api-key' header
 PLACEHOLDER_TOKEN = "PLACEHOLDER_GEMINI_TOKEN"
 # File containing the real Google Gemini API keys, one per line
 API_KEY_FILE = "key.txt"
-# Base URL for the actual Google Gemini API
+# Every setting in this section can be overridden by an environment variable of the same name
+# (e.g. LISTEN_PORT=8080) or a command line option (see Configuration Overrides below)
+# Base URL for the actual Google Gemini API (e.g. the stub in benchmarks/stub_upstream.py for benchmarks)
 GEMINI_API_BASE_URL = "https://generativelanguage.googleapis.com"
 # Host and port for the proxy server to listen on
 # '0.0.0.0' makes it accessible from other machines on the network
@@ -24,29 +58,510 @@ LISTEN_PORT = 5000
 # Log file configuration
 LOG_DIRECTORY = "." # Log files will be created in the current working directory
 LOG_LEVEL = logging.DEBUG # Set to logging.INFO for less verbose logging
+# Log file format: "text" (readable lines) or "json" (one JSON object per line, with the request id
+# and structured fields)
+LOG_FORMAT = "text"
+# The log file is rotated at LOG_FILE_MAX_BYTES, keeping LOG_FILE_BACKUP_COUNT old files
+LOG_FILE_MAX_BYTES = 50 * 1024 * 1024
+LOG_FILE_BACKUP_COUNT = 5
+# Records are written by a background thread; at most LOG_QUEUE_SIZE wait for it, further
+# records are dropped (and counted) instead of slowing down requests
+LOG_QUEUE_SIZE = 10000
+# Request/response bodies and headers are only logged for a LOG_BODY_SAMPLE_RATE fraction of
+# requests, each cut to LOG_BODY_MAX_CHARS characters
+LOG_BODY_SAMPLE_RATE = 0.1
+LOG_BODY_MAX_CHARS = 2000
+# Upstream connection pool configuration
+# Maximum number of pooled keep-alive connections to the Gemini API
+UPSTREAM_POOL_MAXSIZE = 50
+# Block (wait for a free connection) instead of opening throwaway connections when the pool is saturated
+UPSTREAM_POOL_BLOCK = True
+# Keep upstream connections alive between requests (disable only for debugging)
+UPSTREAM_KEEPALIVE = True
+# Seconds an idle keep-alive connection may stay in the pool (only used by the HTTP/2 client)
+UPSTREAM_KEEPALIVE_EXPIRY = 120
+# Use HTTP/2 multiplexing for upstream requests (requires `pip install httpx[http2]`)
+UPSTREAM_HTTP2 = False
+# Number of upstream connections to open at startup (0 disables warm-up)
+UPSTREAM_WARM_CONNECTIONS = 4
+# Interval in seconds between connection pool statistics log lines
+UPSTREAM_STATS_LOG_INTERVAL = 60
+# Seconds to wait for the Gemini API (to connect, and between received bytes) before an attempt fails
+UPSTREAM_TIMEOUT = 120
+# Largest single upstream SSE event accepted while streaming (bounds memory per stream)
+SSE_MAX_EVENT_BYTES = 16 * 1024 * 1024
+# Relay native Gemini responses to the client as a chunked stream instead of buffering them
+NATIVE_PASSTHROUGH = True
+# Maximum number of bytes read from the upstream response at a time while relaying
+STREAM_READ_CHUNK_SIZE = 64 * 1024
+# Largest tail held back while checking a streamed response for a trailing Google API error JSON
+TRAILING_ERROR_WINDOW_BYTES = 16 * 1024
+# Compression: upstream responses are always requested gzip encoded (or brotli, with the brotli
+# package installed). A native response relayed unchanged keeps its encoding when the client
+# accepts it, so it is never decompressed; responses the proxy converts or inspects (OpenAI
+# format, streams checked for a trailing error) are gzip compressed on the fly for clients sending
+# Accept-Encoding: gzip, streams always and other bodies from COMPRESSION_MIN_BYTES on.
+COMPRESSION_ENABLED = True
+COMPRESSION_LEVEL = 5
+COMPRESSION_MIN_BYTES = 1024
+# Gzip request bodies of at least UPSTREAM_REQUEST_COMPRESSION_MIN_BYTES sent upstream (Content-Encoding: gzip)
+UPSTREAM_REQUEST_COMPRESSION = False
+UPSTREAM_REQUEST_COMPRESSION_MIN_BYTES = 64 * 1024
+# Interval in seconds between compression statistics log lines
+COMPRESSION_STATS_LOG_INTERVAL = 60
+# JSON library used on the request path: "auto" (orjson if installed, else the standard library),
+# "orjson" (`pip install orjson`) or "stdlib"
+JSON_CODEC = "auto"
+# Serving engine: "sync" (Flask, one thread per request) or "async" (asyncio/ASGI via uvicorn,
+# requires `pip install uvicorn httpx`) for many concurrent long-lived streams
+SERVER_ENGINE = "sync"
+# Maximum concurrent upstream connections of the async engine (each HTTP/1.1 stream needs one)
+ASYNC_UPSTREAM_MAX_CONNECTIONS = 2000
+# HTTP server running the engine (see run_server()): "gunicorn" (`pip install gunicorn`, Linux/macOS;
+# several worker processes), "waitress" (`pip install waitress`, sync engine, also on Windows),
+# "uvicorn" (async engine, one process) or "development" (the Flask development server, sync engine).
+# "auto" uses gunicorn if installed, else waitress (sync) or uvicorn (async), else the development server.
+SERVER_BACKEND = "auto"
+# Worker processes (gunicorn only). Keys and usage data are loaded once, before the workers are
+# forked; with more than one worker use USAGE_STATE_BACKEND = "sqlite" so they share the key state.
+SERVER_WORKERS = 1
+# Request threads per worker process of the sync engine (gunicorn gthread workers, waitress)
+SERVER_THREADS = 32
+# Seconds gunicorn waits for a worker that stopped responding before restarting it (workers keep
+# reporting in while they serve long streams)
+SERVER_WORKER_TIMEOUT = 60
+# On SIGTERM (e.g. `docker stop`) the server stops accepting connections and gives the requests
+# in progress, streams included, up to this many seconds to finish; then usage data is flushed
+SERVER_GRACEFUL_TIMEOUT = 120
+# Listen backlog and client keep-alive timeout (seconds) of the server
+SERVER_BACKLOG = 2048
+SERVER_KEEPALIVE_TIMEOUT = 75
+# Where key state (usage counts, exhausted keys, rotation) lives: "memory" (this process only)
+# or "sqlite" (a WAL-mode database shared by all worker processes on this host)
+USAGE_STATE_BACKEND = "memory"
+# Database file of the "sqlite" backend (key_usage.txt is still written as a readable export)
+USAGE_STATE_DB_FILE = "key_state.db"
+# Seconds a worker waits for another worker's write transaction on the shared database
+USAGE_STATE_DB_BUSY_TIMEOUT = 10
+# Local rate limits per key and model, enforced before a request is sent so keys that would
+# exceed them are skipped instead of costing a 429 round trip. Maps a model name (or "default"
+# for all other models) to any of "rpm" (requests/minute), "tpm" (tokens/minute) and "rpd"
+# (requests/day); models without an entry are not paced. Set these to your tier's limits, e.g.
+#   {"gemini-2.5-flash": {"rpm": 10, "tpm": 250000, "rpd": 250}, "default": {"rpm": 5}}
+# TPM is charged with the estimated prompt size (request body bytes / 4), as output tokens
+# are not known before the request is sent. The buckets are kept per process: with
+# SERVER_WORKERS > 1, each worker allows the full limits, so divide them by the number of workers.
+MODEL_RATE_LIMITS = {}
+RATE_PACING_ENABLED = True
+# How the next key for a request is chosen:
+#   "round_robin" - the usable keys take turns
+#   "least_used"  - the key with the fewest requests for the model today (spreads daily quota evenly)
+#   "p2c_ewma"    - of the next two usable keys in the rotation, the one with the lower recent
+#                   latency and error rate (steers traffic away from slow or failing keys)
+KEY_SELECTION_STRATEGY = "round_robin"
+# Seconds between rebuilds of the per-model index of "least_used"; a rebuild picks up keys back
+# from a cooldown and requests made by other workers
+KEY_SELECTION_INDEX_REFRESH_SECONDS = 5.0
+# Weight of the newest sample in the per-key latency and error rate averages (EWMA)
+KEY_STATS_EWMA_ALPHA = 0.2
+# Seconds added to a key's expected latency per unit of recent error rate ("p2c_ewma")
+KEY_SELECTION_ERROR_PENALTY = 10.0
+# Number of keys taken from the rotation per pick; the one with the most headroom is used
+RATE_PACING_CANDIDATES = 4
+# Interval in seconds between rate pacing statistics log lines
+RATE_PACING_STATS_LOG_INTERVAL = 60
+# Upstream 429 handling: a per-day quota marks the key exhausted for the model until the daily
+# reset; a per-minute (or unclassified) limit only takes it out of the rotation for a cooldown
+# that doubles with every repeated 429 (at least the upstream retry delay)
+RATE_LIMIT_COOLDOWN_BASE_SECONDS = 30
+RATE_LIMIT_COOLDOWN_MAX_SECONDS = 900
+# A key without a 429 for this many seconds after its last cooldown starts again at the base cooldown
+RATE_LIMIT_STRIKE_RESET_SECONDS = 600
+# Send a minimal request (1 output token) to confirm a key has recovered before it is used again
+RATE_LIMIT_PROBE_ENABLED = True
+# Daily quotas (and usage counts) reset at midnight in this timezone; Gemini resets at midnight
+# Pacific time. Set to None to use the local date.
+DAILY_RESET_TIMEZONE = "America/Los_Angeles"
+# Opt-in cache of upstream responses for requests that always get the same answer:
+# generateContent/streamGenerateContent with temperature 0, countTokens/embedContent calls and
+# metadata GETs (e.g. v1beta/models). A hit is answered without using a key or any quota.
+# Each worker process keeps its own cache.
+RESPONSE_CACHE_ENABLED = False
+# LRU limits: number of entries and total size of the cached response bodies
+RESPONSE_CACHE_MAX_ENTRIES = 1000
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Responses larger than this are not cached
+RESPONSE_CACHE_MAX_ENTRY_BYTES = 1024 * 1024
+# Seconds a cached response stays valid, per model ("default" for all other models); 0 disables caching for a model
+RESPONSE_CACHE_TTLS = {"default": 3600}
+# Seconds a cached metadata GET (model list, model info) stays valid
+RESPONSE_CACHE_METADATA_TTL = 3600
+# Interval in seconds between response cache statistics log lines
+RESPONSE_CACHE_STATS_LOG_INTERVAL = 60
+# Coalesce identical requests (same model and Gemini body) that arrive while the first one is
+# still waiting for upstream: they share its response, streams are fanned out chunk by chunk,
+# instead of each one using a key. Requests with a Cache-Control: no-cache header are not coalesced.
+REQUEST_COALESCING_ENABLED = False
+# Also coalesce generation requests that sample (temperature other than 0, or unset); they then
+# all get the same answer instead of one sample each, so this is a separate opt-in
+REQUEST_COALESCING_SAMPLED = False
+# Seconds a coalesced request waits for the next chunk of the shared response before giving up
+REQUEST_COALESCING_WAIT_TIMEOUT = 120
+# Interval in seconds between request coalescing statistics log lines
+REQUEST_COALESCING_STATS_LOG_INTERVAL = 60
+# Hedged requests: if a non-streaming call (generateContent, countTokens, embedContent) has not
+# been answered after the model's HEDGING_LATENCY_PERCENTILE latency, a duplicate is sent with
+# another key. The first answer is returned and the other attempt is cancelled.
+HEDGING_ENABLED = False
+HEDGING_LATENCY_PERCENTILE = 95
+# Never hedge sooner than this many seconds after the first attempt
+HEDGING_MIN_DELAY = 1.0
+# Recent latencies kept per model, and how many are needed before requests are hedged
+HEDGING_LATENCY_SAMPLES = 200
+HEDGING_MIN_SAMPLES = 20
+# Hedge budget: each hedgeable request earns HEDGING_BUDGET_RATIO hedges (at most
+# HEDGING_BUDGET_BURST saved up), so at most ~5% of requests are duplicated
+HEDGING_BUDGET_RATIO = 0.05
+HEDGING_BUDGET_BURST = 5
+# Interval in seconds between hedging statistics log lines
+HEDGING_STATS_LOG_INTERVAL = 60
+# Context caching for OpenAI requests: a large system instruction (with the tools and the leading
+# conversation turns) that repeats across requests is stored once per key and model as an upstream
+# cachedContents resource, and later requests reference it instead of resending those prompt tokens.
+# Cached tokens are billed at a reduced rate plus storage time. Each worker process keeps its own caches.
+CONTEXT_CACHE_ENABLED = False
+# Smallest prefix worth caching, in estimated tokens (~4 bytes of JSON each); Gemini rejects
+# caches below the model's minimum (1024-4096 tokens)
+CONTEXT_CACHE_MIN_TOKENS = 4096
+# A prefix is cached once it was seen in this many requests
+CONTEXT_CACHE_MIN_REPEATS = 2
+# Lifetime of an upstream cache; it is extended while in use once less than half of it remains
+CONTEXT_CACHE_TTL_SECONDS = 600
+# Upstream caches kept (per key and prefix); the least recently used one is deleted beyond this
+CONTEXT_CACHE_MAX_ENTRIES = 200
+# Interval in seconds between context caching statistics log lines
+CONTEXT_CACHE_STATS_LOG_INTERVAL = 60
+# OpenAI-compatible embeddings (POST /v1/embeddings) are answered with Gemini batchEmbedContents.
+# Inputs of concurrent requests for the same model (and dimensions) are merged into one upstream
+# call: a batch is sent once it holds EMBEDDING_BATCH_MAX_SIZE inputs (Gemini accepts up to 100)
+# or EMBEDDING_BATCH_WINDOW_MS after its first input arrived. Each batch uses one key (one request
+# of its quota). Set EMBEDDING_BATCHING_ENABLED to False to send each request on its own.
+EMBEDDING_BATCHING_ENABLED = True
+EMBEDDING_BATCH_WINDOW_MS = 5
+EMBEDDING_BATCH_MAX_SIZE = 100
+# Model used when an embeddings request names none
+EMBEDDING_DEFAULT_MODEL = "text-embedding-004"
+# Interval in seconds between embedding batching statistics log lines
+EMBEDDING_STATS_LOG_INTERVAL = 60
+# Admission control: caps the upstream calls in progress (a streamed response counts until it
+# ends), so a traffic spike queues briefly instead of slowing every request down together.
+# Per model, at most ADMISSION_PER_KEY_CONCURRENCY calls per key currently usable for it run at
+# once (and at most ADMISSION_MAX_CONCURRENT_PER_MODEL); at most ADMISSION_MAX_CONCURRENT in total.
+# 0 disables a cap. Further requests wait in a queue of ADMISSION_QUEUE_SIZE for up to
+# ADMISSION_QUEUE_TIMEOUT seconds; beyond that they get ADMISSION_REJECT_STATUS with Retry-After.
+ADMISSION_CONTROL_ENABLED = False
+ADMISSION_MAX_CONCURRENT = 128
+ADMISSION_MAX_CONCURRENT_PER_MODEL = 0
+ADMISSION_PER_KEY_CONCURRENCY = 4
+ADMISSION_QUEUE_SIZE = 256
+ADMISSION_QUEUE_TIMEOUT = 10
+# 503 (server busy) or 429 (client should slow down)
+ADMISSION_REJECT_STATUS = 503
+# Interval in seconds between admission control statistics log lines
+ADMISSION_STATS_LOG_INTERVAL = 60
+# Total seconds a request may take, across all its attempts; each attempt's timeout is
+# UPSTREAM_TIMEOUT or what is left of the deadline, whichever is shorter. A client can set its
+# own deadline in seconds with one of REQUEST_DEADLINE_HEADERS, up to REQUEST_DEADLINE_MAX_SECONDS.
+REQUEST_DEADLINE_SECONDS = 180
+REQUEST_DEADLINE_MAX_SECONDS = 600
+REQUEST_DEADLINE_HEADERS = ("x-request-timeout", "x-stainless-timeout")
+# Retries: a timeout, a connection error or an upstream status in RETRY_STATUSES is retried on
+# another key, after a jittered exponential backoff (RETRY_BACKOFF_BASE * 2^retry seconds, at most
+# RETRY_BACKOFF_MAX), up to RETRY_MAX_RETRIES times and while the deadline leaves at least
+# RETRY_MIN_ATTEMPT_SECONDS for the attempt. Only generation, embedding, token counting and GET
+# requests are retried. Upstream 5xx responses don't count as key usage.
+RETRY_ENABLED = True
+RETRY_MAX_RETRIES = 2
+RETRY_STATUSES = (500, 502, 503, 504)
+RETRY_BACKOFF_BASE = 0.2
+RETRY_BACKOFF_MAX = 2.0
+RETRY_MIN_ATTEMPT_SECONDS = 1.0
+# Circuit breakers: after CIRCUIT_BREAKER_FAILURES consecutive failed attempts (timeouts,
+# connection errors, 5xx) a key is taken out of rotation for CIRCUIT_BREAKER_OPEN_SECONDS. Then a
+# single request tests it (half-open): success puts the key back, failure takes it out again.
+CIRCUIT_BREAKER_ENABLED = True
+CIRCUIT_BREAKER_FAILURES = 3
+CIRCUIT_BREAKER_OPEN_SECONDS = 30
+# Interval in seconds between retry and circuit breaker statistics log lines
+RETRY_STATS_LOG_INTERVAL = 60
+# Metrics: request counts, latency histograms, key usage and the statistics of the features
+# above are served in the Prometheus text format on GET METRICS_PATH
+METRICS_ENABLED = True
+METRICS_PATH = "/metrics"
+# Require the placeholder token (x-goog-api-key or Authorization: Bearer) to read the metrics
+METRICS_REQUIRE_TOKEN = False
+# Tracing: the time spent in each phase of a request (parsing, request conversion, key selection,
+# upstream until the response headers, trailing-error filter, response conversion) is sent in a
+# Server-Timing response header, and a sample of requests is exported as spans
+TRACING_ENABLED = True
+TRACING_SERVER_TIMING = True
+# Fraction of requests exported as spans
+TRACING_SAMPLE_RATE = 0.01
+# Fraction of requests with a sampled W3C traceparent header exported as spans. A sampled parent
+# can only raise the rate up to this, so clients cannot make every request exported.
+TRACING_PARENT_SAMPLE_RATE = 0.1
+# "file" appends OTLP JSON spans to TRACING_FILE in LOG_DIRECTORY, "otlp" posts them to an OTLP/HTTP collector
+TRACING_EXPORTER = "file"
+TRACING_FILE = "traces.jsonl"
+# The span file is rotated at TRACING_FILE_MAX_BYTES, keeping TRACING_FILE_BACKUP_COUNT old files
+TRACING_FILE_MAX_BYTES = 50 * 1024 * 1024
+TRACING_FILE_BACKUP_COUNT = 2
+TRACING_OTLP_ENDPOINT = "http://localhost:4318/v1/traces"
+TRACING_SERVICE_NAME = "gemini-key-manager"
+# Spans are exported in the background, in batches of up to TRACING_EXPORT_BATCH_SIZE at least every
+# TRACING_EXPORT_INTERVAL seconds. Spans beyond TRACING_MAX_QUEUED_SPANS are dropped.
+TRACING_EXPORT_BATCH_SIZE = 512
+TRACING_EXPORT_INTERVAL = 5
+TRACING_MAX_QUEUED_SPANS = 10000
 # --- End Configuration ---
 
 # --- Global Variables ---
-# Will hold the cycle iterator for API keys after loading
-key_cycler = None
+# Will hold the KeyPool (per-model rotation of usable keys) after loading
+key_pool = None
 # List of all loaded API keys
 all_api_keys = []
-# Dictionary to store API key usage counts for the current day
-key_usage_counts = {}
-# Dictionary to store API key usage counts per model for the current day
-model_usage_counts = {}
-# Set to store keys that hit the 429 limit today
-# Now a dictionary: {api_key: {model1, model2}}
-exhausted_keys_today = {}
-# Track the date for which the counts and exhausted list are valid
-current_usage_date = date.today()
+# Today's usage counts, per-model counts, exhausted keys and their date live in
+# `usage_state` (a UsageState, see Usage Data Handling)
 # File to store usage data
 USAGE_DATA_FILE = "key_usage.txt"
+# Usage data is written in the background: at most every USAGE_FLUSH_INTERVAL seconds,
+# or sooner once USAGE_FLUSH_BATCH_SIZE changes have accumulated
+USAGE_FLUSH_INTERVAL = 5
+USAGE_FLUSH_BATCH_SIZE = 200
+# Number of striped locks protecting the usage counters (updates for different keys rarely share one)
+USAGE_LOCK_SHARDS = 64
+# Shared upstream HTTP client (created lazily by get_upstream_client())
+upstream_client = None
 # --- End Global Variables ---
 
+# --- Configuration Overrides ---
+# Settings are overridden in this order: the values above, environment variables of the same
+# name, command line options. They are applied here, before anything below reads them.
+# Names of the settings: everything in upper case from the start of the Configuration section on
+_module_names = list(globals())
+CONFIG_NAMES = tuple(name for name in _module_names[_module_names.index("PLACEHOLDER_TOKEN"):] if name.isupper())
+del _module_names
+# Command line options for the most common settings; `--set NAME=VALUE` covers all of them
+COMMAND_LINE_OPTIONS = (
+    ("--host", "LISTEN_HOST", "address to listen on"),
+    ("--port", "LISTEN_PORT", "port to listen on"),
+    ("--key-file", "API_KEY_FILE", "file with the Gemini API keys, one per line"),
+    ("--upstream", "GEMINI_API_BASE_URL", "base URL of the Gemini API"),
+    ("--engine", "SERVER_ENGINE", "serving engine: sync or async"),
+    ("--server", "SERVER_BACKEND", "auto, gunicorn, waitress, uvicorn or development"),
+    ("--workers", "SERVER_WORKERS", "worker processes (gunicorn)"),
+    ("--threads", "SERVER_THREADS", "request threads per worker (sync engine)"),
+    ("--timeout", "SERVER_WORKER_TIMEOUT", "seconds before an unresponsive worker is restarted (gunicorn)"),
+    ("--graceful-timeout", "SERVER_GRACEFUL_TIMEOUT", "seconds requests in progress may take to finish after SIGTERM"),
+    ("--backlog", "SERVER_BACKLOG", "listen backlog"),
+    ("--keepalive", "SERVER_KEEPALIVE_TIMEOUT", "seconds an idle client connection is kept open"),
+    ("--log-level", "LOG_LEVEL", "DEBUG, INFO, WARNING or ERROR"),
+)
+
+def parse_config_value(name, text):
+    """
+    Parses `text` as the new value of the setting `name`, after the type of its current value:
+    true/false (or 1/0, yes/no, on/off) for flags, numbers, JSON for dicts and tuples (e.g.
+    RETRY_STATUSES='[500, 503]'), level names for LOG_LEVEL and plain text for strings.
+    Raises ValueError for a value that does not fit.
+    """
+    current = globals()[name]
+    text = text.strip()
+    if name == "LOG_LEVEL" and not text.isdigit():
+        level = logging.getLevelName(text.upper())
+        if not isinstance(level, int):
+            raise ValueError(f"unknown log level '{text}'")
+        return level
+    if isinstance(current, bool):
+        if text.lower() in ("1", "true", "yes", "on"):
+            return True
+        if text.lower() in ("0", "false", "no", "off"):
+            return False
+        raise ValueError(f"expected true or false, got '{text}'")
+    if isinstance(current, (int, float)):
+        try:
+            return int(text)
+        except ValueError:
+            pass
+        try:
+            return float(text)
+        except ValueError:
+            raise ValueError(f"expected a number, got '{text}'") from None
+    if isinstance(current, (dict, tuple, list)):
+        value = json.loads(text)
+        if isinstance(value, dict) != isinstance(current, dict) or not isinstance(value, (dict, list)):
+            raise ValueError(f"expected a JSON {'object' if isinstance(current, dict) else 'array'}, got '{text}'")
+        return tuple(value) if isinstance(current, tuple) else value
+    return text
+
+def apply_config_overrides(overrides):
+    """Sets the settings in `overrides` (name -> text); raises ValueError naming the first invalid one."""
+    for name, text in overrides.items():
+        if name not in CONFIG_NAMES:
+            raise ValueError(f"unknown setting {name}")
+        try:
+            globals()[name] = parse_config_value(name, text)
+        except ValueError as e:
+            raise ValueError(f"invalid value for {name}: {e}") from None
+
+def parse_command_line(argv):
+    """Applies the settings given on the command line and returns them (name -> text)."""
+    parser = argparse.ArgumentParser(
+        description="Gemini API key rotation proxy. Options override the settings at the top of the script "
+                    "and the environment variables of the same name.")
+    for option, name, help_text in COMMAND_LINE_OPTIONS:
+        parser.add_argument(option, dest=name, metavar=name, help=f"{help_text} (default: {logging.getLevelName(LOG_LEVEL) if name == 'LOG_LEVEL' else globals()[name]})")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="override any setting, e.g. --set ADMISSION_CONTROL_ENABLED=true (repeatable)")
+    args = parser.parse_args(argv)
+    overrides = {name: value for name, value in vars(args).items() if name != "set" and value is not None}
+    for assignment in args.set:
+        name, separator, value = assignment.partition("=")
+        if not separator:
+            parser.error(f"--set expects NAME=VALUE, got '{assignment}'")
+        overrides[name.strip().upper()] = value
+    try:
+        apply_config_overrides(overrides)
+    except ValueError as e:
+        parser.error(str(e))
+    return overrides
+
+try:
+    apply_config_overrides({name: os.environ[name] for name in CONFIG_NAMES if name in os.environ})
+except ValueError as e:
+    sys.exit(f"Configuration error (environment): {e}")
+if __name__ == '__main__':
+    parse_command_line(sys.argv[1:])
+GEMINI_API_BASE_URL = GEMINI_API_BASE_URL.rstrip("/")
+# --- End Configuration Overrides ---
+
 # --- Logging Setup ---
+# Id of the request being handled, attached to every log record (see BackgroundLogHandler).
+# Context variables follow the request across its thread or asyncio task.
+request_id_var = contextvars.ContextVar("request_id", default=None)
+# The BackgroundLogHandler installed by setup_logging()
+log_handler = None
+
+class BackgroundLogHandler(logging.handlers.QueueHandler):
+    """
+    Hands log records to a background thread that formats and writes them with `handlers`, so
+    requests never wait for console or disk I/O. When LOG_QUEUE_SIZE records are waiting, new
+    ones are dropped and counted instead of blocking the request.
+    """
+
+    def __init__(self, handlers, maxsize):
+        super().__init__(queue.Queue(maxsize))
+        self.target_handlers = handlers
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._listener = None
+        self._owner_pid = None
+        self._start()
+
+    def _start(self):
+        # Threads do not survive fork(), so each worker process starts its own writer
+        self.queue = queue.Queue(self.maxsize)
+        self._listener = logging.handlers.QueueListener(self.queue, *self.target_handlers, respect_handler_level=True)
+        self._listener.start()
+        self._owner_pid = os.getpid()
+
+    def prepare(self, record):
+        # Records stay in this process, so unlike the default they are not formatted here: the
+        # message of a call with %-style arguments is only built by the writer thread.
+        # Arguments must therefore not be mutated after they are logged.
+        record.request_id = request_id_var.get()
+        return record
+
+    def enqueue(self, record):
+        # Called with the handler lock held
+        if self._owner_pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        """Writes the records still queued and stops the writer thread."""
+        if self._listener is not None and self._owner_pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+            if self.dropped:
+                print(f"Logging: {self.dropped} records were dropped because the log queue was full.", file=sys.stderr)
+
+class JSONLogFormatter(logging.Formatter):
+    """
+    Formats a record as one JSON object per line: time, level, function, request id and message,
+    plus the structured fields passed with extra={"fields": {...}}.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "func": record.funcName,
+            "request_id": getattr(record, "request_id", None),
+            "message": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class LogPayload:
+    """
+    A request/response body (bytes or JSON data) passed as a logging argument. It is decoded or
+    serialized, and cut to LOG_BODY_MAX_CHARS, only when the writer thread formats the record.
+    """
+    __slots__ = ("payload",)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        payload = self.payload
+        if isinstance(payload, (bytes, bytearray)):
+            total = len(payload)
+            text = bytes(payload[:LOG_BODY_MAX_CHARS * 4]).decode('utf-8', errors='replace')
+        elif isinstance(payload, (dict, list)):
+            text = json.dumps(payload, ensure_ascii=False, default=str)
+            total = len(text)
+        else:
+            text = str(payload)
+            total = len(text)
+        if len(text) > LOG_BODY_MAX_CHARS:
+            return f"{text[:LOG_BODY_MAX_CHARS]}... [truncated, {total} {'bytes' if isinstance(payload, (bytes, bytearray)) else 'chars'} in total]"
+        return text
+
+# Header values that are never logged in full
+SECRET_HEADERS = ('x-goog-api-key', 'authorization', 'proxy-authorization', 'cookie')
+
+def redact_headers(headers):
+    """Returns a copy of `headers` with API keys and other credentials reduced to their last 4 characters."""
+    return {name: (f"...{str(value)[-4:]}" if name.lower() in SECRET_HEADERS else value) for name, value in headers.items()}
+
+def should_log_bodies():
+    """Decides whether the bodies and headers of a new request are logged (LOG_BODY_SAMPLE_RATE, DEBUG only)."""
+    return logging.getLogger().isEnabledFor(logging.DEBUG) and random.random() < LOG_BODY_SAMPLE_RATE
+
 def setup_logging():
-    """Configures logging to both console and a rotating file."""
+    """
+    Configures logging to both console and a rotating file. Records are written by a background
+    thread (see BackgroundLogHandler).
+    """
+    global log_handler
     log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - [%(funcName)s] - %(message)s')
     log_level = LOG_LEVEL
 
@@ -60,12 +575,12 @@ def setup_logging():
     log_filename_with_ts = os.path.join(LOG_DIRECTORY, f"proxy_debug_{timestamp}.log")
 
     # File Handler (Rotates log file)
-    # Rotates when the log reaches 1MB, keeps 3 backup logs
+    # Rotates when the log reaches LOG_FILE_MAX_BYTES, keeps LOG_FILE_BACKUP_COUNT backup logs
     try:
         # Use the full path with timestamp
         file_handler = logging.handlers.RotatingFileHandler(
-            log_filename_with_ts, maxBytes=1*1024*1024, backupCount=3, encoding='utf-8')
-        file_handler.setFormatter(log_formatter)
+            log_filename_with_ts, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUP_COUNT, encoding='utf-8')
+        file_handler.setFormatter(JSONLogFormatter() if LOG_FORMAT == "json" else log_formatter)
         file_handler.setLevel(log_level)
     except Exception as e:
         print(f"Error setting up file logger for {log_filename_with_ts}: {e}", file=sys.stderr)
@@ -77,22 +592,392 @@ def setup_logging():
     # Console handler might have a different level (e.g., INFO) if desired
     console_handler.setLevel(logging.INFO)
 
-    # Get the root logger and add handlers
+    # Get the root logger and route everything through the background writer
     root_logger = logging.getLogger()
     root_logger.setLevel(log_level) # Set root logger level to the lowest level needed
-    if file_handler:
-        root_logger.addHandler(file_handler)
-    root_logger.addHandler(console_handler)
+    handlers = [file_handler, console_handler] if file_handler else [console_handler]
+    log_handler = BackgroundLogHandler(handlers, LOG_QUEUE_SIZE)
+    root_logger.addHandler(log_handler)
+    atexit.register(log_handler.stop)
+    # httpx logs every request at INFO; the proxy already logs each upstream call itself
+    logging.getLogger("httpx").setLevel(logging.WARNING)
 
     # Update log message to show the generated filename
-    logging.info("Logging configured. Level: %s, File: %s", logging.getLevelName(log_level), log_filename_with_ts if file_handler else "N/A")
+    logging.info("Logging configured. Level: %s, Format: %s, File: %s", logging.getLevelName(log_level), LOG_FORMAT, log_filename_with_ts if file_handler else "N/A")
+
+# --- JSON Codec ---
+try:
+    import orjson # Optional: `pip install orjson` for faster request/response (de)serialization
+except ImportError:
+    orjson = None
+
+def _stdlib_json_loads(data):
+    return json.loads(data)
+
+def _stdlib_json_dumps(obj, sort_keys=False):
+    return json.dumps(obj, separators=(',', ':'), sort_keys=sort_keys).encode('ascii')
+
+def _orjson_loads(data):
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # orjson is stricter than the standard library (NaN, Infinity, ...); keep accepting what it accepts
+        return json.loads(data)
+
+def _orjson_dumps(obj, sort_keys=False):
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    except TypeError: # Non-string keys, integers beyond 64 bits, lone surrogates, ...
+        return _stdlib_json_dumps(obj, sort_keys)
+
+# json_loads(data) parses bytes or str without decoding bytes first; json_dumps(obj, sort_keys=False)
+# returns compact UTF-8 bytes. Both are bound by configure_json_codec().
+json_codec_name = "stdlib"
+json_loads = _stdlib_json_loads
+json_dumps = _stdlib_json_dumps
+
+def configure_json_codec():
+    """Binds json_loads/json_dumps to the library selected by JSON_CODEC and returns its name."""
+    global json_codec_name, json_loads, json_dumps
+    if JSON_CODEC == "orjson" and orjson is None:
+        logging.warning("JSON_CODEC is 'orjson' but orjson is not installed. Falling back to the standard library json module.")
+    if JSON_CODEC in ("auto", "orjson") and orjson is not None:
+        json_codec_name, json_loads, json_dumps = "orjson", _orjson_loads, _orjson_dumps
+    else:
+        json_codec_name, json_loads, json_dumps = "stdlib", _stdlib_json_loads, _stdlib_json_dumps
+    return json_codec_name
+
+configure_json_codec()
 
 # --- Usage Data Handling ---
+_daily_reset_tzinfo = None
+
+def current_usage_day():
+    """Returns the current date in DAILY_RESET_TIMEZONE, the day the provider's daily quotas belong to."""
+    global _daily_reset_tzinfo, DAILY_RESET_TIMEZONE
+    if DAILY_RESET_TIMEZONE is None:
+        return date.today()
+    if _daily_reset_tzinfo is None or _daily_reset_tzinfo.key != DAILY_RESET_TIMEZONE:
+        try:
+            _daily_reset_tzinfo = ZoneInfo(DAILY_RESET_TIMEZONE)
+        except Exception as e: # No zoneinfo module or no tz database (on Windows: pip install tzdata)
+            logging.warning(f"Could not load timezone '{DAILY_RESET_TIMEZONE}' ({e}). Daily usage resets at local midnight instead.")
+            DAILY_RESET_TIMEZONE = None
+            return date.today()
+    return datetime.now(_daily_reset_tzinfo).date()
+
+class UsageState:
+    """
+    Today's usage counters and exhausted marks, safe to update from many threads.
+
+    Updates for one API key take one of USAGE_LOCK_SHARDS striped locks, chosen by the
+    key's hash. Requests that use different keys therefore rarely wait for each other,
+    and each read-modify-write of a counter is atomic. Whole-state operations (day
+    rollover, loading, snapshots for saving) take every shard lock in a fixed order.
+    """
+
+    def __init__(self, shards=USAGE_LOCK_SHARDS):
+        self._shard_locks = [threading.Lock() for _ in range(max(1, shards))]
+        self._rollover_lock = threading.Lock()
+        self.usage_date = current_usage_day() # Date the counters and exhausted marks are valid for
+        self.key_counts = {} # {api_key: total count}
+        self.model_counts = {} # {api_key: {model: count}}
+        self.exhausted = {} # {api_key: {model1, model2}}
+
+    def _lock_for(self, api_key):
+        return self._shard_locks[hash(api_key) % len(self._shard_locks)]
+
+    def _acquire_all(self):
+        for lock in self._shard_locks:
+            lock.acquire()
+
+    def _release_all(self):
+        for lock in reversed(self._shard_locks):
+            lock.release()
+
+    def replace(self, usage_date, key_counts, model_counts, exhausted):
+        """Replaces the whole state, e.g. with data loaded from disk."""
+        self._acquire_all()
+        try:
+            self.usage_date = usage_date
+            self.key_counts = dict(key_counts)
+            self.model_counts = {key: dict(models) for key, models in model_counts.items()}
+            self.exhausted = {key: set(models) for key, models in exhausted.items()}
+        finally:
+            self._release_all()
+
+    def import_data(self, usage_date, key_counts, model_counts, exhausted):
+        """Initializes the state from data loaded from the usage file."""
+        self.replace(usage_date, key_counts, model_counts, exhausted)
+
+    def rollover_if_needed(self, today=None):
+        """
+        Clears all counters and exhausted marks if the date has changed. Returns True only
+        in the one thread that performed the rollover.
+        """
+        today = today or current_usage_day()
+        if today == self.usage_date: # Fast path, no lock needed
+            return False
+        with self._rollover_lock:
+            if today == self.usage_date: # Another thread rolled over first
+                return False
+            logging.info(f"Date changed from {self.usage_date} to {today}. Resetting daily usage counts, model counts, and exhausted keys list.")
+            self.replace(today, {}, {}, {})
+            return True
+
+    def record_usage(self, api_key, model):
+        """Increments the counters of `api_key`. Returns (model count, total count) after the increment."""
+        with self._lock_for(api_key):
+            total_count = self.key_counts.get(api_key, 0) + 1
+            self.key_counts[api_key] = total_count
+            models = self.model_counts.get(api_key)
+            if models is None:
+                models = self.model_counts[api_key] = {}
+            model_count = models.get(model, 0) + 1
+            models[model] = model_count
+        return model_count, total_count
+
+    def model_count(self, api_key, model):
+        """Returns today's request count of `api_key` for `model`."""
+        return self.model_counts.get(api_key, {}).get(model, 0)
+
+    def model_counts_for(self, model):
+        """Returns today's request counts for `model` by key ({api_key: count}, keys without requests are missing)."""
+        # list() copies the items atomically, so concurrent inserts of new keys are harmless
+        return {api_key: models[model] for api_key, models in list(self.model_counts.items()) if model in models}
+
+    def mark_exhausted(self, api_key, model):
+        """Marks `model` as exhausted for `api_key` today."""
+        with self._lock_for(api_key):
+            self.exhausted.setdefault(api_key, set()).add(model)
+
+    def exhausted_copy(self):
+        """Returns a copy of today's exhausted marks."""
+        self._acquire_all()
+        try:
+            return {key: set(models) for key, models in self.exhausted.items()}
+        finally:
+            self._release_all()
+
+    def snapshot(self):
+        """Returns a consistent, JSON-serializable copy of the state (the usage file format)."""
+        self._acquire_all()
+        try:
+            return {
+                "date": self.usage_date.isoformat(),
+                "counts": dict(self.key_counts),
+                "model_counts": {key: dict(models) for key, models in self.model_counts.items()},
+                # Convert sets to lists for JSON serialization
+                "exhausted_keys": {key: list(models) for key, models in self.exhausted.items()}
+            }
+        finally:
+            self._release_all()
+
+usage_state = UsageState()
+
+class SQLiteStateStore:
+    """
+    SQLite database (WAL mode) holding the key state shared by all worker processes on a host.
+
+    Connections are pooled per process and handed out for one short transaction at a time,
+    so any thread can use the store. After fork() the inherited connections are discarded,
+    and each worker opens its own.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS key_counts (api_key TEXT PRIMARY KEY, count INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS model_counts (
+            api_key TEXT NOT NULL, model TEXT NOT NULL, count INTEGER NOT NULL,
+            PRIMARY KEY (api_key, model));
+        CREATE TABLE IF NOT EXISTS exhausted (
+            api_key TEXT NOT NULL, model TEXT NOT NULL, PRIMARY KEY (api_key, model));
+        CREATE TABLE IF NOT EXISTS rotation (
+            model TEXT NOT NULL, api_key TEXT NOT NULL, seq INTEGER NOT NULL,
+            cooldown_until REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (model, api_key));
+        CREATE INDEX IF NOT EXISTS rotation_order ON rotation (model, seq);
+        CREATE TABLE IF NOT EXISTS rotation_models (model TEXT PRIMARY KEY);
+    """
+    # Tables holding the state of one day (cleared at the day rollover)
+    DAILY_TABLES = ("key_counts", "model_counts", "exhausted", "rotation", "rotation_models")
+
+    def __init__(self, path, max_idle_connections=8):
+        self.path = path
+        self._max_idle_connections = max_idle_connections
+        self._idle_connections = []
+        self._owner_pid = os.getpid()
+        conn = self._acquire()
+        conn.executescript(self.SCHEMA) # executescript() manages its own transaction
+        rotation_columns = {row[1] for row in conn.execute("PRAGMA table_info(rotation)")}
+        if "cooldown_until" not in rotation_columns: # Database created by an older version
+            conn.execute("ALTER TABLE rotation ADD COLUMN cooldown_until REAL NOT NULL DEFAULT 0")
+        self._release(conn)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=USAGE_STATE_DB_BUSY_TIMEOUT,
+                               isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL") # Readers never block the (single) writer
+        conn.execute("PRAGMA synchronous=NORMAL") # fsync at checkpoints only; safe with WAL
+        return conn
+
+    def _acquire(self):
+        if self._owner_pid != os.getpid(): # Forked: never reuse the parent's connections
+            self._owner_pid = os.getpid()
+            self._idle_connections = []
+        try:
+            return self._idle_connections.pop()
+        except IndexError:
+            return self._connect()
+
+    def _release(self, conn):
+        if len(self._idle_connections) < self._max_idle_connections:
+            self._idle_connections.append(conn)
+        else:
+            conn.close()
+
+    @contextmanager
+    def transaction(self, write=True):
+        """Runs the block in one transaction; write transactions take the write lock up front."""
+        conn = self._acquire()
+        try:
+            conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.close() # Do not return a connection in an unknown state to the pool
+            raise
+        except BaseException:
+            self._release(conn) # Rolled back cleanly
+            raise
+        self._release(conn)
+
+    def get_day(self, conn):
+        row = conn.execute("SELECT value FROM meta WHERE name = 'day'").fetchone()
+        return row[0] if row else None
+
+    def start_day(self, conn, usage_date):
+        """Clears the daily tables and records `usage_date` as the current day."""
+        for table in self.DAILY_TABLES:
+            conn.execute(f"DELETE FROM {table}")
+        conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('day', ?)", (usage_date.isoformat(),))
+
+class SQLiteUsageState:
+    """
+    UsageState backed by a SQLiteStateStore, so the usage counters and exhausted marks are
+    shared by every worker process on the host. Offers the same methods as UsageState.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._rollover_lock = threading.Lock()
+        with store.transaction(write=False) as conn:
+            day = store.get_day(conn)
+        self.usage_date = date.fromisoformat(day) if day else current_usage_day()
+
+    def import_data(self, usage_date, key_counts, model_counts, exhausted):
+        """
+        Initializes the shared state from the usage file, unless the database already holds
+        data for `usage_date` (written by another worker or a previous run), which then wins.
+        """
+        with self.store.transaction() as conn:
+            if self.store.get_day(conn) == usage_date.isoformat():
+                logging.info(f"Shared usage database {self.store.path} already holds data for {usage_date}; not importing the usage file.")
+            else:
+                self.store.start_day(conn, usage_date)
+                conn.executemany("INSERT INTO key_counts (api_key, count) VALUES (?, ?)", key_counts.items())
+                conn.executemany(
+                    "INSERT INTO model_counts (api_key, model, count) VALUES (?, ?, ?)",
+                    [(key, model, count) for key, models in model_counts.items() for model, count in models.items()])
+                conn.executemany(
+                    "INSERT INTO exhausted (api_key, model) VALUES (?, ?)",
+                    [(key, model) for key, models in exhausted.items() for model in models])
+        self.usage_date = usage_date
+
+    def rollover_if_needed(self, today=None):
+        """
+        Clears the shared state if the date has changed. Returns True only in the one thread
+        (of all worker processes) that performed the rollover.
+        """
+        today = today or current_usage_day()
+        if today == self.usage_date: # Fast path, no database access
+            return False
+        with self._rollover_lock:
+            if today == self.usage_date:
+                return False
+            with self.store.transaction() as conn:
+                day = self.store.get_day(conn)
+                performed = day is None or day < today.isoformat()
+                if performed:
+                    self.store.start_day(conn, today)
+            if performed:
+                logging.info(f"Date changed from {self.usage_date} to {today}. Resetting daily usage counts, model counts, and exhausted keys list.")
+            self.usage_date = today
+            return performed
+
+    def record_usage(self, api_key, model):
+        """Increments the counters of `api_key`. Returns (model count, total count) after the increment."""
+        with self.store.transaction() as conn:
+            conn.execute(
+                "INSERT INTO key_counts (api_key, count) VALUES (?, 1) "
+                "ON CONFLICT (api_key) DO UPDATE SET count = count + 1", (api_key,))
+            conn.execute(
+                "INSERT INTO model_counts (api_key, model, count) VALUES (?, ?, 1) "
+                "ON CONFLICT (api_key, model) DO UPDATE SET count = count + 1", (api_key, model))
+            total_count = conn.execute("SELECT count FROM key_counts WHERE api_key = ?", (api_key,)).fetchone()[0]
+            model_count = conn.execute(
+                "SELECT count FROM model_counts WHERE api_key = ? AND model = ?", (api_key, model)).fetchone()[0]
+        return model_count, total_count
+
+    def model_count(self, api_key, model):
+        """Returns today's request count of `api_key` for `model`."""
+        with self.store.transaction(write=False) as conn:
+            row = conn.execute(
+                "SELECT count FROM model_counts WHERE api_key = ? AND model = ?", (api_key, model)).fetchone()
+        return row[0] if row else 0
+
+    def model_counts_for(self, model):
+        """Returns today's request counts for `model` by key ({api_key: count}, keys without requests are missing)."""
+        with self.store.transaction(write=False) as conn:
+            return dict(conn.execute("SELECT api_key, count FROM model_counts WHERE model = ?", (model,)))
+
+    def mark_exhausted(self, api_key, model):
+        """Marks `model` as exhausted for `api_key` today."""
+        with self.store.transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO exhausted (api_key, model) VALUES (?, ?)", (api_key, model))
+
+    def exhausted_copy(self):
+        """Returns a copy of today's exhausted marks."""
+        exhausted = {}
+        with self.store.transaction(write=False) as conn:
+            for api_key, model in conn.execute("SELECT api_key, model FROM exhausted"):
+                exhausted.setdefault(api_key, set()).add(model)
+        return exhausted
+
+    def snapshot(self):
+        """Returns a consistent, JSON-serializable copy of the state (the usage file format)."""
+        model_counts = {}
+        exhausted = {}
+        with self.store.transaction(write=False) as conn:
+            day = self.store.get_day(conn) or self.usage_date.isoformat()
+            counts = dict(conn.execute("SELECT api_key, count FROM key_counts"))
+            for api_key, model, count in conn.execute("SELECT api_key, model, count FROM model_counts"):
+                model_counts.setdefault(api_key, {})[model] = count
+            for api_key, model in conn.execute("SELECT api_key, model FROM exhausted"):
+                exhausted.setdefault(api_key, []).append(model)
+        return {"date": day, "counts": counts, "model_counts": model_counts, "exhausted_keys": exhausted}
+
 def load_usage_data(filename=USAGE_DATA_FILE):
-    """Loads usage data (counts, model counts, and exhausted keys) from the specified file for today's date."""
-    global key_usage_counts, model_usage_counts, current_usage_date, exhausted_keys_today
-    today_str = date.today().isoformat()
-    current_usage_date = date.today() # Ensure current_usage_date is set
+    """
+    Loads usage data (counts, model counts, and exhausted keys) from the specified file for today's date
+    and imports it into `usage_state`.
+    """
+    today_str = current_usage_day().isoformat()
+    key_usage_counts, model_usage_counts, exhausted_keys_today = {}, {}, {}
 
     script_dir = os.path.dirname(__file__) if '__file__' in globals() else '.'
     filepath = os.path.join(script_dir, filename)
@@ -145,32 +1030,146 @@ def load_usage_data(filename=USAGE_DATA_FILE):
         model_usage_counts = {}
         exhausted_keys_today = {}
 
-def save_usage_data(filename=USAGE_DATA_FILE):
-    """Saves the current usage data (date, counts, model counts, exhausted keys) to the specified file."""
-    global key_usage_counts, model_usage_counts, current_usage_date, exhausted_keys_today
-    today_str = current_usage_date.isoformat() # Use the tracked date
-    
-    # Convert sets in exhausted_keys_today to lists for JSON serialization
-    serializable_exhausted_keys = {
-        key: list(models) for key, models in exhausted_keys_today.items()
-    }
-    
-    data_to_save = {
-        "date": today_str,
-        "counts": key_usage_counts,
-        "model_counts": model_usage_counts, # Save model counts
-        "exhausted_keys": serializable_exhausted_keys # Save new format
-    }
+    usage_state.import_data(current_usage_day(), key_usage_counts, model_usage_counts, exhausted_keys_today)
 
+_usage_file_lock = threading.Lock()
+
+def save_usage_data(filename=USAGE_DATA_FILE):
+    """
+    Saves the current usage data (date, counts, model counts, exhausted keys) to the specified file.
+    The file is replaced atomically (temporary file + fsync + rename) so a crash never leaves it truncated.
+    Each save uses its own temporary file, so worker processes exporting at the same time don't clash.
+    """
+    data_to_save = usage_state.snapshot()
     script_dir = os.path.dirname(__file__) if '__file__' in globals() else '.'
     filepath = os.path.join(script_dir, filename)
+    serialized = json.dumps(data_to_save, indent=4)
+
+    with _usage_file_lock:
+        tmp_path = None
+        try:
+            directory = os.path.dirname(os.path.abspath(filepath))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f"{os.path.basename(filepath)}.", suffix=".tmp")
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(serialized)
+                f.flush()
+                os.fsync(f.fileno())
+            try:
+                # mkstemp creates the file readable by its owner only; keep the permissions of the file it replaces
+                os.chmod(tmp_path, os.stat(filepath).st_mode & 0o777)
+            except OSError:
+                os.chmod(tmp_path, 0o644)
+            try:
+                os.replace(tmp_path, filepath)
+                tmp_path = None
+            except OSError as e:
+                # A file bind-mounted into a container (docker -v ./key_usage.txt:...) cannot be
+                # replaced by rename; fall back to rewriting it in place.
+                logging.debug(f"Atomic rename of usage data failed ({e}); rewriting {filepath} in place.")
+                with open(filepath, 'w', encoding='utf-8') as f:
+                    f.write(serialized)
+                    f.flush()
+                    os.fsync(f.fileno())
+            else:
+                _fsync_directory(directory)
+            logging.debug(f"Successfully saved usage data for {data_to_save['date']} to {filepath}. Counts: {data_to_save['counts']}")
+        except Exception as e:
+            logging.error(f"An error occurred while saving usage data to {filepath}: {e}", exc_info=True)
+        finally:
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
 
+def _fsync_directory(directory):
+    """Makes a rename durable by syncing its directory (not supported on Windows)."""
     try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data_to_save, f, indent=4)
-        logging.debug(f"Successfully saved usage data for {today_str} to {filepath}. Counts: {key_usage_counts}")
-    except Exception as e:
-        logging.error(f"An error occurred while saving usage data to {filepath}: {e}", exc_info=True)
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+class UsagePersister:
+    """
+    Write-behind persistence for usage data. Request handlers only call mark_dirty(); a
+    background thread writes the data with save_usage_data() every USAGE_FLUSH_INTERVAL
+    seconds or as soon as USAGE_FLUSH_BATCH_SIZE changes have accumulated, and once more
+    on shutdown. Request latency therefore no longer depends on the size of the data.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pending_changes = 0
+        self._flush_requested = False
+        self._stopping = False
+        self._thread = None
+        self._owner_pid = None
+        self._atexit_registered = False
+
+    def _ensure_started(self):
+        # Threads do not survive fork(), so each worker process starts its own writer
+        if self._thread is not None and self._owner_pid == os.getpid():
+            return
+        self._owner_pid = os.getpid()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="usage-persister", daemon=True)
+        self._thread.start()
+        if not self._atexit_registered:
+            atexit.register(self.stop)
+            self._atexit_registered = True
+
+    def mark_dirty(self, flush_now=False):
+        """Records a change. flush_now requests an immediate write (e.g. at day rollover)."""
+        with self._condition:
+            self._ensure_started()
+            self._pending_changes += 1
+            if flush_now or self._pending_changes >= USAGE_FLUSH_BATCH_SIZE:
+                self._flush_requested = True
+                self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._flush_requested or self._stopping, timeout=USAGE_FLUSH_INTERVAL)
+                pending_changes = self._pending_changes
+                stopping = self._stopping
+                self._pending_changes = 0
+                self._flush_requested = False
+            if pending_changes:
+                save_usage_data()
+                logging.debug(f"Usage data flushed ({pending_changes} changes written in one save).")
+            if stopping:
+                return
+
+    def flush(self):
+        """Writes pending changes synchronously."""
+        with self._condition:
+            pending_changes = self._pending_changes
+            self._pending_changes = 0
+            self._flush_requested = False
+        if pending_changes:
+            save_usage_data()
+
+    def stop(self):
+        """Stops the background writer and flushes everything still pending."""
+        with self._condition:
+            thread = self._thread
+            if thread is None or self._owner_pid != os.getpid():
+                return
+            self._stopping = True
+            self._condition.notify()
+        thread.join(timeout=10)
+        self._thread = None
+        self.flush()
+        logging.info("Usage data flushed on shutdown.")
+
+usage_persister = UsagePersister()
 
 # --- API Key Loading ---
 def load_api_keys(filename):
@@ -210,622 +1209,5826 @@ def load_api_keys(filename):
         logging.error(f"An error occurred while loading API keys from {filepath}: {e}", exc_info=True)
         return None
 
-# --- Helper Functions ---
-
-def is_openai_chat_request(path):
-    """Checks if the request path matches the OpenAI chat completions endpoint."""
-    return path.strip('/') == "v1/chat/completions"
+# --- Key Rotation and Usage Accounting ---
+# Shared by the sync (Flask) and async (ASGI) engines so both apply the same rules.
+class _KeyRotation:
+    """Usable keys of one model, as a rotating queue, with the lock that guards them."""
+    __slots__ = ("lock", "keys")
 
-def convert_openai_to_gemini_request(openai_data):
-    """Converts OpenAI request JSON to Gemini request JSON."""
-    gemini_request = {"contents": [], "generationConfig": {}, "safetySettings": []}
-    target_model = "gemini-pro" # Default model, can be overridden
+    def __init__(self, keys):
+        self.lock = threading.Lock()
+        self.keys = OrderedDict((key, None) for key in keys)
 
-    # --- Model Mapping (Simple: Use OpenAI model name directly for now) ---
-    # A more robust solution might involve explicit mapping or configuration
-    if "model" in openai_data:
-        # Assuming the model name provided is Gemini-compatible
-        # Remove potential prefix like "openai/" if present
-        target_model = openai_data["model"].split('/')[-1]
-        logging.debug(f"Using model from OpenAI request: {target_model}")
-        # We won't put the model in the Gemini request body, it's part of the URL
+class KeyPool:
+    """
+    Per-model rotation of the keys that are still usable today.
 
-    # --- Message Conversion ---
-    system_prompt = None
-    gemini_contents = []
-    for message in openai_data.get("messages", []):
-        role = message.get("role")
-        content = message.get("content")
+    Each model gets its own OrderedDict of usable keys, used as a rotating queue. So
+    "next usable key", "mark exhausted" and "all exhausted?" are O(1) no matter how many
+    keys are loaded. Exhausted keys are removed from a model's rotation instead of being
+    skipped on every pass. A model's rotation is built lazily the first time the model is
+    requested, from the key list minus the keys already exhausted for it. Every rotation
+    has its own lock, so requests for different models never contend.
+    """
 
-        if not content: # Skip messages without content
-             continue
+    def __init__(self, keys, exhausted=None):
+        self._keys = list(keys)
+        self._lock = threading.Lock() # Guards creating rotations and self._exhausted
+        self._rotations = {} # {model: _KeyRotation} of keys still usable today
+        self._exhausted = {} # {api_key: {model1, model2}} snapshot used to build new rotations
+        self.reset(exhausted)
 
-        # Handle system prompt separately
-        if role == "system":
-            if isinstance(content, str):
-                 system_prompt = {"role": "system", "parts": [{"text": content}]}
-            # Note: Gemini API might prefer system prompt at the start or via specific field
-            continue # Don't add system prompt directly to contents here
+    def __len__(self):
+        return len(self._keys)
 
-        # Map roles
-        gemini_role = "user" if role == "user" else "model" # Treat 'assistant' as 'model'
+    def reset(self, exhausted=None):
+        """Drops all rotations, e.g. on a new day; `exhausted` seeds today's exhausted keys."""
+        with self._lock:
+            self._rotations = {}
+            self._exhausted = {key: set(models) for key, models in (exhausted or {}).items()}
 
-        # Ensure content is in the correct parts format
-        if isinstance(content, str):
-            # Simple string content
-            gemini_contents.append({"role": gemini_role, "parts": [{"text": content}]})
-        elif isinstance(content, list):
-            # Handle list of parts (like from multimodal requests or specific clients)
-            combined_text = ""
-            # TODO: Handle non-text parts if necessary (e.g., images)
-            for part in content:
-                if isinstance(part, dict) and part.get("type") == "text":
-                    combined_text += part.get("text", "")
-            if combined_text: # Only add if we extracted some text
-                 gemini_contents.append({"role": gemini_role, "parts": [{"text": combined_text}]})
-            else:
-                 logging.warning(f"Message with role '{role}' had list content, but no text parts found: {content}")
-        else:
-             logging.warning(f"Unsupported content type for role '{role}': {type(content)}")
+    def _rotation(self, model):
+        rotation = self._rotations.get(model)
+        if rotation is None:
+            with self._lock:
+                rotation = self._rotations.get(model) # Another thread may have built it meanwhile
+                if rotation is None:
+                    rotation = _KeyRotation(
+                        key for key in self._keys
+                        if model not in self._exhausted.get(key, ())
+                    )
+                    self._rotations[model] = rotation
+        return rotation
 
-    # Add system prompt if found (Gemini prefers it at the start or via systemInstruction)
-    # Let's try adding it via systemInstruction if present
-    if system_prompt:
-         gemini_request["systemInstruction"] = system_prompt
-         # Alternatively, prepend to contents: gemini_contents.insert(0, system_prompt)
+    def next_key(self, model):
+        """Returns the next usable key for `model` and rotates it to the back, or None if none is left."""
+        rotation = self._rotation(model)
+        with rotation.lock:
+            if not rotation.keys:
+                return None
+            key = next(iter(rotation.keys))
+            rotation.keys.move_to_end(key)
+            return key
 
-    gemini_request["contents"] = gemini_contents
+    def mark_exhausted(self, api_key, model):
+        """Removes `api_key` from the rotation of `model`. Returns True if no usable key is left for it."""
+        with self._lock:
+            self._exhausted.setdefault(api_key, set()).add(model)
+        rotation = self._rotation(model)
+        with rotation.lock:
+            rotation.keys.pop(api_key, None)
+            return not rotation.keys
 
+    def all_exhausted(self, model):
+        """Returns True if every key is exhausted for `model` today."""
+        return not self._rotation(model).keys
 
-    # --- Generation Config Mapping ---
-    if "temperature" in openai_data:
-        gemini_request["generationConfig"]["temperature"] = openai_data["temperature"]
-    if "max_tokens" in openai_data:
-        gemini_request["generationConfig"]["maxOutputTokens"] = openai_data["max_tokens"]
-    if "stop" in openai_data:
-        # Gemini expects `stopSequences` which is an array of strings
-        stop_sequences = openai_data["stop"]
-        if isinstance(stop_sequences, str):
-            gemini_request["generationConfig"]["stopSequences"] = [stop_sequences]
-        elif isinstance(stop_sequences, list):
-            gemini_request["generationConfig"]["stopSequences"] = stop_sequences
-    # Add other mappings as needed (topP, topK etc.)
-    if "top_p" in openai_data:
-         gemini_request["generationConfig"]["topP"] = openai_data["top_p"]
-    # if "top_k" in openai_data: gemini_request["generationConfig"]["topK"] = openai_data["top_k"] # Map if needed
+    def usable_count(self, model):
+        """Number of keys still usable for `model` today."""
+        return len(self._rotation(model).keys)
 
-    # --- Safety Settings (Optional: Default to BLOCK_NONE for compatibility) ---
-    # You might want to make this configurable or map from OpenAI safety params if they existed
-    gemini_request["safetySettings"] = [
-        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-    ]
+    def usable_keys(self, model):
+        """Returns the keys still usable for `model` today, in rotation order."""
+        rotation = self._rotation(model)
+        with rotation.lock:
+            return list(rotation.keys)
 
-    # --- Streaming ---
-    # The actual Gemini endpoint URL will determine streaming, not a body parameter
-    is_streaming = openai_data.get("stream", False)
+    def is_usable(self, api_key, model):
+        """Returns True if `api_key` is in the rotation of `model` (not exhausted or suspended)."""
+        return api_key in self._rotation(model).keys
 
-    return gemini_request, target_model, is_streaming
+    def suspend(self, api_key, model, until=None):
+        """Takes `api_key` out of the rotation of `model` without marking it exhausted (see restore())."""
+        rotation = self._rotation(model)
+        with rotation.lock:
+            rotation.keys.pop(api_key, None)
 
-# --- Flask Application ---
-app = Flask(__name__)
+    def restore(self, api_key, model):
+        """Puts a suspended key back at the end of the rotation of `model`, unless it was exhausted meanwhile."""
+        with self._lock:
+            if api_key not in self._keys or model in self._exhausted.get(api_key, ()):
+                return
+        rotation = self._rotation(model)
+        with rotation.lock:
+            rotation.keys[api_key] = None
 
-@app.route('/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'OPTIONS'])
-def proxy(path):
+class SQLiteKeyPool:
     """
-    Handles incoming requests, validates placeholder token, selects an available API key
-    (skipping exhausted ones), tracks usage, handles 429 errors by marking keys
-    as exhausted for the day, forwards the request (potentially converting formats),
-    and returns the response (potentially converting formats).
+    KeyPool backed by a SQLiteStateStore, so all worker processes share one rotation per
+    model and skip keys another worker has seen return 429. Each model's rotation is a
+    table of usable keys ordered by `seq`. Taking the head and moving it to the back, or
+    deleting an exhausted key, uses the (model, seq) index and stays cheap for any number
+    of keys.
+
+    A suspended key stays in the table with its cooldown deadline and is skipped until the
+    deadline passes. So a key whose worker dies during the cooldown is not lost: any worker
+    uses it again once the deadline has passed, even if restore() never runs.
     """
-    global key_cycler, key_usage_counts, model_usage_counts, current_usage_date, exhausted_keys_today, all_api_keys
 
-    request_start_time = time.time()
-    original_request_path = path
-    is_openai_format = is_openai_chat_request(original_request_path)
-    logging.info(f"Request received for path: {original_request_path}. OpenAI format detected: {is_openai_format}")
+    def __init__(self, store, keys):
+        self.store = store
+        self._keys = list(keys)
 
-    # --- Daily Usage Reset Check ---
-    today = date.today()
-    if today != current_usage_date:
-        logging.info(f"Date changed from {current_usage_date} to {today}. Resetting daily usage counts, model counts, and exhausted keys list.")
-        current_usage_date = today
-        key_usage_counts = {}
-        model_usage_counts = {} # Reset model counts as well
-        exhausted_keys_today = {} # Reset exhausted keys (new dict format)
-        save_usage_data() # Save the reset state
+    def __len__(self):
+        return len(self._keys)
 
-    # Ensure keys were loaded and the cycler is available
-    if not all_api_keys or key_cycler is None: # Check all_api_keys as well
-        logging.error("API keys not loaded or cycler not initialized. Cannot process request.")
-        return Response("Proxy server error: API keys not loaded.", status=503, mimetype='text/plain') # Service Unavailable
+    def reset(self, exhausted=None):
+        """Drops all rotations (exhausted marks live in the shared usage state)."""
+        with self.store.transaction() as conn:
+            conn.execute("DELETE FROM rotation")
+            conn.execute("DELETE FROM rotation_models")
 
-    # --- Request Body Handling & Potential Conversion ---
-    request_data_bytes = request.get_data()
-    gemini_request_body_json = None
-    target_gemini_model = None
-    use_stream_endpoint = False
-    target_path = path # Default to original path
+    def _ensure_rotation(self, conn, model):
+        # Caller holds a write transaction
+        if conn.execute("SELECT 1 FROM rotation_models WHERE model = ?", (model,)).fetchone():
+            return
+        exhausted_keys = {row[0] for row in conn.execute("SELECT api_key FROM exhausted WHERE model = ?", (model,))}
+        conn.executemany(
+            "INSERT OR IGNORE INTO rotation (model, api_key, seq) VALUES (?, ?, ?)",
+            [(model, key, seq) for seq, key in enumerate(self._keys) if key not in exhausted_keys])
+        conn.execute("INSERT INTO rotation_models (model) VALUES (?)", (model,))
 
-    if is_openai_format:
-        if request.method != 'POST':
-             return Response("OpenAI compatible endpoint only supports POST.", status=405, mimetype='text/plain')
-        try:
-            openai_request_data = json.loads(request_data_bytes)
-            logging.debug(f"Original OpenAI request data: {openai_request_data}")
-            gemini_request_body_json, target_gemini_model, use_stream_endpoint = convert_openai_to_gemini_request(openai_request_data)
-            logging.debug(f"Converted Gemini request data: {gemini_request_body_json}")
-            logging.info(f"OpenAI request mapped to Gemini model: {target_gemini_model}, Streaming: {use_stream_endpoint}")
+    def next_key(self, model):
+        """Returns the next usable key for `model` and rotates it to the back, or None if none is left."""
+        with self.store.transaction() as conn:
+            self._ensure_rotation(conn, model)
+            row = conn.execute(
+                "SELECT api_key, (SELECT MAX(seq) FROM rotation WHERE model = ?) FROM rotation "
+                "WHERE model = ? AND cooldown_until <= ? ORDER BY seq LIMIT 1", (model, model, time.time())).fetchone()
+            if row is None:
+                return None
+            key, last_seq = row
+            conn.execute("UPDATE rotation SET seq = ?, cooldown_until = 0 WHERE model = ? AND api_key = ?",
+                         (last_seq + 1, model, key))
+            return key
 
-            # Determine target Gemini endpoint
-            action = "streamGenerateContent" if use_stream_endpoint else "generateContent"
-            # Construct the Gemini API path using the extracted/defaulted model
-            target_path = f"v1beta/models/{target_gemini_model}:{action}"
+    def mark_exhausted(self, api_key, model):
+        """Removes `api_key` from the rotation of `model`. Returns True if no usable key is left for it."""
+        with self.store.transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO exhausted (api_key, model) VALUES (?, ?)", (api_key, model))
+            self._ensure_rotation(conn, model)
+            conn.execute("DELETE FROM rotation WHERE model = ? AND api_key = ?", (model, api_key))
+            return conn.execute("SELECT 1 FROM rotation WHERE model = ? AND cooldown_until <= ? LIMIT 1",
+                                (model, time.time())).fetchone() is None
 
-        except json.JSONDecodeError:
-            logging.error("Failed to decode OpenAI request body as JSON.")
-            return Response("Invalid JSON in request body.", status=400, mimetype='text/plain')
-        except Exception as e:
-            logging.error(f"Error during OpenAI request conversion: {e}", exc_info=True)
-            return Response("Error processing OpenAI request.", status=500, mimetype='text/plain')
-    else:
-        # Assume it's a direct Gemini request, pass body through (if method allows)
-        if request_data_bytes and request.method in ['POST', 'PUT', 'PATCH']:
-             # We don't strictly need to parse it here, but might be useful for logging
-             try:
-                  gemini_request_body_json = json.loads(request_data_bytes)
-                  logging.debug(f"Direct Gemini request data: {gemini_request_body_json}")
-             except json.JSONDecodeError:
-                  logging.warning("Could not parse direct Gemini request body as JSON for logging.")
-                  # Send bytes directly if not JSON? Or assume JSON? Let's assume JSON for now.
-                  # If non-JSON needed, this needs adjustment.
-        target_path = path # Use original path for direct Gemini requests
+    def all_exhausted(self, model):
+        """Returns True if every key is exhausted for `model` today."""
+        with self.store.transaction(write=False) as conn:
+            built = conn.execute("SELECT 1 FROM rotation_models WHERE model = ?", (model,)).fetchone()
+            if built:
+                return conn.execute("SELECT 1 FROM rotation WHERE model = ? AND cooldown_until <= ? LIMIT 1",
+                                    (model, time.time())).fetchone() is None
+            exhausted_count = conn.execute(
+                "SELECT COUNT(*) FROM exhausted WHERE model = ?", (model,)).fetchone()[0]
+        return exhausted_count >= len(self._keys) # Rotation not built yet
 
+    def usable_count(self, model):
+        """Number of keys still usable for `model` today."""
+        with self.store.transaction(write=False) as conn:
+            built = conn.execute("SELECT 1 FROM rotation_models WHERE model = ?", (model,)).fetchone()
+            if built:
+                return conn.execute("SELECT COUNT(*) FROM rotation WHERE model = ? AND cooldown_until <= ?",
+                                    (model, time.time())).fetchone()[0]
+            exhausted_count = conn.execute(
+                "SELECT COUNT(*) FROM exhausted WHERE model = ?", (model,)).fetchone()[0]
+        return max(0, len(self._keys) - exhausted_count) # Rotation not built yet
 
-    # Construct the target URL for the actual Google API
-    target_url = f"{GEMINI_API_BASE_URL}/{target_path}"
-    logging.debug(f"Target Gemini URL: {target_url}")
+    def usable_keys(self, model):
+        """Returns the keys still usable for `model` today, in rotation order."""
+        with self.store.transaction() as conn:
+            self._ensure_rotation(conn, model)
+            return [row[0] for row in conn.execute(
+                "SELECT api_key FROM rotation WHERE model = ? AND cooldown_until <= ? ORDER BY seq", (model, time.time()))]
 
-    # Get query parameters (passed through but not used for key auth)
-    query_params = request.args.to_dict()
-    logging.debug(f"Incoming query parameters: {query_params}")
+    def is_usable(self, api_key, model):
+        """Returns True if `api_key` is in the rotation of `model` (not exhausted or suspended)."""
+        with self.store.transaction(write=False) as conn:
+            if conn.execute("SELECT 1 FROM rotation_models WHERE model = ?", (model,)).fetchone():
+                return conn.execute(
+                    "SELECT 1 FROM rotation WHERE model = ? AND api_key = ? AND cooldown_until <= ?",
+                    (model, api_key, time.time())).fetchone() is not None
+            exhausted = conn.execute(
+                "SELECT 1 FROM exhausted WHERE api_key = ? AND model = ?", (api_key, model)).fetchone()
+        return api_key in self._keys and exhausted is None # Rotation not built yet
 
-    # Prepare headers for the outgoing request
-    # Copy headers from incoming request, excluding 'Host'
-    # Use lowercase keys for case-insensitive lookup
-    incoming_headers = {key.lower(): value for key, value in request.headers.items() if key.lower() != 'host'}
-    logging.debug(f"Incoming headers (excluding Host): {incoming_headers}")
+    def suspend(self, api_key, model, until=None):
+        """
+        Skips `api_key` in the rotation of `model` until `until` (time.time()) without marking it
+        exhausted; restore() ends the suspension early. Without `until` it lasts until restore().
+        """
+        with self.store.transaction() as conn:
+            self._ensure_rotation(conn, model)
+            conn.execute("UPDATE rotation SET cooldown_until = ? WHERE model = ? AND api_key = ?",
+                         (until if until is not None else float("inf"), model, api_key))
 
-    # Start with a copy of incoming headers for the outgoing request
-    outgoing_headers = incoming_headers.copy()
-    auth_header_openai = 'authorization' # Define variable *before* use
+    def restore(self, api_key, model):
+        """Puts a suspended key back at the end of the rotation of `model`, unless it was exhausted meanwhile."""
+        with self.store.transaction() as conn:
+            if conn.execute("SELECT 1 FROM exhausted WHERE api_key = ? AND model = ?", (api_key, model)).fetchone():
+                return
+            self._ensure_rotation(conn, model)
+            conn.execute(
+                "INSERT OR REPLACE INTO rotation (model, api_key, seq, cooldown_until) "
+                "SELECT ?, ?, COALESCE(MAX(seq), 0) + 1, 0 FROM rotation WHERE model = ?", (model, api_key, model))
 
-    # If the original request was OpenAI format, remove the Authorization header
-    # as we will use x-goog-api-key for the upstream request.
-    if is_openai_format and auth_header_openai in outgoing_headers:
-        del outgoing_headers[auth_header_openai]
-        logging.debug(f"Removed '{auth_header_openai}' header before forwarding.")
+def check_daily_reset():
+    """Resets usage counts and exhausted keys when the date has changed."""
+    # Only the thread that performs the rollover resets the key pool and saves
+    if usage_state.rollover_if_needed():
+        if key_pool is not None:
+            key_pool.reset() # Every key is usable again for every model
+        usage_persister.mark_dirty(flush_now=True) # Write the fresh, compact state right away
+    # Pacing buckets live in each process: every worker starts fresh daily request budgets,
+    # not only the one that performed the (shared) rollover
+    rate_pacer.start_day(usage_state.usage_date)
 
-    api_key_header_gemini = 'x-goog-api-key'
-    # auth_header_openai = 'authorization' # Definition moved up
-    next_key = None
+def all_keys_exhausted_for_model(model):
+    """Returns True if every loaded key is marked exhausted for `model` today."""
+    return key_pool.all_exhausted(model)
+
+class _KeyStat:
+    __slots__ = ("latency", "error_rate", "in_flight")
+
+    def __init__(self):
+        self.latency = None # EWMA of seconds until the response headers arrived (None: no sample yet)
+        self.error_rate = 0.0 # EWMA of 1 for a 429, 5xx or connection error, 0 otherwise
+        self.in_flight = 0 # Attempts waiting for their response headers
+
+class KeyStats:
+    """
+    Recent health of every key per model, for the key selection strategies: averages of the
+    upstream latency and error rate, and the attempts in flight. Updating them costs one
+    dict lookup and a few float operations per attempt.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {} # {(api_key, model): _KeyStat}
+
+    def _stat(self, api_key, model):
+        stat = self._stats.get((api_key, model))
+        if stat is None:
+            stat = self._stats.setdefault((api_key, model), _KeyStat())
+        return stat
+
+    def start(self, api_key, model):
+        """Called when an attempt is sent with `api_key`."""
+        stat = self._stat(api_key, model)
+        with self._lock:
+            stat.in_flight += 1
+
+    def finish(self, api_key, model, latency, error):
+        """Called when the attempt was answered (`latency` in seconds) or failed (`latency` None)."""
+        stat = self._stat(api_key, model)
+        alpha = KEY_STATS_EWMA_ALPHA
+        with self._lock:
+            stat.in_flight = max(0, stat.in_flight - 1)
+            stat.error_rate += alpha * ((1.0 if error else 0.0) - stat.error_rate)
+            # Errors (e.g. a 429) come back fast and would make a failing key look fast
+            if latency is not None and not error:
+                stat.latency = latency if stat.latency is None else stat.latency + alpha * (latency - stat.latency)
+
+    def in_flight(self, api_key, model):
+        stat = self._stats.get((api_key, model))
+        return stat.in_flight if stat else 0
+
+    def expected_latency(self, api_key, model):
+        """Seconds a new attempt with `api_key` is expected to take; 0 for keys without samples, so they get tried."""
+        stat = self._stats.get((api_key, model))
+        if stat is None:
+            return 0.0
+        latency = stat.latency or 0.0
+        return (latency + stat.error_rate * KEY_SELECTION_ERROR_PENALTY) * (stat.in_flight + 1)
+
+    def snapshot(self):
+        """Returns {(api_key, model): (latency EWMA, error rate EWMA, in flight)}."""
+        with self._lock:
+            return {item: (stat.latency, stat.error_rate, stat.in_flight) for item, stat in self._stats.items()}
+
+key_stats = KeyStats()
+
+class RoundRobinStrategy:
+    """The usable keys take turns, in the order of the key pool's rotation."""
+
+    def next_key(self, model, exclude):
+        return key_pool.next_key(model) # `exclude` is checked by KeyCandidates
+
+class _UsageIndex:
+    """Heap of (requests today + attempts in flight, random tie-breaker, api_key) of one model's usable keys."""
+    __slots__ = ("lock", "heap", "usage_date", "built_at")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []
+        self.usage_date = None
+        self.built_at = 0.0
+
+class LeastUsedStrategy:
+    """
+    Picks the usable key with the fewest requests for the model today (attempts in flight included).
+
+    Each model has a min-heap of its usable keys by usage, so a pick pops a few entries instead
+    of scanning every key. Entries are checked when they reach the top: a key that is no longer
+    usable is dropped, and a key whose usage grew meanwhile (e.g. through another worker) is
+    pushed back with its current usage. The heap is rebuilt from the key pool on a new day, when
+    it runs empty, and every KEY_SELECTION_INDEX_REFRESH_SECONDS to pick up restored keys.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._indexes = {} # {model: _UsageIndex}
+
+    def _current_usage(self, api_key, model):
+        return usage_state.model_count(api_key, model) + key_stats.in_flight(api_key, model)
+
+    def _rebuild(self, index, model):
+        # Caller holds index.lock
+        counts = usage_state.model_counts_for(model)
+        # The random tie-breaker keeps ties (e.g. every key unused in the morning) from all going to one key
+        index.heap = [(counts.get(key, 0) + key_stats.in_flight(key, model), random.random(), key)
+                      for key in key_pool.usable_keys(model)]
+        heapq.heapify(index.heap)
+        index.usage_date = usage_state.usage_date
+        index.built_at = time.monotonic()
+
+    def _pop_least_used(self, index, model, exclude):
+        # Caller holds index.lock
+        skipped = [] # Excluded keys, pushed back after the pick
+        chosen_key = None
+        while index.heap:
+            used, tie, key = heapq.heappop(index.heap)
+            if key in exclude:
+                skipped.append((used, tie, key))
+                continue
+            if not key_pool.is_usable(key, model): # Exhausted or cooling down; a rebuild brings it back if restored
+                continue
+            current = self._current_usage(key, model)
+            if current > used: # Stale entry: try again with its current usage
+                heapq.heappush(index.heap, (current, tie, key))
+                continue
+            chosen_key = key
+            heapq.heappush(index.heap, (current + 1, tie, key)) # Counts the attempt about to be sent
+            break
+        for entry in skipped:
+            heapq.heappush(index.heap, entry)
+        return chosen_key
+
+    def next_key(self, model, exclude):
+        index = self._indexes.get(model)
+        if index is None:
+            with self._lock:
+                index = self._indexes.setdefault(model, _UsageIndex())
+        with index.lock:
+            rebuilt = False
+            if index.usage_date != usage_state.usage_date or time.monotonic() - index.built_at > KEY_SELECTION_INDEX_REFRESH_SECONDS:
+                self._rebuild(index, model)
+                rebuilt = True
+            chosen_key = self._pop_least_used(index, model, exclude)
+            if chosen_key is None and not index.heap and not rebuilt: # Ran empty: restored keys may be missing
+                self._rebuild(index, model)
+                chosen_key = self._pop_least_used(index, model, exclude)
+            return chosen_key
+
+class PowerOfTwoEWMAStrategy:
+    """
+    Power of two choices: of the next two usable keys in the key pool's rotation, picks the
+    one with the lower expected latency (EWMA latency plus an error rate penalty, scaled by
+    the attempts in flight). Taking the pair from the rotation costs two next_key() calls of
+    the pool (plus one per excluded key drawn), and comparing just two keys avoids sending
+    every request to the single key that looks best right now.
+    """
+
+    def next_key(self, model, exclude):
+        picks = []
+        # Each excluded key can be drawn at most once before two others come up
+        for _ in range(len(exclude) + 2):
+            key = key_pool.next_key(model)
+            if key is None or key in picks: # None left, or the rotation wrapped around
+                break
+            if key in exclude:
+                continue
+            picks.append(key)
+            if len(picks) == 2:
+                break
+        if len(picks) <= 1:
+            return picks[0] if picks else None
+        random.shuffle(picks) # Ties (e.g. keys without samples yet) go to either key, not always the first drawn
+        first, second = picks
+        if key_stats.expected_latency(second, model) < key_stats.expected_latency(first, model):
+            return second
+        return first
+
+# Key selection strategies by KEY_SELECTION_STRATEGY name. Another strategy can be plugged in
+# by adding a class with a next_key(model, exclude) method that returns a usable key for
+# `model` that is not in `exclude`, or None if there is none.
+KEY_SELECTION_STRATEGIES = {
+    "round_robin": RoundRobinStrategy,
+    "least_used": LeastUsedStrategy,
+    "p2c_ewma": PowerOfTwoEWMAStrategy,
+}
+_key_strategy = None
+
+def get_key_strategy():
+    """Returns the configured key selection strategy (read at call time so it can be reconfigured)."""
+    global _key_strategy
+    name = KEY_SELECTION_STRATEGY
+    if name not in KEY_SELECTION_STRATEGIES:
+        logging.warning(f"Unknown KEY_SELECTION_STRATEGY '{name}', using 'round_robin'.")
+        name = "round_robin"
+    if _key_strategy is None or _key_strategy[0] != name:
+        _key_strategy = (name, KEY_SELECTION_STRATEGIES[name]())
+    return _key_strategy[1]
+
+class KeyCandidates:
+    """
+    Iterates the keys to try for one request, in order. Exhausted keys are never returned,
+    and each key is tried at most once per request. Keys are chosen by the configured
+    KEY_SELECTION_STRATEGY.
+
+    When MODEL_RATE_LIMITS has limits for the model, up to RATE_PACING_CANDIDATES keys are
+    taken from the rotation at a time. Keys over their local budget are skipped, and the
+    key with the most headroom is used. If every key is over budget, iteration ends and
+    `retry_after` holds the seconds until the earliest key has budget again.
+
+    `preferred_keys` (e.g. the keys holding a context cache of the request's prompt) are
+    tried first, as long as they are usable and within their local limits. Keys whose circuit
+    breaker is open are skipped.
+    """
+
+    def __init__(self, model, estimated_tokens=0, preferred_keys=()):
+        self.model = model
+        self.estimated_tokens = estimated_tokens
+        self.preferred_keys = preferred_keys
+        self.retry_after = None # Set when the local rate limits left no usable key
+
+    def __iter__(self):
+        model = self.model
+        paced = rate_pacer.limits_for(model) is not None
+        strategy = get_key_strategy()
+        tried_keys = set()
+        if self.preferred_keys:
+            usable_keys = set(key_pool.usable_keys(model))
+            for api_key in self.preferred_keys:
+                if api_key not in usable_keys or api_key in tried_keys or circuit_breakers.blocked(api_key):
+                    continue
+                if paced:
+                    chosen_key, _, daily_limit_keys, _ = rate_pacer.choose([api_key], model, self.estimated_tokens)
+                    if daily_limit_keys:
+                        mark_key_exhausted(api_key, model, reason="reached its local daily request limit (RPD)")
+                    if chosen_key is None:
+                        continue
+                tried_keys.add(api_key)
+                if circuit_breakers.allow(api_key):
+                    yield api_key
+        for _ in range(len(key_pool)):
+            if len(tried_keys) >= len(key_pool):
+                return
+            if not paced:
+                next_key = strategy.next_key(model, tried_keys)
+                if next_key is None: # Every key is exhausted for this model
+                    return
+                if next_key in tried_keys: # Concurrent requests moved the rotation back to a key we already tried
+                    continue
+                tried_keys.add(next_key)
+                if circuit_breakers.allow(next_key):
+                    yield next_key
+                continue
+
+            candidates = []
+            excluded = set(tried_keys)
+            for _ in range(min(RATE_PACING_CANDIDATES, len(key_pool))):
+                next_key = strategy.next_key(model, excluded)
+                if next_key is None:
+                    break
+                if next_key not in excluded:
+                    excluded.add(next_key)
+                    if circuit_breakers.blocked(next_key):
+                        tried_keys.add(next_key)
+                    else:
+                        candidates.append(next_key)
+            if not candidates:
+                if len(tried_keys) < len(key_pool) and next_key is not None:
+                    continue # Only keys with open circuit breakers were drawn
+                return
+            chosen_key, over_budget_keys, daily_limit_keys, wait_seconds = rate_pacer.choose(candidates, model, self.estimated_tokens)
+            for api_key in daily_limit_keys: # No budget left today; take it out of the rotation
+                mark_key_exhausted(api_key, model, reason="reached its local daily request limit (RPD)")
+            tried_keys.update(over_budget_keys)
+            tried_keys.update(daily_limit_keys)
+            if chosen_key is None:
+                if wait_seconds is not None:
+                    self.retry_after = wait_seconds if self.retry_after is None else min(self.retry_after, wait_seconds)
+                continue
+            self.retry_after = None
+            tried_keys.add(chosen_key)
+            if circuit_breakers.allow(chosen_key):
+                yield chosen_key
+
+def mark_key_exhausted(api_key, model, reason=None):
+    """
+    Marks `model` as exhausted for `api_key` today, after a daily-quota 429 or for `reason`.
+    Returns True if all keys are now exhausted for it.
+    """
+    if reason is None:
+        logging.warning(f"Key ending ...{api_key[-4:]} hit its daily quota (429) for model '{model}'. Marking this model as exhausted for this key today.")
+    else:
+        logging.warning(f"Key ending ...{api_key[-4:]} {reason} for model '{model}'. Marking this model as exhausted for this key today.")
+    usage_state.mark_exhausted(api_key, model)
+    usage_persister.mark_dirty() # Persisted by the background writer
+    # Check if all keys are now exhausted for this specific model after this failure
+    if key_pool.mark_exhausted(api_key, model):
+        logging.warning(f"All API keys are now exhausted for model '{model}' after 429 error. Last key tried: ...{api_key[-4:]}")
+        return True
+    return False
+
+def record_key_usage(api_key, model):
+    """Increments the total and per-model usage counters of `api_key` and persists them."""
+    # Increment usage count ONLY if the request didn't result in 429 (atomic per key)
+    current_model_count, current_total_count = usage_state.record_usage(api_key, model)
+
+    logging.info(f"Key ending ...{api_key[-4:]} used for model '{model}'. Today's model usage: {current_model_count}. Total usage for key: {current_total_count}")
+    usage_persister.mark_dirty() # Persisted by the background writer
+
+def init_key_state(api_keys):
+    """
+    Creates the usage state and key pool for USAGE_STATE_BACKEND and loads today's usage
+    data into them. Call once per process after the API keys are loaded.
+    """
+    global usage_state, key_pool
+    if USAGE_STATE_BACKEND == "sqlite":
+        script_dir = os.path.dirname(__file__) if '__file__' in globals() else '.'
+        store = SQLiteStateStore(os.path.join(script_dir, USAGE_STATE_DB_FILE))
+        logging.info(f"Using shared key state database: {store.path}")
+        usage_state = SQLiteUsageState(store)
+        load_usage_data()
+        key_pool = SQLiteKeyPool(store, api_keys)
+    else:
+        load_usage_data()
+        # Build the key pool, leaving out keys already exhausted today for each model
+        key_pool = KeyPool(api_keys, usage_state.exhausted_copy())
+    # Requests already made today count against the local daily limits (RPD)
+    rate_pacer.reset_daily(usage_state.snapshot()["model_counts"], usage_state.usage_date)
+
+# --- 429 Classification and Cooldowns ---
+def _parse_retry_delay(value):
+    """Parses a google.rpc.RetryInfo retryDelay ("33s", "1.5s" or {"seconds": 33}) into seconds."""
+    if isinstance(value, dict):
+        return float(value.get("seconds", 0)) + float(value.get("nanos", 0)) / 1e9
+    if isinstance(value, str) and value.endswith("s"):
+        try:
+            return float(value[:-1])
+        except ValueError:
+            return None
+    return None
+
+def classify_rate_limit(error_body):
+    """
+    Classifies an upstream 429 body. Returns ("daily", retry_delay) when a per-day quota was
+    exceeded, otherwise ("short", retry_delay) for per-minute or unknown limits. retry_delay
+    is the RetryInfo delay in seconds, or None.
+    """
+    try:
+        payload = json_loads(error_body)
+    except (ValueError, TypeError):
+        return "short", None
+    if isinstance(payload, list) and payload: # Streaming endpoints wrap the error in an array
+        payload = payload[0]
+    error = payload.get("error") if isinstance(payload, dict) else None
+    if not isinstance(error, dict):
+        return "short", None
+
+    daily = False
+    retry_delay = None
+    for detail in error.get("details") or []:
+        if not isinstance(detail, dict):
+            continue
+        detail_type = detail.get("@type", "")
+        if detail_type.endswith("QuotaFailure"):
+            for violation in detail.get("violations") or []:
+                quota = f"{violation.get('quotaId', '')} {violation.get('quotaMetric', '')}".lower()
+                if "perday" in quota or "per_day" in quota:
+                    daily = True
+        elif detail_type.endswith("RetryInfo"):
+            retry_delay = _parse_retry_delay(detail.get("retryDelay"))
+    if not daily and "per day" in str(error.get("message", "")).lower():
+        daily = True
+    return ("daily" if daily else "short"), retry_delay
+
+def probe_key(api_key, model):
+    """
+    Sends a minimal generateContent request (one output token) with `api_key`.
+    Returns (status code, body), or (None, b"") if the request failed.
+    """
+    try:
+        resp = get_upstream_client().request(
+            method="POST", url=f"{GEMINI_API_BASE_URL}/v1beta/models/{model}:generateContent",
+            headers={"Content-Type": "application/json", "x-goog-api-key": api_key},
+            data=b'{"contents":[{"parts":[{"text":"ping"}]}],"generationConfig":{"maxOutputTokens":1}}',
+            stream=False, timeout=30)
+        return resp.status_code, resp.content
+    except requests.exceptions.RequestException as e:
+        logging.warning(f"Probe of key ending ...{api_key[-4:]} for model '{model}' failed: {e}")
+        return None, b""
+
+class KeyCooldowns:
+    """
+    Keys taken out of a model's rotation for a while after a short-term (per-minute) 429.
+
+    Each repeated 429 doubles the cooldown, starting at RATE_LIMIT_COOLDOWN_BASE_SECONDS (or
+    the upstream retry delay, if longer) and capped at RATE_LIMIT_COOLDOWN_MAX_SECONDS. A
+    background thread handles expired cooldowns. With RATE_LIMIT_PROBE_ENABLED it sends a
+    minimal request first, and returns the key to the rotation only if it no longer gets a
+    429.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._cooldowns = {} # {model: {api_key: cooldown end (time.time())}}
+        self._strikes = {} # {(api_key, model): (consecutive cooldowns, end of the last one)}
+        self._heap = [] # (cooldown end, api_key, model), earliest first
+        self._thread = None
+        self._owner_pid = None
+
+    def _ensure_started(self):
+        # Caller holds self._condition. Threads do not survive fork(), so each worker starts its own.
+        if self._thread is not None and self._owner_pid == os.getpid():
+            return
+        self._owner_pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name="key-cooldowns", daemon=True)
+        self._thread.start()
+
+    def start(self, api_key, model, retry_delay=None):
+        """Takes `api_key` out of the rotation of `model` until its cooldown ends."""
+        now = time.time()
+        with self._condition:
+            strikes, last_end = self._strikes.get((api_key, model), (0, 0))
+            if now - last_end > RATE_LIMIT_STRIKE_RESET_SECONDS: # Well-behaved for a while: start over
+                strikes = 0
+            strikes += 1
+            duration = min(RATE_LIMIT_COOLDOWN_MAX_SECONDS, RATE_LIMIT_COOLDOWN_BASE_SECONDS * 2 ** (strikes - 1))
+            duration = max(duration, retry_delay or 0)
+            until = now + duration
+            self._strikes[(api_key, model)] = (strikes, until)
+            self._cooldowns.setdefault(model, {})[api_key] = until
+            heapq.heappush(self._heap, (until, api_key, model))
+            self._ensure_started()
+            self._condition.notify()
+        key_pool.suspend(api_key, model, until) # The shared pool keeps the deadline, should this worker die
+        logging.warning(f"Key ending ...{api_key[-4:]} hit a short-term rate limit (429) for model '{model}'. Cooling down for {duration:.0f}s (strike {strikes}).")
+
+    def seconds_until_available(self, model):
+        """Seconds until the first key of `model` leaves its cooldown, or None if none is cooling down."""
+        with self._condition:
+            ends = self._cooldowns.get(model)
+            if not ends:
+                return None
+            return max(0.0, min(ends.values()) - time.time())
+
+    def snapshot(self):
+        """Returns the number of keys cooling down per model ({model: count})."""
+        with self._condition:
+            return {model: len(ends) for model, ends in self._cooldowns.items()}
+
+    def _finish(self, api_key, model):
+        with self._condition:
+            ends = self._cooldowns.get(model)
+            if ends is not None:
+                ends.pop(api_key, None)
+                if not ends:
+                    del self._cooldowns[model]
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.time():
+                    self._condition.wait(timeout=(self._heap[0][0] - time.time()) if self._heap else None)
+                until, api_key, model = heapq.heappop(self._heap)
+                if self._cooldowns.get(model, {}).get(api_key) != until: # Superseded by a later cooldown
+                    continue
+            try:
+                self._recover(api_key, model)
+            except Exception as e:
+                logging.error(f"Error while recovering key ending ...{api_key[-4:]} for model '{model}': {e}", exc_info=True)
+                self._finish(api_key, model)
+                key_pool.restore(api_key, model)
+
+    def _recover(self, api_key, model):
+        if RATE_LIMIT_PROBE_ENABLED:
+            status_code, body = probe_key(api_key, model)
+            if status_code == 429 or status_code is None:
+                kind, retry_delay = classify_rate_limit(body) if status_code == 429 else ("short", None)
+                if kind == "daily":
+                    self._finish(api_key, model)
+                    mark_key_exhausted(api_key, model, reason="hit its daily quota (429) while cooling down")
+                else:
+                    self.start(api_key, model, retry_delay) # Still limited: back off further
+                return
+            if status_code == 200:
+                record_key_usage(api_key, model) # The probe used one request of the key's quota
+        self._finish(api_key, model)
+        key_pool.restore(api_key, model)
+        logging.info(f"Key ending ...{api_key[-4:]} recovered from its cooldown for model '{model}' and is back in the rotation.")
+
+key_cooldowns = KeyCooldowns()
+
+def handle_rate_limited_key(api_key, model, error_body):
+    """
+    Handles an upstream 429 for `api_key`: a per-day quota marks the key exhausted for
+    `model` until the daily reset, while a per-minute (or unclassified) limit starts a cooldown.
+    """
+    rate_pacer.record_upstream_429()
+    kind, retry_delay = classify_rate_limit(error_body)
+    UPSTREAM_RATE_LIMITS.inc((key_label(api_key), model, kind))
+    if kind == "daily":
+        mark_key_exhausted(api_key, model)
+    else:
+        key_cooldowns.start(api_key, model, retry_delay)
+
+# --- Retries and Circuit Breakers ---
+def request_deadline_seconds(incoming_headers):
+    """Returns the seconds a request may take: REQUEST_DEADLINE_SECONDS, or the client's deadline header."""
+    for header in REQUEST_DEADLINE_HEADERS:
+        value = incoming_headers.get(header)
+        if not value:
+            continue
+        try:
+            seconds = float(value)
+        except ValueError:
+            logging.debug("Ignoring invalid %s header: %r", header, value)
+            continue
+        if seconds > 0 and math.isfinite(seconds):
+            return min(seconds, REQUEST_DEADLINE_MAX_SECONDS)
+    return REQUEST_DEADLINE_SECONDS
+
+class RetryPolicy:
+    """Decides whether a request that failed transiently is retried on another key, and after how long."""
+
+    def __init__(self):
+        self._lock = threading.Lock() # Guards the statistics
+        self.retries = {} # {reason: retries}
+        self.exhausted = 0 # Transient failures returned to the client (no retry or deadline left)
+        self._last_log_time = time.time()
+
+    def retryable(self, proxy_req):
+        """Returns True if `proxy_req` may be sent again (generation, embeddings, countTokens or a GET)."""
+        if not RETRY_ENABLED:
+            return False
+        if proxy_req.is_openai_format or proxy_req.method == 'GET':
+            return True
+        last_segment = proxy_req.target_path.rsplit('/', 1)[-1]
+        action = last_segment.split(':', 1)[1] if ':' in last_segment else None
+        return proxy_req.method == 'POST' and action in GENERATION_ACTIONS + DETERMINISTIC_ACTIONS
+
+    def next_delay(self, proxy_req, retries, reason, api_key):
+        """
+        Returns the seconds to wait before retrying `proxy_req` on another key after a transient
+        failure (`reason`) with `api_key`, or None if it must not be retried.
+        """
+        if not self.retryable(proxy_req):
+            return None
+        delay = None
+        if retries < RETRY_MAX_RETRIES:
+            # Full jitter: spreads the retries of requests that failed together
+            delay = random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** retries))
+            if proxy_req.deadline - time.time() - delay < RETRY_MIN_ATTEMPT_SECONDS:
+                delay = None
+        with self._lock:
+            if delay is None:
+                self.exhausted += 1
+            else:
+                self.retries[reason] = self.retries.get(reason, 0) + 1
+        self.maybe_log()
+        if delay is None:
+            logging.warning(f"Not retrying request for model '{proxy_req.model}' after {reason} with key ...{api_key[-4:]}: "
+                            f"{retries} retries made, {max(0.0, proxy_req.deadline - time.time()):.1f}s left until its deadline.")
+            return None
+        logging.warning(f"Retrying request for model '{proxy_req.model}' on another key in {delay:.2f}s after {reason} with key ...{api_key[-4:]}.")
+        return delay
+
+    def snapshot(self):
+        with self._lock:
+            return {"retries": dict(self.retries), "exhausted": self.exhausted}
+
+    def maybe_log(self, force=False):
+        """Logs a retry and circuit breaker summary at most once every RETRY_STATS_LOG_INTERVAL seconds."""
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_log_time < RETRY_STATS_LOG_INTERVAL:
+                return
+            self._last_log_time = now
+        stats = self.snapshot()
+        breakers = circuit_breakers.snapshot()
+        if not stats["retries"] and not stats["exhausted"] and not breakers["opened"]:
+            return
+        retries = ", ".join(f"{count} after {reason}" for reason, count in sorted(stats["retries"].items())) or "none"
+        logging.info(
+            f"Retries: {retries}; {stats['exhausted']} transient failures returned to the client. "
+            f"Circuit breakers: {breakers['open']} keys out of rotation, opened {breakers['opened']} times, {breakers['recovered']} keys recovered.")
+
+retry_policy = RetryPolicy()
+
+class _Breaker:
+    __slots__ = ("state", "failures", "open_until", "trial_started")
+
+    def __init__(self):
+        self.state = "closed" # -> "open" (key out of rotation) -> "half_open" (one trial request) -> "closed"
+        self.failures = 0 # Consecutive failed attempts
+        self.open_until = 0.0
+        self.trial_started = 0.0
+
+class CircuitBreakers:
+    """
+    Per-key circuit breakers (across models): a key whose attempts keep failing transiently is
+    skipped by KeyCandidates for CIRCUIT_BREAKER_OPEN_SECONDS, then tested with one request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._breakers = {} # {api_key: _Breaker}, only keys that failed
+        self.opened = 0
+        self.recovered = 0
+
+    def blocked(self, api_key):
+        """Returns True if `api_key` is out of rotation (open, or half-open with its trial running)."""
+        if not CIRCUIT_BREAKER_ENABLED:
+            return False
+        breaker = self._breakers.get(api_key)
+        if breaker is None or breaker.state == "closed":
+            return False
+        now = time.monotonic()
+        if breaker.state == "open":
+            return now < breaker.open_until
+        # A trial that never reported back (e.g. lost with its request) doesn't block the key forever
+        return now - breaker.trial_started < CIRCUIT_BREAKER_OPEN_SECONDS
+
+    def allow(self, api_key):
+        """Called before using `api_key`: returns False if it is out of rotation, makes it the half-open trial if due."""
+        if not CIRCUIT_BREAKER_ENABLED or api_key not in self._breakers:
+            return True
+        with self._lock:
+            if self.blocked(api_key):
+                return False
+            breaker = self._breakers[api_key]
+            if breaker.state != "closed":
+                breaker.state = "half_open"
+                breaker.trial_started = time.monotonic()
+                logging.info(f"Circuit breaker of key ...{api_key[-4:]} half-open: testing it with one request.")
+            return True
+
+    def record(self, api_key, failed):
+        """Records the outcome of an attempt with `api_key` (failed: timeout, connection error or 5xx)."""
+        if not CIRCUIT_BREAKER_ENABLED or (not failed and api_key not in self._breakers):
+            return
+        with self._lock:
+            breaker = self._breakers.get(api_key)
+            if breaker is None:
+                breaker = self._breakers[api_key] = _Breaker()
+            if not failed:
+                if breaker.state != "closed":
+                    self.recovered += 1
+                    logging.info(f"Circuit breaker of key ...{api_key[-4:]} closed: the key is back in rotation.")
+                del self._breakers[api_key]
+                return
+            breaker.failures += 1
+            if breaker.state == "half_open" or (breaker.state == "closed" and breaker.failures >= CIRCUIT_BREAKER_FAILURES):
+                breaker.state = "open"
+                breaker.open_until = time.monotonic() + CIRCUIT_BREAKER_OPEN_SECONDS
+                self.opened += 1
+                logging.warning(f"Circuit breaker of key ...{api_key[-4:]} opened after {breaker.failures} failed attempts: "
+                                f"key out of rotation for {CIRCUIT_BREAKER_OPEN_SECONDS}s.")
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "open": sum(1 for api_key in self._breakers if self.blocked(api_key)),
+                "opened": self.opened,
+                "recovered": self.recovered,
+            }
+
+circuit_breakers = CircuitBreakers()
+
+# --- Rate Pacing ---
+# Enforces MODEL_RATE_LIMITS locally with token buckets per key and model, so that keys
+# which would exceed their limits are skipped before a request is sent instead of
+# costing a 429 round trip.
+class _PaceBucket:
+    """RPM and TPM token buckets plus the RPD counter of one key and model."""
+    __slots__ = ("lock", "rpm", "tpm", "rpd", "requests", "tokens", "day_requests", "updated")
+
+    def __init__(self, limits, day_requests=0):
+        self.lock = threading.Lock()
+        self.rpm = limits.get("rpm")
+        self.tpm = limits.get("tpm")
+        self.rpd = limits.get("rpd")
+        self.requests = float(self.rpm or 0) # Buckets start full
+        self.tokens = float(self.tpm or 0)
+        self.day_requests = day_requests
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        if self.rpm:
+            self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    def check(self, token_cost, now):
+        """
+        Returns (headroom, wait_seconds) for one request costing `token_cost` tokens. headroom is
+        the smallest remaining fraction of any limit after the request, or None if the request
+        does not fit now. wait_seconds is None if it cannot fit again today. Caller holds self.lock.
+        """
+        self._refill(now)
+        headroom = 1.0
+        wait_seconds = 0.0
+        if self.rpd:
+            if self.day_requests >= self.rpd:
+                return None, None
+            headroom = min(headroom, (self.rpd - self.day_requests - 1) / self.rpd)
+        if self.rpm:
+            if self.requests < 1:
+                wait_seconds = max(wait_seconds, (1 - self.requests) * 60 / self.rpm)
+            headroom = min(headroom, (self.requests - 1) / self.rpm)
+        if self.tpm:
+            token_cost = min(token_cost, self.tpm) # A request larger than the bucket fits only when it is full
+            if self.tokens < token_cost:
+                wait_seconds = max(wait_seconds, (token_cost - self.tokens) * 60 / self.tpm)
+            headroom = min(headroom, (self.tokens - token_cost) / self.tpm)
+        return (headroom if wait_seconds == 0 else None), wait_seconds
+
+    def consume(self, token_cost):
+        """Charges one request. Caller holds self.lock."""
+        self.requests -= 1
+        if self.tpm:
+            self.tokens -= min(token_cost, self.tpm)
+        self.day_requests += 1
+
+class RatePacer:
+    """Per-key, per-model pacing against the local limits in MODEL_RATE_LIMITS."""
+
+    def __init__(self, limits=None):
+        self.limits = limits # None: use MODEL_RATE_LIMITS (read at call time so it can be reconfigured)
+        self._lock = threading.Lock() # Guards creating buckets and the statistics
+        self._buckets = {} # {(api_key, model): _PaceBucket}
+        self._day_seed = {} # {(api_key, model): requests already made today}
+        self._day = None # Usage day the buckets belong to
+        self.paced_skips = 0 # Keys skipped for being over budget (each one an avoided 429 round trip)
+        self.paced_rejections = 0 # Requests answered locally with 429 because no key had budget
+        self.upstream_429s = 0 # 429 responses received from upstream
+        self._last_log_time = time.time()
+
+    def limits_for(self, model):
+        """Returns the limits of `model` ({"rpm", "tpm", "rpd"}), or None if it is not paced."""
+        if not RATE_PACING_ENABLED:
+            return None
+        limits = MODEL_RATE_LIMITS if self.limits is None else self.limits
+        return limits.get(model) or limits.get("default")
+
+    def reset_daily(self, model_counts=None, day=None):
+        """Starts a new day. `model_counts` ({api_key: {model: count}}) seeds today's RPD counters."""
+        with self._lock:
+            self._day = day
+            self._buckets = {}
+            self._day_seed = {
+                (api_key, model): count
+                for api_key, models in (model_counts or {}).items() for model, count in models.items()
+            }
+
+    def start_day(self, day):
+        """Drops the buckets if they belong to another day than `day`."""
+        if day == self._day: # Fast path, no lock needed
+            return
+        with self._lock:
+            if day == self._day:
+                return
+            self._day = day
+            self._buckets = {}
+            self._day_seed = {}
+
+    def _bucket(self, api_key, model, limits):
+        bucket = self._buckets.get((api_key, model))
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.get((api_key, model))
+                if bucket is None:
+                    bucket = _PaceBucket(limits, self._day_seed.get((api_key, model), 0))
+                    self._buckets[(api_key, model)] = bucket
+        return bucket
+
+    def choose(self, candidates, model, token_cost):
+        """
+        Picks the candidate key with the most headroom and charges it.
+        Returns (chosen key or None, keys over budget for now, keys out of budget for today,
+        seconds until the first over-budget key has budget again or None).
+        """
+        limits = self.limits_for(model)
+        now = time.monotonic()
+        over_budget_keys = []
+        daily_limit_keys = []
+        shortest_wait = None
+        ranked = []
+        for api_key in candidates:
+            bucket = self._bucket(api_key, model, limits)
+            with bucket.lock:
+                headroom, wait_seconds = bucket.check(token_cost, now)
+            if headroom is not None:
+                ranked.append((headroom, api_key, bucket))
+            elif wait_seconds is None:
+                daily_limit_keys.append(api_key)
+            else:
+                over_budget_keys.append(api_key)
+                shortest_wait = wait_seconds if shortest_wait is None else min(shortest_wait, wait_seconds)
+
+        chosen_key = None
+        ranked.sort(key=lambda item: item[0], reverse=True)
+        for _, api_key, bucket in ranked:
+            with bucket.lock:
+                # Re-check: another thread may have charged this bucket since it was ranked
+                headroom, wait_seconds = bucket.check(token_cost, time.monotonic())
+                if headroom is not None:
+                    bucket.consume(token_cost)
+                    chosen_key = api_key
+                    break
+            over_budget_keys.append(api_key)
+            if wait_seconds is not None:
+                shortest_wait = wait_seconds if shortest_wait is None else min(shortest_wait, wait_seconds)
+
+        skipped = len(over_budget_keys) + len(daily_limit_keys)
+        with self._lock:
+            self.paced_skips += skipped
+        if skipped:
+            logging.debug("Rate pacing skipped %d key(s) over their local budget for model '%s'.", skipped, model)
+        self.maybe_log()
+        return chosen_key, over_budget_keys, daily_limit_keys, shortest_wait
+
+    def record_rejection(self):
+        with self._lock:
+            self.paced_rejections += 1
+
+    def record_upstream_429(self):
+        with self._lock:
+            self.upstream_429s += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "paced_skips": self.paced_skips,
+                "paced_rejections": self.paced_rejections,
+                "upstream_429s": self.upstream_429s,
+            }
+
+    def maybe_log(self, force=False):
+        """Logs a pacing summary at most once every RATE_PACING_STATS_LOG_INTERVAL seconds."""
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_log_time < RATE_PACING_STATS_LOG_INTERVAL:
+                return
+            self._last_log_time = now
+        stats = self.snapshot()
+        logging.info(
+            f"Rate pacing: {stats['paced_skips']} over-budget keys skipped (upstream 429s avoided), "
+            f"{stats['paced_rejections']} requests rejected locally, {stats['upstream_429s']} upstream 429s received.")
+
+rate_pacer = RatePacer()
+
+# --- Response Cache ---
+# Gemini actions whose response only depends on the request body
+DETERMINISTIC_ACTIONS = ("countTokens", "embedContent", "batchEmbedContents")
+# Generation actions, cached only when sampling is deterministic (temperature 0)
+GENERATION_ACTIONS = ("generateContent", "streamGenerateContent")
+# Matches the total token count in usageMetadata (streams repeat it, the last one is final)
+_TOTAL_TOKENS_PATTERN = re.compile(rb'"totalTokenCount"\s*:\s*(\d+)')
+
+def request_fingerprint(proxy_req):
+    """
+    Identifies the upstream response a request will get. Returns (key, kind), where key is a
+    sha256 of the method, target path, forwarded query params and canonical (sorted) Gemini body,
+    and kind is "metadata" (GETs), "deterministic" or "sampled" (generation with a temperature
+    other than 0). Returns (None, reason) for requests that must not share a response.
+    """
+    last_segment = proxy_req.target_path.rsplit('/', 1)[-1]
+    action = last_segment.split(':', 1)[1] if ':' in last_segment else None
+    forward_method = 'POST' if proxy_req.is_openai_format else proxy_req.method
+    if forward_method == 'GET' and action is None:
+        body = None # Metadata request, e.g. v1beta/models or v1beta/models/gemini-pro
+        kind = "metadata"
+    elif forward_method == 'POST' and action in GENERATION_ACTIONS + DETERMINISTIC_ACTIONS:
+        body = proxy_req.gemini_request_body_json
+        if not proxy_req.is_openai_format:
+            try:
+                body = json_loads(proxy_req.native_request_body)
+            except ValueError:
+                return None, "invalid"
+        if not isinstance(body, dict):
+            return None, "invalid"
+        kind = "deterministic"
+        if action in GENERATION_ACTIONS:
+            generation_config = body.get("generationConfig") or {}
+            # Gemini samples with temperature 1 by default, only an explicit 0 is repeatable
+            if generation_config.get("temperature") != 0:
+                kind = "sampled"
+    else:
+        return None, None
+    cache_control = proxy_req.outgoing_headers.get('cache-control', '').lower()
+    if 'no-cache' in cache_control or 'no-store' in cache_control:
+        return None, "no-cache"
+
+    params = sorted((proxy_req.forward_params() or {}).items())
+    key_material = json_dumps([forward_method, proxy_req.target_path, params]) + b"\n" + json_dumps(body, sort_keys=True)
+    return hashlib.sha256(key_material).hexdigest(), kind
+
+class _CacheEntry:
+    __slots__ = ("status", "headers", "body", "model", "tokens", "expires")
+
+    def __init__(self, status, headers, body, model, tokens, expires):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.model = model
+        self.tokens = tokens # Tokens a hit saves (from usageMetadata, 0 if unknown)
+        self.expires = expires # time.monotonic() deadline
+
+class ResponseCacheFill:
+    """
+    Collects an upstream response body while it is relayed and caches it once it completed.
+    Like a _Flight it is a response sink: add() each body chunk, commit() once the response
+    completed, close() when done either way.
+    """
+
+    def __init__(self, cache, cache_key, ttl, model, status, headers):
+        self.cache = cache
+        self.cache_key = cache_key
+        self.ttl = ttl
+        self.model = model
+        self.status = status
+        self.headers = headers
+        self.parts = []
+        self.size = 0
+        self.aborted = False
+
+    def add(self, data):
+        if self.aborted:
+            return
+        self.size += len(data)
+        if self.size > RESPONSE_CACHE_MAX_ENTRY_BYTES:
+            self.aborted = True # Too large to cache, stop collecting
+            self.parts = []
+            return
+        self.parts.append(data)
+
+    def commit(self):
+        """Caches the collected body, unless it was too large or ends with a Google API error."""
+        if self.aborted:
+            return
+        body = b"".join(self.parts)
+        self.parts = []
+        if body and filter_trailing_error(body) != body:
+            logging.debug("Not caching a response that ends with an upstream error.")
+            return
+        self.cache.put(self.cache_key, self.ttl, self.model, self.status, self.headers, body)
+
+    def close(self):
+        self.parts = [] # Nothing to release; an uncommitted body is simply dropped
+
+class ResponseCache:
+    """
+    LRU cache of upstream responses, bounded by RESPONSE_CACHE_MAX_ENTRIES and RESPONSE_CACHE_MAX_BYTES.
+
+    Entries hold the upstream (Gemini) response rather than what was sent to the client, so an
+    OpenAI request and a native request with the same Gemini body share one entry, and the
+    OpenAI conversion runs again (with a fresh id) on every hit.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock() # Guards the entries and the statistics
+        self._entries = OrderedDict() # {cache key: _CacheEntry}, least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0 # Cacheable endpoints skipped for sampling, Cache-Control or an unparsable body
+        self.evictions = 0
+        self.saved_tokens = 0
+        self.saved_requests = {} # {model: upstream requests answered from the cache}
+        self._last_log_time = time.time()
+
+    def ttl_for(self, proxy_req):
+        """Returns how many seconds the response to `proxy_req` may be cached, or None if it must not be."""
+        if not RESPONSE_CACHE_ENABLED:
+            return None
+        if proxy_req.fingerprint_kind in ("sampled", "no-cache", "invalid"):
+            with self._lock:
+                self.bypasses += 1
+            return None
+        if proxy_req.fingerprint_kind == "metadata":
+            return RESPONSE_CACHE_METADATA_TTL or None
+        if proxy_req.fingerprint_kind == "deterministic":
+            return RESPONSE_CACHE_TTLS.get(proxy_req.model, RESPONSE_CACHE_TTLS.get("default", 0)) or None
+        return None
+
+    def get(self, cache_key):
+        """Returns the fresh _CacheEntry for `cache_key` (counting a hit) or None (counting a miss)."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and entry.expires <= now:
+                self._remove(cache_key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(cache_key)
+                self.hits += 1
+                self.saved_tokens += entry.tokens
+                self.saved_requests[entry.model] = self.saved_requests.get(entry.model, 0) + 1
+        self.maybe_log()
+        return entry
+
+    def start_fill(self, proxy_req, status_code, headers):
+        """Returns a ResponseCacheFill for a successful response to a cacheable request, else None."""
+        if proxy_req.cache_ttl is None or status_code != 200:
+            return None
+        return ResponseCacheFill(self, proxy_req.fingerprint, proxy_req.cache_ttl, proxy_req.model, status_code, headers)
+
+    def put(self, cache_key, ttl, model, status, headers, body):
+        if len(body) > RESPONSE_CACHE_MAX_ENTRY_BYTES:
+            return
+        token_matches = _TOTAL_TOKENS_PATTERN.findall(body)
+        tokens = int(token_matches[-1]) if token_matches else 0
+        entry = _CacheEntry(status, list(headers), body, model, tokens, time.monotonic() + ttl)
+        with self._lock:
+            self._remove(cache_key)
+            self._entries[cache_key] = entry
+            self.total_bytes += len(body)
+            # Evict least recently used entries until both limits hold again
+            while len(self._entries) > RESPONSE_CACHE_MAX_ENTRIES or self.total_bytes > RESPONSE_CACHE_MAX_BYTES:
+                _, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= len(evicted.body)
+                self.evictions += 1
+        logging.debug("Cached %d byte response for model '%s' for %ss.", len(body), model, ttl)
+
+    def _remove(self, cache_key):
+        entry = self._entries.pop(cache_key, None)
+        if entry is not None:
+            self.total_bytes -= len(entry.body)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypasses": self.bypasses,
+                "evictions": self.evictions,
+                "saved_tokens": self.saved_tokens,
+                "saved_requests": dict(self.saved_requests),
+            }
+
+    def maybe_log(self, force=False):
+        """Logs a cache summary at most once every RESPONSE_CACHE_STATS_LOG_INTERVAL seconds."""
+        if not RESPONSE_CACHE_ENABLED:
+            return
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_log_time < RESPONSE_CACHE_STATS_LOG_INTERVAL:
+                return
+            self._last_log_time = now
+        stats = self.snapshot()
+        lookups = stats['hits'] + stats['misses']
+        hit_rate = f"{stats['hits'] / lookups:.1%}" if lookups else "n/a"
+        logging.info(
+            f"Response cache: {stats['hits']} hits, {stats['misses']} misses (hit rate {hit_rate}), "
+            f"{stats['bypasses']} bypassed, {stats['entries']} entries / {stats['bytes']} bytes, "
+            f"{stats['evictions']} evictions. Saved {sum(stats['saved_requests'].values())} upstream requests "
+            f"(~{stats['saved_tokens']} tokens) per model: {stats['saved_requests']}")
+
+response_cache = ResponseCache()
+
+# --- Request Coalescing ---
+class _Flight:
+    """
+    One upstream call shared by the request that made it (the leader) and the identical
+    requests that arrived while it was running (the followers).
+
+    The leader publish()es the upstream status and headers and then feeds the body through the
+    response sink interface (add/commit/close); followers read the chunks as they arrive.
+    Works for both engines: sync followers wait on a Condition, async followers on an
+    asyncio.Event woken through their event loop.
+    """
+
+    def __init__(self, coalescer, key, model):
+        self.coalescer = coalescer
+        self.key = key
+        self.model = model
+        self.cond = threading.Condition()
+        self.state = "pending" # -> "streaming" -> "completed" or "failed"; "abandoned" if never published
+        self.status = None
+        self.headers = None
+        self.chunks = []
+        self.next_sink = None # Sink the leader's body is passed on to (e.g. a ResponseCacheFill)
+        self._async_waiters = [] # (event loop, asyncio.Event) of async followers
+
+    def _notify(self):
+        # Called with self.cond held
+        self.cond.notify_all()
+        for loop, event in self._async_waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def _finish(self, state):
+        with self.cond:
+            if self.state not in ("pending", "streaming"):
+                return
+            self.state = state
+            self._notify()
+        self.coalescer.remove(self)
+
+    # --- Leader side ---
+    def publish(self, status, headers, next_sink=None):
+        """Shares the upstream response status and headers. Returns the flight as the body sink."""
+        self.next_sink = next_sink
+        with self.cond:
+            self.status = status
+            self.headers = list(headers)
+            self.state = "streaming"
+            self._notify()
+        return self
+
+    def add(self, data):
+        with self.cond:
+            self.chunks.append(data)
+            self._notify()
+        if self.next_sink:
+            self.next_sink.add(data)
+
+    def commit(self):
+        if self.next_sink:
+            self.next_sink.commit() # Cache first, so no identical request falls between flight and cache
+        self._finish("completed")
+
+    def release_unpublished(self):
+        """Called when the leader is done: abandons the flight if no upstream response was published."""
+        if self.state == "pending":
+            self._finish("abandoned")
+
+    def close(self):
+        """Ends the flight: "failed" if the body did not complete, "abandoned" if nothing was published."""
+        if self.next_sink:
+            self.next_sink.close()
+        self._finish("abandoned" if self.state == "pending" else "failed")
+
+    # --- Follower side ---
+    def wait_published(self):
+        """Blocks until the leader got an upstream response. Returns False if it gave up without one."""
+        deadline = time.monotonic() + REQUEST_COALESCING_WAIT_TIMEOUT
+        with self.cond:
+            while self.state == "pending":
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            return self.state != "abandoned"
+
+    def iter_chunks(self):
+        """Yields the body chunks as the leader receives them; ends when the body is complete (or failed)."""
+        index = 0
+        while True:
+            with self.cond:
+                deadline = time.monotonic() + REQUEST_COALESCING_WAIT_TIMEOUT
+                while index >= len(self.chunks) and self.state == "streaming":
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        logging.warning(f"Coalesced request for model '{self.model}' stopped waiting for the shared response.")
+                        return
+                    self.cond.wait(remaining)
+                new_chunks = self.chunks[index:]
+                finished = self.state != "streaming"
+            index += len(new_chunks)
+            for chunk in new_chunks:
+                yield chunk
+            if finished and index >= len(self.chunks):
+                return
+
+    async def _async_wait(self, ready):
+        """Awaits until ready() (evaluated with the lock held) is true. Returns False on timeout."""
+        event = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), event)
+        with self.cond:
+            self._async_waiters.append(waiter)
+        try:
+            deadline = time.monotonic() + REQUEST_COALESCING_WAIT_TIMEOUT
+            while True:
+                event.clear() # Before checking, so a notification in between is not lost
+                with self.cond:
+                    if ready():
+                        return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                try:
+                    await asyncio.wait_for(event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self.cond:
+                self._async_waiters.remove(waiter)
+
+    async def async_wait_published(self):
+        """Async counterpart of wait_published()."""
+        if not await self._async_wait(lambda: self.state != "pending"):
+            return False
+        return self.state != "abandoned"
+
+    async def aiter_chunks(self):
+        """Async counterpart of iter_chunks()."""
+        index = 0
+        while True:
+            if not await self._async_wait(lambda: index < len(self.chunks) or self.state != "streaming"):
+                logging.warning(f"Coalesced request for model '{self.model}' stopped waiting for the shared response.")
+                return
+            with self.cond:
+                new_chunks = self.chunks[index:]
+                finished = self.state != "streaming"
+            index += len(new_chunks)
+            for chunk in new_chunks:
+                yield chunk
+            if finished and index >= len(self.chunks):
+                return
+
+class FollowerResponseConverter:
+    """Turns the shared upstream body of a flight into the response format of one follower."""
+
+    def __init__(self, proxy_req, flight, response_mode):
+        self.flight = flight
+        self.translator = None
+        self.error_filter = None
+        if response_mode == "openai_stream":
+            self.translator = GeminiSSEToOpenAIStream(proxy_req.model, proxy_req.start_time)
+        elif flight.status == 200:
+            self.error_filter = TrailingErrorFilter()
+
+    def feed(self, chunk):
+        if self.translator:
+            try:
+                return self.translator.feed(chunk)
+            except ValueError as e:
+                logging.error(f"Error while converting a coalesced stream: {e}")
+                return b""
+        return self.error_filter.feed(chunk) if self.error_filter else chunk
+
+    def finish(self):
+        if self.translator:
+            return self.translator.finish(self.flight.state == "completed")
+        return self.error_filter.finish() if self.error_filter else b""
+
+class RequestCoalescer:
+    """Registry of in-flight upstream calls, keyed by request fingerprint."""
+
+    def __init__(self):
+        self._lock = threading.Lock() # Guards the registry and the statistics
+        self._flights = {} # {fingerprint: _Flight}
+        self.leaders = 0 # Upstream calls that identical requests could join
+        self.followers = 0 # Requests answered from another request's upstream call
+        self.abandoned = 0 # Followers that had to send their own request (leader got no response)
+        self.saved_requests = {} # {model: upstream requests saved}
+        self._last_log_time = time.time()
+
+    def join(self, proxy_req):
+        """
+        Returns (flight, is_leader) for a coalescable request: the running flight of an identical
+        request (follower) or a new one this request leads. Returns (None, False) otherwise.
+        """
+        if not REQUEST_COALESCING_ENABLED or proxy_req.fingerprint is None:
+            return None, False
+        if proxy_req.fingerprint_kind == "sampled" and not REQUEST_COALESCING_SAMPLED:
+            return None, False
+        with self._lock:
+            flight = self._flights.get(proxy_req.fingerprint)
+            if flight is not None:
+                return flight, False
+            flight = _Flight(self, proxy_req.fingerprint, proxy_req.model)
+            self._flights[proxy_req.fingerprint] = flight
+            self.leaders += 1
+            return flight, True
+
+    def remove(self, flight):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def record_follower(self, model, served):
+        """Counts a follower that was served from a shared response (or had to go on its own)."""
+        with self._lock:
+            if served:
+                self.followers += 1
+                self.saved_requests[model] = self.saved_requests.get(model, 0) + 1
+            else:
+                self.abandoned += 1
+        self.maybe_log()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._flights),
+                "leaders": self.leaders,
+                "followers": self.followers,
+                "abandoned": self.abandoned,
+                "saved_requests": dict(self.saved_requests),
+            }
+
+    def maybe_log(self, force=False):
+        """Logs a coalescing summary at most once every REQUEST_COALESCING_STATS_LOG_INTERVAL seconds."""
+        if not REQUEST_COALESCING_ENABLED:
+            return
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_log_time < REQUEST_COALESCING_STATS_LOG_INTERVAL:
+                return
+            self._last_log_time = now
+        stats = self.snapshot()
+        logging.info(
+            f"Request coalescing: {stats['followers']} requests shared the upstream call of an identical request "
+            f"({stats['leaders']} coalescable upstream calls, {stats['in_flight']} in flight, "
+            f"{stats['abandoned']} followers fell back to their own call). Saved upstream requests per model: {stats['saved_requests']}")
+
+request_coalescer = RequestCoalescer()
+
+# --- Hedged Requests ---
+# Non-streaming actions that may be sent twice (a streamed generation can't be hedged once it
+# has started, and the client already sees its first tokens)
+HEDGEABLE_ACTIONS = ("generateContent",) + DETERMINISTIC_ACTIONS
+
+class HedgePolicy:
+    """
+    Decides when a slow request gets a duplicate on another key: after the model's
+    HEDGING_LATENCY_PERCENTILE latency, and only while the hedge budget allows it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock() # Guards the latency samples, the budget and the statistics
+        self._latencies = {} # {model: deque of recent upstream latencies in seconds}
+        self._budget = 0.0 # Hedges that may be sent now
+        self.requests = 0 # Hedgeable requests seen
+        self.hedges = 0 # Duplicates sent
+        self.hedge_wins = 0 # Requests answered by the duplicate
+        self.budget_denials = 0 # Slow requests not hedged because the budget was used up
+        self._last_log_time = time.time()
+
+    def hedgeable(self, proxy_req):
+        """Returns True if `proxy_req` is a non-streaming call that may be hedged."""
+        if not HEDGING_ENABLED:
+            return False
+        last_segment = proxy_req.target_path.rsplit('/', 1)[-1]
+        action = last_segment.split(':', 1)[1] if ':' in last_segment else None
+        return (proxy_req.is_openai_format or proxy_req.method == 'POST') and action in HEDGEABLE_ACTIONS
+
+    def start_request(self, model):
+        """
+        Called once per hedgeable request. Adds the request's share to the hedge budget and
+        returns the seconds after which to hedge it, or None while there are too few samples.
+        """
+        with self._lock:
+            self.requests += 1
+            self._budget = min(HEDGING_BUDGET_BURST, self._budget + HEDGING_BUDGET_RATIO)
+            samples = self._latencies.get(model)
+            ordered = sorted(samples) if samples is not None and len(samples) >= HEDGING_MIN_SAMPLES else None
+        self.maybe_log()
+        if ordered is None:
+            return None
+        index = min(len(ordered) - 1, int(len(ordered) * HEDGING_LATENCY_PERCENTILE / 100))
+        return max(HEDGING_MIN_DELAY, ordered[index])
+
+    def record_latency(self, model, seconds):
+        """Records the latency of an answered (non-429) attempt."""
+        with self._lock:
+            samples = self._latencies.get(model)
+            if samples is None or samples.maxlen != HEDGING_LATENCY_SAMPLES:
+                samples = self._latencies[model] = deque(samples or (), maxlen=HEDGING_LATENCY_SAMPLES)
+            samples.append(seconds)
+
+    def try_acquire(self):
+        """Takes one hedge from the budget. Returns False (and counts a denial) if none is left."""
+        with self._lock:
+            if self._budget < 1:
+                self.budget_denials += 1
+                return False
+            self._budget -= 1
+            self.hedges += 1
+            return True
+
+    def release(self):
+        """Returns an acquired hedge that could not be sent (no other usable key)."""
+        with self._lock:
+            self._budget += 1
+            self.hedges -= 1
+
+    def record_win(self):
+        with self._lock:
+            self.hedge_wins += 1
+        self.maybe_log()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "budget_denials": self.budget_denials,
+            }
+
+    def maybe_log(self, force=False):
+        """Logs a hedging summary at most once every HEDGING_STATS_LOG_INTERVAL seconds."""
+        if not HEDGING_ENABLED:
+            return
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_log_time < HEDGING_STATS_LOG_INTERVAL:
+                return
+            self._last_log_time = now
+        stats = self.snapshot()
+        share = f"{stats['hedges'] / stats['requests']:.1%}" if stats['requests'] else "n/a"
+        logging.info(
+            f"Hedging: {stats['hedges']} duplicates sent for {stats['requests']} hedgeable requests ({share}), "
+            f"{stats['hedge_wins']} answered first by the duplicate, {stats['budget_denials']} slow requests not hedged (budget used up).")
+
+hedge_policy = HedgePolicy()
+
+# --- Context Caching ---
+# Request fields that must be part of a cachedContents resource instead of a request that references it
+CONTEXT_CACHE_HEAD_FIELDS = ("systemInstruction", "tools", "toolConfig")
+# A cache is no longer referenced this many seconds before it expires (it could expire in flight)
+CONTEXT_CACHE_EXPIRY_MARGIN = 15
+# Seconds before creating a cache is tried again with a key after it failed
+CONTEXT_CACHE_RETRY_SECONDS = 60
+# Upstream statuses of a request that referenced a cache that no longer exists
+CONTEXT_CACHE_REJECTION_STATUSES = (400, 403, 404)
+
+class ContextCachePlan:
+    """
+    The cacheable prefixes of one converted request. A prefix is the head fields plus the
+    first `count` contents; only prefixes of at least CONTEXT_CACHE_MIN_TOKENS that leave
+    at least one content in the request are listed.
+    """
+    __slots__ = ("model", "body", "prefixes", "create", "cached_keys")
+
+    def __init__(self, model, body, prefixes, create, cached_keys):
+        self.model = model
+        self.body = body
+        self.prefixes = prefixes # [(prefix_hash, count, estimated_tokens)], shortest first
+        self.create = create # Longest prefix seen in CONTEXT_CACHE_MIN_REPEATS requests, caches are created for it
+        self.cached_keys = cached_keys # Keys holding a cache of the longest prefix cached so far
+
+class _ContextCacheEntry:
+    __slots__ = ("name", "tokens", "expires", "refreshing")
+
+    def __init__(self, name, tokens, expires):
+        self.name = name # Resource name, e.g. "cachedContents/abc123"
+        self.tokens = tokens # Prompt tokens stored in the cache
+        self.expires = expires # time.monotonic() of the upstream expiry
+        self.refreshing = False
+
+def context_cache_request(method, resource, api_key, payload=None, params=None):
+    """Sends a cachedContents API call with `api_key`. Returns (status_code, body)."""
+    resp = get_upstream_client().request(
+        method=method, url=f"{GEMINI_API_BASE_URL}/v1beta/{resource}",
+        headers={"x-goog-api-key": api_key, "content-type": "application/json"}, params=params,
+        data=json_dumps(payload) if payload is not None else None, stream=False, timeout=UPSTREAM_TIMEOUT)
+    return resp.status_code, resp.content
+
+class ContextCache:
+    """
+    Upstream cachedContents resources of repeated prompt prefixes, one per (prefix, key): a
+    cache belongs to the project of the key that created it.
+
+    plan() hashes the prefixes of a converted request (chained, so one pass covers all of
+    them) and counts how often each was seen. body_for() returns the body of an attempt with
+    a key, referencing the longest prefix that key has a cache for, and creates or extends
+    caches in the background so requests never wait for them. Requests prefer the keys that
+    already hold a cache (see KeyCandidates), so a prefix is not stored once per key.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock() # Guards everything below
+        self._seen = OrderedDict() # {prefix_hash: requests seen}, least recently seen first
+        self._entries = OrderedDict() # {(prefix_hash, api_key): _ContextCacheEntry}, least recently used first
+        self._keys = {} # {prefix_hash: {api_key, ...}} with an entry
+        self._pending = {} # {(prefix_hash, api_key): monotonic time until which no creation is started}
+        self._executor = None
+        self.requests = 0 # Requests with a cacheable prefix
+        self.hits = 0 # Requests sent referencing a cache
+        self.saved_tokens = 0 # Prompt tokens those requests did not resend
+        self.created = 0
+        self.creation_failures = 0
+        self.refreshes = 0
+        self.invalidations = 0 # Caches found gone upstream while referenced
+        self._last_log_time = time.time()
+
+    def _submit(self, func, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="context-cache")
+        self._executor.submit(func, *args)
+
+    def _drop_locked(self, entry_key):
+        entry = self._entries.pop(entry_key, None)
+        keys = self._keys.get(entry_key[0])
+        if keys is not None:
+            keys.discard(entry_key[1])
+            if not keys:
+                del self._keys[entry_key[0]]
+        return entry
+
+    def plan(self, proxy_req):
+        """Returns the ContextCachePlan of a converted OpenAI request, or None if it has no cacheable prefix."""
+        body = proxy_req.gemini_request_body_json
+        if not CONTEXT_CACHE_ENABLED or not isinstance(body, dict) or "cachedContent" in body:
+            return None
+        contents = body.get("contents")
+        min_bytes = CONTEXT_CACHE_MIN_TOKENS * 4
+        if not isinstance(contents, list) or not contents or len(proxy_req.request_body()) < min_bytes:
+            return None
+        head = json_dumps([body.get(field) for field in CONTEXT_CACHE_HEAD_FIELDS])
+        digest = hashlib.sha256(proxy_req.model.encode('utf-8') + b"\n" + head)
+        size = len(head)
+        prefixes = []
+        for count in range(len(contents) + 1):
+            if count:
+                item = json_dumps(contents[count - 1])
+                digest.update(b"%d:" % len(item) + item)
+                size += len(item)
+            if size >= min_bytes:
+                prefixes.append((digest.hexdigest(), count, size // 4))
+        if not prefixes:
+            return None
+        # The whole conversation is counted too: it is the prefix of the next turn
+        usable = [prefix for prefix in prefixes if prefix[1] < len(contents)]
+        with self._lock:
+            for prefix_hash, _, _ in prefixes:
+                self._seen[prefix_hash] = self._seen.pop(prefix_hash, 0) + 1
+            while len(self._seen) > CONTEXT_CACHE_MAX_ENTRIES * 50:
+                self._seen.popitem(last=False)
+            if not usable:
+                return None
+            self.requests += 1
+            create = next((prefix for prefix in reversed(usable) if self._seen[prefix[0]] >= CONTEXT_CACHE_MIN_REPEATS), None)
+            cached_keys = next((list(self._keys[prefix[0]]) for prefix in reversed(usable) if prefix[0] in self._keys), [])
+        self.maybe_log()
+        return ContextCachePlan(proxy_req.model, body, usable, create, cached_keys)
+
+    def body_for(self, proxy_req, api_key):
+        """
+        Returns the body of an attempt of `proxy_req` with `api_key` that references the
+        longest prefix cached for that key, or None to send the request in full.
+        """
+        plan = proxy_req.context_cache_plan
+        now = time.monotonic()
+        entry = prefix = None
+        create = refresh = False
+        with self._lock:
+            for candidate in reversed(plan.prefixes):
+                entry_key = (candidate[0], api_key)
+                found = self._entries.get(entry_key)
+                if found is None:
+                    continue
+                if found.expires - now <= CONTEXT_CACHE_EXPIRY_MARGIN:
+                    self._drop_locked(entry_key) # Expired upstream (or about to)
+                    continue
+                self._entries.move_to_end(entry_key)
+                entry, prefix = found, candidate
+                break
+            # Create a cache of the repeated prefix unless this key's cache already covers most of it
+            if plan.create is not None and (prefix is None or plan.create[2] - prefix[2] >= CONTEXT_CACHE_MIN_TOKENS):
+                create_key = (plan.create[0], api_key)
+                if self._pending.get(create_key, 0) <= now:
+                    self._pending[create_key] = float("inf")
+                    create = True
+            if entry is not None:
+                if not entry.refreshing and entry.expires - now < CONTEXT_CACHE_TTL_SECONDS / 2:
+                    entry.refreshing = refresh = True
+                if not proxy_req.context_cache_hit:
+                    self.hits += 1
+                    self.saved_tokens += entry.tokens
+        if create:
+            self._submit(self._create, plan.model, plan.body, plan.create, api_key)
+        if refresh:
+            self._submit(self._refresh, prefix[0], api_key, entry)
+        if entry is None:
+            return None
+        proxy_req.context_cache_hit = True
+        proxy_req.context_cache_refs[api_key] = prefix[0]
+        body = {field: value for field, value in plan.body.items() if field not in CONTEXT_CACHE_HEAD_FIELDS}
+        body["contents"] = plan.body["contents"][prefix[1]:]
+        body["cachedContent"] = entry.name
+        logging.debug("Referencing context cache %s (~%d tokens) with key ...%s", entry.name, entry.tokens, api_key[-4:])
+        return json_dumps(body)
+
+    def preferred_keys(self, proxy_req):
+        """Keys to try first for `proxy_req`: those holding a cache of its longest cached prefix."""
+        plan = proxy_req.context_cache_plan
+        return plan.cached_keys if plan is not None else ()
+
+    def rejected(self, proxy_req, api_key, status_code, error_body):
+        """
+        Returns True if an attempt failed because the cache it referenced no longer exists
+        upstream (expired or deleted). The cache is forgotten and the request stops using
+        context caches, so it can be resent in full.
+        """
+        prefix_hash = proxy_req.context_cache_refs.get(api_key)
+        if prefix_hash is None or status_code not in CONTEXT_CACHE_REJECTION_STATUSES:
+            return False
+        if b"cachedcontent" not in (error_body or b"").lower():
+            return False
+        with self._lock:
+            entry = self._drop_locked((prefix_hash, api_key))
+            self.invalidations += 1
+        logging.warning(f"Context cache {entry.name if entry else prefix_hash[:12]} of key ...{api_key[-4:]} no longer exists upstream, resending the request in full.")
+        proxy_req.context_cache_plan = None
+        proxy_req.context_cache_refs.clear()
+        return True
+
+    def _create(self, model, body, prefix, api_key):
+        prefix_hash, count, estimated_tokens = prefix
+        resource = {"model": f"models/{model}", "ttl": f"{CONTEXT_CACHE_TTL_SECONDS}s"}
+        for field in CONTEXT_CACHE_HEAD_FIELDS:
+            if body.get(field) is not None:
+                resource[field] = body[field]
+        if count:
+            resource["contents"] = body["contents"][:count]
+        created = time.monotonic()
+        try:
+            status_code, content = context_cache_request("POST", "cachedContents", api_key, resource)
+            payload = json_loads(content) if status_code == 200 else None
+        except (requests.exceptions.RequestException, ValueError) as e:
+            status_code, content, payload = None, str(e).encode('utf-8'), None
+        name = payload.get("name") if isinstance(payload, dict) else None
+        if not name:
+            logging.warning(f"Creating a context cache (~{estimated_tokens} tokens) for model '{model}' with key ...{api_key[-4:]} failed "
+                            f"(status {status_code}): {content[:300].decode('utf-8', errors='replace')}")
+            with self._lock:
+                self.creation_failures += 1
+                self._pending[(prefix_hash, api_key)] = time.monotonic() + CONTEXT_CACHE_RETRY_SECONDS
+            return
+        tokens = (payload.get("usageMetadata") or {}).get("totalTokenCount") or estimated_tokens
+        entry = _ContextCacheEntry(name, tokens, created + CONTEXT_CACHE_TTL_SECONDS)
+        with self._lock:
+            self._pending.pop((prefix_hash, api_key), None)
+            self._entries[(prefix_hash, api_key)] = entry
+            self._keys.setdefault(prefix_hash, set()).add(api_key)
+            self.created += 1
+            evicted = []
+            while len(self._entries) > CONTEXT_CACHE_MAX_ENTRIES:
+                old_key, _ = next(iter(self._entries.items()))
+                evicted.append((old_key[1], self._drop_locked(old_key)))
+            if len(self._pending) > CONTEXT_CACHE_MAX_ENTRIES * 10: # Forget failures that may be retried anyway
+                now = time.monotonic()
+                self._pending = {key: until for key, until in self._pending.items() if until > now}
+        logging.info(f"Created context cache {name} (~{tokens} tokens) for model '{model}' with key ...{api_key[-4:]}")
+        for old_api_key, old_entry in evicted: # Don't keep paying for storage of caches no longer used
+            self._delete(old_api_key, old_entry)
+
+    def _refresh(self, prefix_hash, api_key, entry):
+        refreshed = time.monotonic()
+        try:
+            status_code, _ = context_cache_request("PATCH", entry.name, api_key, {"ttl": f"{CONTEXT_CACHE_TTL_SECONDS}s"}, params={"updateMask": "ttl"})
+        except requests.exceptions.RequestException as e:
+            logging.warning(f"Extending context cache {entry.name} failed: {e}")
+            status_code = None
+        with self._lock:
+            entry.refreshing = False
+            if status_code == 200:
+                entry.expires = refreshed + CONTEXT_CACHE_TTL_SECONDS
+                self.refreshes += 1
+            elif status_code in CONTEXT_CACHE_REJECTION_STATUSES:
+                if self._entries.get((prefix_hash, api_key)) is entry:
+                    self._drop_locked((prefix_hash, api_key))
+
+    def _delete(self, api_key, entry):
+        try:
+            context_cache_request("DELETE", entry.name, api_key)
+        except requests.exceptions.RequestException as e:
+            logging.debug(f"Deleting context cache {entry.name} failed: {e}")
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "requests": self.requests,
+                "hits": self.hits,
+                "saved_tokens": self.saved_tokens,
+                "created": self.created,
+                "creation_failures": self.creation_failures,
+                "refreshes": self.refreshes,
+                "invalidations": self.invalidations,
+            }
+
+    def maybe_log(self, force=False):
+        """Logs a context caching summary at most once every CONTEXT_CACHE_STATS_LOG_INTERVAL seconds."""
+        if not CONTEXT_CACHE_ENABLED:
+            return
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_log_time < CONTEXT_CACHE_STATS_LOG_INTERVAL:
+                return
+            self._last_log_time = now
+        stats = self.snapshot()
+        hit_rate = f"{stats['hits'] / stats['requests']:.1%}" if stats['requests'] else "n/a"
+        logging.info(
+            f"Context caching: {stats['hits']} of {stats['requests']} requests with a cacheable prefix referenced a cache ({hit_rate}), "
+            f"~{stats['saved_tokens']} prompt tokens not resent. {stats['entries']} caches, {stats['created']} created, "
+            f"{stats['creation_failures']} creations failed, {stats['refreshes']} extended, {stats['invalidations']} found gone upstream.")
+
+context_cache = ContextCache()
+
+# --- Embedding Batching ---
+# Most inputs Gemini accepts in one batchEmbedContents call
+GEMINI_BATCH_EMBED_MAX_REQUESTS = 100
+
+class _EmbeddingBatch:
+    """
+    One batchEmbedContents call shared by the embeddings requests whose inputs joined it. The
+    request that opened the batch (its leader) sends it once it is closed; the others wait for
+    the result. Like _Flight, it works for both engines: sync requests wait on a Condition,
+    async ones on an asyncio.Event woken through their event loop.
+    """
+
+    def __init__(self, model, dimensions):
+        self.model = model
+        self.dimensions = dimensions
+        self.requests = [] # Gemini EmbedContentRequest of each input
+        self.estimated_tokens = 0
+        self.cond = threading.Condition()
+        self.state = "open" # -> "closed" (no more inputs, being sent) -> "done"
+        self.status = None # Upstream status code
+        self.body = b'' # Upstream body, returned as-is if the call failed
+        self.embeddings = None # Values of each input's embedding after a successful call
+        self.error = None # ProxyRequestError if the batch got no upstream response
+        self._async_waiters = [] # (event loop, asyncio.Event) of async requests
+
+    def _set_state(self, state):
+        # Called with self.cond held
+        self.state = state
+        self.cond.notify_all()
+        for loop, event in self._async_waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def close(self):
+        """Stops the batch from taking more inputs and wakes its leader to send it."""
+        with self.cond:
+            if self.state == "open":
+                self._set_state("closed")
+
+    def finish(self, status=None, body=b'', embeddings=None, error=None):
+        """Stores the result of the batch (once) and wakes the requests waiting for it."""
+        with self.cond:
+            if self.state == "done":
+                return
+            self.status, self.body, self.embeddings, self.error = status, body, embeddings, error
+            self._set_state("done")
+
+    def set_response(self, status_code, content):
+        """Stores the upstream response to the batch, split into one embedding per input."""
+        if status_code != 200:
+            self.finish(status_code, content)
+            return
+        try:
+            embeddings = [item.get("values") or [] for item in json_loads(content).get("embeddings", [])]
+        except (ValueError, AttributeError):
+            embeddings = None
+        if embeddings is None or len(embeddings) != len(self.requests):
+            logging.error(f"Unexpected batchEmbedContents response for model '{self.model}': expected {len(self.requests)} embeddings.")
+            self.finish(error=ProxyRequestError(502, "Proxy error: Unexpected embeddings response from upstream."))
+            return
+        self.finish(status_code, content, embeddings)
+
+    def upstream_request(self):
+        """Returns the batchEmbedContents call of the batch as a native ProxyRequest."""
+        target_path = f"v1beta/models/{self.model}:batchEmbedContents"
+        return ProxyRequest(
+            path=target_path, method='POST', is_openai_format=False, target_path=target_path,
+            model=self.model, outgoing_headers={'content-type': 'application/json'}, query_params={},
+            gemini_request_body_json=None, native_request_body=json_dumps({"requests": self.requests}),
+            use_stream_endpoint=False, start_time=time.time(), estimated_tokens=self.estimated_tokens)
+
+    def wait(self, ready, timeout=None):
+        """Blocks until ready() (evaluated with the lock held) is true. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while not ready():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            return True
+
+    async def async_wait(self, ready, timeout=None):
+        """Async counterpart of wait()."""
+        event = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), event)
+        with self.cond:
+            self._async_waiters.append(waiter)
+        try:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while True:
+                event.clear() # Before checking, so a notification in between is not lost
+                with self.cond:
+                    if ready():
+                        return True
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                try:
+                    await asyncio.wait_for(event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self.cond:
+                self._async_waiters.remove(waiter)
+
+class EmbeddingBatcher:
+    """
+    Merges the inputs of concurrent embeddings requests for the same model and dimensions into
+    batches of at most EMBEDDING_BATCH_MAX_SIZE inputs. A batch is sent by its leader when it is
+    full or EMBEDDING_BATCH_WINDOW_MS after it was opened, whichever comes first.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock() # Guards the open batches and the statistics
+        self._open = {} # {(model, dimensions): batch still taking inputs}
+        self.requests = 0 # Embeddings requests served
+        self.inputs = 0 # Texts embedded
+        self.batches = 0 # Upstream batchEmbedContents calls
+        self.full_batches = 0 # Batches sent because they were full (before the window ended)
+        self._last_log_time = time.time()
+
+    def join(self, emb_req):
+        """
+        Adds the inputs of `emb_req` to the open batch of its model, opening new batches as needed.
+        Returns a list of (batch, index of the first input in it, number of inputs, is_leader).
+        """
+        max_size = max(1, min(EMBEDDING_BATCH_MAX_SIZE, GEMINI_BATCH_EMBED_MAX_REQUESTS))
+        batch_key = (emb_req.model, emb_req.dimensions)
+        parts = []
+        full = []
+        with self._lock:
+            self.requests += 1
+            self.inputs += len(emb_req.requests)
+            index = 0
+            while index < len(emb_req.requests):
+                batch = self._open.get(batch_key)
+                is_leader = batch is None
+                if is_leader:
+                    batch = _EmbeddingBatch(*batch_key)
+                    self.batches += 1
+                    if EMBEDDING_BATCHING_ENABLED:
+                        self._open[batch_key] = batch
+                count = min(max_size - len(batch.requests), len(emb_req.requests) - index)
+                parts.append((batch, len(batch.requests), count, is_leader))
+                batch.requests.extend(emb_req.requests[index:index + count])
+                batch.estimated_tokens += sum(emb_req.tokens[index:index + count])
+                index += count
+                if len(batch.requests) >= max_size:
+                    # Full: send it now instead of waiting for the end of the window
+                    if self._open.get(batch_key) is batch:
+                        del self._open[batch_key]
+                        self.full_batches += 1
+                    full.append(batch)
+        for batch in full:
+            batch.close()
+        return parts
+
+    def seal(self, batch):
+        """Called by the leader when the batching window is over: no more inputs join `batch`."""
+        with self._lock:
+            if self._open.get((batch.model, batch.dimensions)) is batch:
+                del self._open[(batch.model, batch.dimensions)]
+        batch.close()
+
+    def window_seconds(self):
+        return EMBEDDING_BATCH_WINDOW_MS / 1000 if EMBEDDING_BATCHING_ENABLED else 0
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "inputs": self.inputs,
+                "batches": self.batches,
+                "full_batches": self.full_batches,
+            }
+
+    def maybe_log(self, force=False):
+        """Logs an embedding batching summary at most once every EMBEDDING_STATS_LOG_INTERVAL seconds."""
+        now = time.time()
+        with self._lock:
+            if not self.requests or (not force and now - self._last_log_time < EMBEDDING_STATS_LOG_INTERVAL):
+                return
+            self._last_log_time = now
+        stats = self.snapshot()
+        logging.info(
+            f"Embeddings: {stats['requests']} requests with {stats['inputs']} inputs sent in {stats['batches']} upstream batches "
+            f"({stats['inputs'] / max(1, stats['batches']):.1f} inputs per batch), {stats['full_batches']} sent full before the window ended.")
+
+embedding_batcher = EmbeddingBatcher()
+
+# --- Admission Control ---
+# Seconds a model's capacity (derived from its usable keys) is reused before it is recomputed
+ADMISSION_CAPACITY_TTL = 1.0
+# Bounds of the Retry-After sent with a rejection, in seconds
+ADMISSION_RETRY_AFTER_MAX = 60
+
+class AdmissionTicket:
+    """An admitted upstream call; release() gives its slot to the next waiting request."""
+    __slots__ = ("model", "admitted_at", "released")
+
+    def __init__(self, model):
+        self.model = model
+        self.admitted_at = time.monotonic()
+        self.released = False
+
+    def release(self):
+        admission_controller.release(self)
+
+class _AdmissionWaiter:
+    """A request in the admission queue. Sync requests wait on `event`, async ones on `future`."""
+    __slots__ = ("model", "ticket", "event", "loop", "future")
+
+    def __init__(self, model, loop=None):
+        self.model = model
+        self.ticket = None # Set (with the controller's lock held) once admitted
+        self.loop = loop
+        self.event = threading.Event() if loop is None else None
+        self.future = loop.create_future() if loop is not None else None
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(None))
+
+class AdmissionController:
+    """
+    Caps the upstream calls in progress, globally and per model (from the number of keys usable
+    for the model), and queues the requests beyond the caps in arrival order. A request waits at
+    most ADMISSION_QUEUE_TIMEOUT seconds; when the queue is full it is rejected right away.
+    Works for both engines, like _Flight.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock() # Guards the counts, the queue and the statistics
+        self._active = 0
+        self._active_per_model = {}
+        self._queue = deque() # _AdmissionWaiter in arrival order
+        self._queued_per_model = {}
+        self._capacities = {} # {model: (expires, capacity)}
+        self._hold_seconds = None # EWMA of how long an admitted call holds its slot
+        self.admitted = 0
+        self.queued = 0 # Requests that had to wait
+        self.queue_full_rejections = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0 # Total time spent waiting in the queue
+        self.max_queue_depth = 0
+        self._last_log_time = time.time()
+
+    def model_capacity(self, model):
+        """Upstream calls allowed at once for `model`: ADMISSION_PER_KEY_CONCURRENCY per usable key."""
+        now = time.monotonic()
+        cached = self._capacities.get(model)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        usable = key_pool.usable_count(model) if key_pool is not None else 0
+        # At least one key's worth, so a request still gets through to report why no key is usable
+        capacity = max(1, usable) * ADMISSION_PER_KEY_CONCURRENCY if ADMISSION_PER_KEY_CONCURRENCY > 0 else math.inf
+        if ADMISSION_MAX_CONCURRENT_PER_MODEL > 0:
+            capacity = min(capacity, ADMISSION_MAX_CONCURRENT_PER_MODEL)
+        self._capacities[model] = (now + ADMISSION_CAPACITY_TTL, capacity)
+        return capacity
+
+    def _has_room_locked(self, model):
+        if ADMISSION_MAX_CONCURRENT > 0 and self._active >= ADMISSION_MAX_CONCURRENT:
+            return False
+        return self._active_per_model.get(model, 0) < self.model_capacity(model)
+
+    def _admit_locked(self, model):
+        self._active += 1
+        self._active_per_model[model] = self._active_per_model.get(model, 0) + 1
+        self.admitted += 1
+        return AdmissionTicket(model)
+
+    def _try_admit(self, model, loop=None):
+        """Admits `model` now (returns a ticket) or queues it (returns a waiter). Raises ProxyRequestError if the queue is full."""
+        with self._lock:
+            # Requests for a model queue behind the ones already waiting for it
+            if not self._queued_per_model.get(model) and self._has_room_locked(model):
+                return self._admit_locked(model), None
+            if len(self._queue) >= ADMISSION_QUEUE_SIZE:
+                self.queue_full_rejections += 1
+                error = self._rejection_locked(model, "the admission queue is full")
+            else:
+                waiter = _AdmissionWaiter(model, loop)
+                self._queue.append(waiter)
+                self._queued_per_model[model] = self._queued_per_model.get(model, 0) + 1
+                self.queued += 1
+                self.max_queue_depth = max(self.max_queue_depth, len(self._queue))
+                return None, waiter
+        self.maybe_log()
+        raise error
+
+    def _give_up(self, waiter, waited):
+        """Removes a waiter that timed out. Returns its ticket instead if it was admitted meanwhile."""
+        with self._lock:
+            self.wait_seconds += waited
+            ticket = waiter.ticket
+            if ticket is None:
+                self._dequeue_locked(waiter)
+                self.timeouts += 1
+                error = self._rejection_locked(waiter.model, f"no upstream capacity within {ADMISSION_QUEUE_TIMEOUT}s")
+        ADMISSION_WAIT.observe(waited, (waiter.model,))
+        if ticket is not None:
+            return ticket
+        self.maybe_log()
+        raise error
+
+    def _admitted_after_wait(self, waiter, waited):
+        with self._lock:
+            self.wait_seconds += waited
+        ADMISSION_WAIT.observe(waited, (waiter.model,))
+        return waiter.ticket
+
+    def acquire(self, model):
+        """Waits for an upstream call slot for `model`. Returns an AdmissionTicket (None if disabled)."""
+        if not ADMISSION_CONTROL_ENABLED:
+            return None
+        ticket, waiter = self._try_admit(model)
+        if ticket is not None:
+            return ticket
+        started = time.monotonic()
+        if waiter.event.wait(ADMISSION_QUEUE_TIMEOUT):
+            return self._admitted_after_wait(waiter, time.monotonic() - started)
+        return self._give_up(waiter, time.monotonic() - started)
+
+    async def async_acquire(self, model):
+        """Async counterpart of acquire()."""
+        if not ADMISSION_CONTROL_ENABLED:
+            return None
+        ticket, waiter = self._try_admit(model, asyncio.get_running_loop())
+        if ticket is not None:
+            return ticket
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), ADMISSION_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return self._give_up(waiter, time.monotonic() - started)
+        except asyncio.CancelledError: # The client went away while waiting
+            with self._lock:
+                if waiter.ticket is None:
+                    self._dequeue_locked(waiter)
+            if waiter.ticket is not None:
+                waiter.ticket.release()
+            raise
+        return self._admitted_after_wait(waiter, time.monotonic() - started)
+
+    def release(self, ticket):
+        """Frees the slot of `ticket` (once) and admits the queued requests that now fit."""
+        if ticket is None:
+            return
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            self._active -= 1
+            self._active_per_model[ticket.model] -= 1
+            held = time.monotonic() - ticket.admitted_at
+            self._hold_seconds = held if self._hold_seconds is None else 0.9 * self._hold_seconds + 0.1 * held
+            woken = []
+            for waiter in list(self._queue):
+                if ADMISSION_MAX_CONCURRENT > 0 and self._active >= ADMISSION_MAX_CONCURRENT:
+                    break
+                if self._active_per_model.get(waiter.model, 0) < self.model_capacity(waiter.model):
+                    self._dequeue_locked(waiter)
+                    waiter.ticket = self._admit_locked(waiter.model)
+                    woken.append(waiter)
+        for waiter in woken:
+            waiter.wake()
+        self.maybe_log()
+
+    def _dequeue_locked(self, waiter):
+        self._queue.remove(waiter)
+        self._queued_per_model[waiter.model] -= 1
+
+    def _rejection_locked(self, model, reason):
+        # Roughly when the queue ahead will have drained: calls ahead / capacity * time per call
+        capacity = self.model_capacity(model)
+        if ADMISSION_MAX_CONCURRENT > 0:
+            capacity = min(capacity, ADMISSION_MAX_CONCURRENT)
+        ahead = self._queued_per_model.get(model, 0) + 1
+        retry_after = min(ADMISSION_RETRY_AFTER_MAX, max(1, math.ceil(ahead / capacity * (self._hold_seconds or 1.0))))
+        logging.warning(f"Request for model '{model}' rejected by admission control: {reason}. Retry after {retry_after}s.")
+        return ProxyRequestError(ADMISSION_REJECT_STATUS, f"Proxy is overloaded ({reason}) for model '{model}'. Retry after {retry_after} seconds.", retry_after)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "active": self._active,
+                "queue_depth": len(self._queue),
+                "max_queue_depth": self.max_queue_depth,
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "queue_full_rejections": self.queue_full_rejections,
+                "timeouts": self.timeouts,
+                "wait_seconds": self.wait_seconds,
+            }
+
+    def maybe_log(self, force=False):
+        """Logs an admission control summary at most once every ADMISSION_STATS_LOG_INTERVAL seconds."""
+        if not ADMISSION_CONTROL_ENABLED:
+            return
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_log_time < ADMISSION_STATS_LOG_INTERVAL:
+                return
+            self._last_log_time = now
+        stats = self.snapshot()
+        mean_wait = f"{stats['wait_seconds'] / stats['queued'] * 1000:.0f} ms" if stats['queued'] else "n/a"
+        logging.info(
+            f"Admission control: {stats['admitted']} upstream calls admitted, {stats['queued']} had to wait (mean wait {mean_wait}), "
+            f"{stats['queue_full_rejections']} rejected with a full queue, {stats['timeouts']} timed out waiting. "
+            f"Now {stats['active']} active and {stats['queue_depth']} queued (max queue depth {stats['max_queue_depth']}).")
+
+admission_controller = AdmissionController()
+
+# --- Metrics ---
+# Cheap in-process counters and histograms, rendered in the Prometheus text format on
+# METRICS_PATH. Recording one value is a dict update under the metric's own lock (well under a
+# microsecond); everything else (key usage, cache, pool, pacing, ... statistics) is read from
+# the existing state only when the metrics are scraped. Label values are passed as a tuple in
+# the order of the metric's label names. API keys only appear as their last 4 characters.
+
+# Histogram buckets in seconds: upstream and end-to-end latencies, and the (much shorter)
+# time spent converting between the OpenAI and Gemini formats
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+CONVERSION_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)
+# Time spent in the admission queue
+QUEUE_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def key_label(api_key):
+    """Returns the label identifying `api_key` in metrics: its last 4 characters, as in the logs."""
+    return f"...{api_key[-4:]}"
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value):
+    if isinstance(value, float):
+        return "+Inf" if value == math.inf else repr(value)
+    return str(int(value))
+
+class Counter:
+    """A monotonically increasing value per label set."""
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {} # {label values: value}
+        metrics_registry.register(self)
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in self.samples():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+class Gauge(Counter):
+    """A value per label set that can go up and down."""
+    kind = "gauge"
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+class Histogram(Counter):
+    """Counts observations into fixed buckets per label set, plus their sum and count."""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help_text, labelnames)
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value) # First bucket with value <= upper bound
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self):
+        with self._lock:
+            return [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        bounds = ['le="%s"' % _format_value(float(bound)) for bound in self.buckets] + ['le="+Inf"']
+        for labels, counts, total in self.samples():
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, bound)} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(float(total))}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    """The recorded metrics plus collectors that read the rest of the proxy's state at scrape time."""
+
+    def __init__(self):
+        self._metrics = []
+        # Callables returning [(name, kind, help text, label names, [(label values, value), ...]), ...]
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+        return collector
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format (bytes)."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            try:
+                families = collector()
+            except Exception as e: # One broken collector must not hide the other metrics
+                logging.error(f"Metrics collector {collector.__name__} failed: {e}", exc_info=True)
+                continue
+            for name, kind, help_text, labelnames, samples in families:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labelnames, labels)} {_format_value(value)}")
+        lines.append("")
+        return "\n".join(lines).encode('utf-8')
+
+metrics_registry = MetricsRegistry()
+
+# Recorded on the request path
+CLIENT_REQUESTS = Counter("gemini_proxy_requests_total", "Client requests by API format and response status code.", ("api", "code"))
+REQUEST_BYTES = Counter("gemini_proxy_request_bytes_total", "Request body bytes received from clients.", ("api",))
+RESPONSE_BYTES = Counter("gemini_proxy_response_bytes_total", "Response body bytes sent to clients.", ("api",))
+REQUEST_DURATION = Histogram("gemini_proxy_request_duration_seconds", "Time from receiving a request until the last byte of its response was sent.", ("model", "api"))
+ACTIVE_STREAMS = Gauge("gemini_proxy_active_streams", "Streamed responses currently being sent to clients.")
+UPSTREAM_RESPONSES = Counter("gemini_proxy_upstream_responses_total", "Upstream attempts by model and status code ('error' if no response arrived).", ("model", "code"))
+UPSTREAM_TTFB = Histogram("gemini_proxy_upstream_ttfb_seconds", "Time until the upstream response headers arrived, per attempt.", ("model",))
+UPSTREAM_RATE_LIMITS = Counter("gemini_proxy_upstream_rate_limited_total", "Upstream 429 responses by key, model and quota kind (daily or short).", ("key", "model", "kind"))
+ADMISSION_WAIT = Histogram("gemini_proxy_admission_wait_seconds", "Time requests waited in the admission queue for an upstream call slot.", ("model",), QUEUE_WAIT_BUCKETS)
+CONVERSION_DURATION = Histogram("gemini_proxy_conversion_seconds", "Time spent converting between the OpenAI and Gemini formats (request, response, stream).", ("direction",), CONVERSION_BUCKETS)
+
+def api_label(is_openai_format):
+    return "openai" if is_openai_format else "gemini"
+
+def record_client_request(path, status_code):
+    """Counts a client request once its response status is known (both engines)."""
+    CLIENT_REQUESTS.inc((api_label(is_openai_chat_request(path) or is_openai_embeddings_request(path)), str(status_code)))
+
+def record_response_sent(proxy_req, bytes_sent):
+    """Records the size and end-to-end duration of a complete response to `proxy_req`."""
+    api = api_label(proxy_req.is_openai_format)
+    RESPONSE_BYTES.inc((api,), bytes_sent)
+    REQUEST_DURATION.observe(time.time() - proxy_req.start_time, (proxy_req.model, api))
+
+def metered_stream(proxy_req, chunks):
+    """Wraps a streamed response body to count it in ACTIVE_STREAMS and record it once it ends."""
+    ACTIVE_STREAMS.inc()
+    bytes_sent = 0
+    try:
+        for chunk in chunks:
+            bytes_sent += len(chunk)
+            yield chunk
+    finally:
+        chunks.close() # Closes the upstream response if the client went away
+        proxy_req.release_admission()
+        ACTIVE_STREAMS.dec()
+        record_response_sent(proxy_req, bytes_sent)
+        proxy_req.trace.finish()
+
+async def async_metered_stream(proxy_req, chunks):
+    """Async counterpart of metered_stream()."""
+    ACTIVE_STREAMS.inc()
+    bytes_sent = 0
+    try:
+        async for chunk in chunks:
+            bytes_sent += len(chunk)
+            yield chunk
+    finally:
+        await chunks.aclose()
+        proxy_req.release_admission()
+        ACTIVE_STREAMS.dec()
+        record_response_sent(proxy_req, bytes_sent)
+        proxy_req.trace.finish()
+
+def _labelled_sum(items):
+    """Sums values whose labels collide (two keys may share their last 4 characters)."""
+    totals = {}
+    for labels, value in items:
+        totals[labels] = totals.get(labels, 0) + value
+    return list(totals.items())
+
+@metrics_registry.add_collector
+def collect_key_metrics():
+    snapshot = usage_state.snapshot()
+    requests_today = _labelled_sum(
+        ((key_label(api_key), model), count)
+        for api_key, models in snapshot["model_counts"].items() for model, count in models.items())
+    exhausted = _labelled_sum(
+        ((key_label(api_key), model), 1)
+        for api_key, models in snapshot["exhausted_keys"].items() for model in models)
+    models = {model for _, model in dict(requests_today)} | {model for _, model in dict(exhausted)}
+    usable = [((model,), len(key_pool.usable_keys(model))) for model in sorted(models)] if key_pool is not None else []
+    latency, error_rate, in_flight = [], [], []
+    for (api_key, model), (key_latency, key_error_rate, key_in_flight) in key_stats.snapshot().items():
+        labels = (key_label(api_key), model)
+        if key_latency is not None:
+            latency.append((labels, key_latency))
+        error_rate.append((labels, key_error_rate))
+        in_flight.append((labels, key_in_flight))
+    return [
+        ("gemini_proxy_keys", "gauge", "API keys loaded.", (), [((), len(all_api_keys))]),
+        ("gemini_proxy_key_requests_today", "gauge", "Requests made with each key for each model today (resets at the daily quota reset).", ("key", "model"), requests_today),
+        ("gemini_proxy_key_exhausted", "gauge", "1 if the key has hit its daily quota for the model.", ("key", "model"), exhausted),
+        ("gemini_proxy_usable_keys", "gauge", "Keys still usable for the model today (includes keys cooling down).", ("model",), usable),
+        ("gemini_proxy_keys_cooling_down", "gauge", "Keys on a short-term 429 cooldown.", ("model",), [((model,), count) for model, count in key_cooldowns.snapshot().items()]),
+        ("gemini_proxy_key_latency_ewma_seconds", "gauge", "Recent upstream latency of the key for the model (EWMA).", ("key", "model"), _labelled_sum(latency)),
+        ("gemini_proxy_key_error_rate_ewma", "gauge", "Recent error rate of the key for the model (EWMA of 429/5xx/failed attempts).", ("key", "model"), _labelled_sum(error_rate)),
+        ("gemini_proxy_key_in_flight", "gauge", "Upstream attempts in flight with the key for the model.", ("key", "model"), _labelled_sum(in_flight)),
+    ]
+
+@metrics_registry.add_collector
+def collect_feature_metrics():
+    pool = upstream_pool_stats.snapshot()
+    pacer = rate_pacer.snapshot()
+    cache = response_cache.snapshot()
+    coalescing = request_coalescer.snapshot()
+    hedging = hedge_policy.snapshot()
+    context_caching = context_cache.snapshot()
+    embeddings = embedding_batcher.snapshot()
+    admission = admission_controller.snapshot()
+    retrying = retry_policy.snapshot()
+    breakers = circuit_breakers.snapshot()
+    compression = compression_stats.snapshot()
+    return [
+        ("gemini_proxy_upstream_pool_requests_total", "counter", "Requests sent through the pooled upstream client (sync engine).", (), [((), pool["requests"])]),
+        ("gemini_proxy_upstream_pool_new_connections_total", "counter", "New upstream connections opened.", (), [((), pool["new_connections"])]),
+        ("gemini_proxy_upstream_pool_tls_handshakes_total", "counter", "TLS handshakes with the upstream.", (), [((), pool["tls_handshakes"])]),
+        ("gemini_proxy_upstream_pool_in_use", "gauge", "Upstream connections currently checked out.", (), [((), pool["in_use"])]),
+        ("gemini_proxy_upstream_pool_size", "gauge", "Maximum number of pooled upstream connections per host.", (), [((), pool["pool_size"])]),
+        ("gemini_proxy_upstream_pool_saturation_total", "counter", "Checkouts that found every pooled connection busy.", (), [((), pool["saturation_events"])]),
+        ("gemini_proxy_upstream_pool_saturation_wait_seconds_total", "counter", "Time spent waiting for a free pooled connection.", (), [((), pool["saturation_wait_seconds"])]),
+        ("gemini_proxy_pacing_skipped_keys_total", "counter", "Keys skipped because they were over their local rate limits.", (), [((), pacer["paced_skips"])]),
+        ("gemini_proxy_pacing_rejections_total", "counter", "Requests rejected locally because every key was over its rate limits.", (), [((), pacer["paced_rejections"])]),
+        ("gemini_proxy_cache_entries", "gauge", "Responses in the response cache.", (), [((), cache["entries"])]),
+        ("gemini_proxy_cache_bytes", "gauge", "Size of the cached response bodies.", (), [((), cache["bytes"])]),
+        ("gemini_proxy_cache_hits_total", "counter", "Requests answered from the response cache.", (), [((), cache["hits"])]),
+        ("gemini_proxy_cache_misses_total", "counter", "Cacheable requests not found in the response cache.", (), [((), cache["misses"])]),
+        ("gemini_proxy_cache_bypasses_total", "counter", "Cacheable-endpoint requests not looked up in the cache (sampling, Cache-Control: no-cache/no-store, or an unparsable body).", (), [((), cache["bypasses"])]),
+        ("gemini_proxy_cache_evictions_total", "counter", "Responses evicted from the cache to stay within its limits.", (), [((), cache["evictions"])]),
+        ("gemini_proxy_cache_saved_tokens_total", "counter", "Tokens not spent upstream thanks to cache hits.", (), [((), cache["saved_tokens"])]),
+        ("gemini_proxy_cache_saved_requests_total", "counter", "Upstream requests saved by cache hits.", ("model",), [((model,), count) for model, count in cache["saved_requests"].items()]),
+        ("gemini_proxy_coalescing_in_flight", "gauge", "Upstream calls that identical requests can currently join.", (), [((), coalescing["in_flight"])]),
+        ("gemini_proxy_coalescing_followers_total", "counter", "Requests that joined an identical in-flight request.", (), [((), coalescing["followers"])]),
+        ("gemini_proxy_coalescing_abandoned_total", "counter", "Joined requests whose shared call got no response, so they were sent on their own.", (), [((), coalescing["abandoned"])]),
+        ("gemini_proxy_coalescing_saved_requests_total", "counter", "Upstream requests saved by coalescing.", ("model",), [((model,), count) for model, count in coalescing["saved_requests"].items()]),
+        ("gemini_proxy_hedging_requests_total", "counter", "Non-streaming requests eligible for hedging.", (), [((), hedging["requests"])]),
+        ("gemini_proxy_hedges_total", "counter", "Duplicate attempts sent by hedging.", (), [((), hedging["hedges"])]),
+        ("gemini_proxy_hedge_wins_total", "counter", "Hedged requests answered first by the duplicate attempt.", (), [((), hedging["hedge_wins"])]),
+        ("gemini_proxy_hedge_budget_denials_total", "counter", "Hedges not sent because the hedge budget was used up.", (), [((), hedging["budget_denials"])]),
+        ("gemini_proxy_context_cache_entries", "gauge", "Upstream context caches (per key and prompt prefix) in use.", (), [((), context_caching["entries"])]),
+        ("gemini_proxy_context_cache_requests_total", "counter", "OpenAI requests with a prompt prefix large enough to cache.", (), [((), context_caching["requests"])]),
+        ("gemini_proxy_context_cache_hits_total", "counter", "Requests sent referencing a context cache.", (), [((), context_caching["hits"])]),
+        ("gemini_proxy_context_cache_saved_prompt_tokens_total", "counter", "Prompt tokens not resent thanks to context caches.", (), [((), context_caching["saved_tokens"])]),
+        ("gemini_proxy_context_cache_created_total", "counter", "Context caches created upstream.", (), [((), context_caching["created"])]),
+        ("gemini_proxy_context_cache_creation_failures_total", "counter", "Context cache creations that failed.", (), [((), context_caching["creation_failures"])]),
+        ("gemini_proxy_context_cache_refreshes_total", "counter", "Context cache lifetimes extended.", (), [((), context_caching["refreshes"])]),
+        ("gemini_proxy_context_cache_invalidations_total", "counter", "Referenced context caches found gone upstream.", (), [((), context_caching["invalidations"])]),
+        ("gemini_proxy_embedding_requests_total", "counter", "OpenAI embeddings requests.", (), [((), embeddings["requests"])]),
+        ("gemini_proxy_embedding_inputs_total", "counter", "Texts embedded for OpenAI embeddings requests.", (), [((), embeddings["inputs"])]),
+        ("gemini_proxy_embedding_batches_total", "counter", "Upstream batchEmbedContents calls made for OpenAI embeddings requests.", (), [((), embeddings["batches"])]),
+        ("gemini_proxy_embedding_full_batches_total", "counter", "Embedding batches sent full, before their batching window ended.", (), [((), embeddings["full_batches"])]),
+        ("gemini_proxy_admission_active", "gauge", "Upstream calls admitted by admission control and still in progress.", (), [((), admission["active"])]),
+        ("gemini_proxy_admission_queue_depth", "gauge", "Requests waiting in the admission queue.", (), [((), admission["queue_depth"])]),
+        ("gemini_proxy_admission_admitted_total", "counter", "Upstream calls admitted by admission control.", (), [((), admission["admitted"])]),
+        ("gemini_proxy_admission_queued_total", "counter", "Requests that waited in the admission queue.", (), [((), admission["queued"])]),
+        ("gemini_proxy_admission_rejections_total", "counter", "Requests rejected by admission control.", ("reason",), [(("queue_full",), admission["queue_full_rejections"]), (("timeout",), admission["timeouts"])]),
+        ("gemini_proxy_retries_total", "counter", "Requests retried on another key after a transient failure, by reason.", ("reason",), [((reason,), count) for reason, count in retrying["retries"].items()]),
+        ("gemini_proxy_retries_exhausted_total", "counter", "Transient failures returned to the client (no retry or deadline left).", (), [((), retrying["exhausted"])]),
+        ("gemini_proxy_circuit_breakers_open", "gauge", "Keys out of rotation because of their circuit breaker.", (), [((), breakers["open"])]),
+        ("gemini_proxy_circuit_breaker_opened_total", "counter", "Times a key's circuit breaker opened.", (), [((), breakers["opened"])]),
+        ("gemini_proxy_circuit_breaker_recovered_total", "counter", "Times a key's circuit breaker closed again after a successful trial.", (), [((), breakers["recovered"])]),
+        ("gemini_proxy_compression_responses_total", "counter", "Responses sent compressed: gzip compressed by the proxy, or relayed still encoded from upstream.", ("mode",), [(("compressed",), compression["compressed_responses"]), (("passthrough",), compression["passthrough_responses"])]),
+        ("gemini_proxy_compression_passthrough_bytes_total", "counter", "Upstream response bytes relayed to clients still encoded.", (), [((), compression["passthrough_bytes"])]),
+        ("gemini_proxy_compression_requests_total", "counter", "Request bodies gzip compressed for the upstream.", (), [((), compression["compressed_requests"])]),
+        ("gemini_proxy_compression_saved_bytes_total", "counter", "Bytes not transferred thanks to compression (passthrough: gzip bodies only).", ("direction",), [(("response",), compression["response_saved_bytes"]), (("passthrough",), compression["passthrough_saved_bytes"]), (("request",), compression["request_saved_bytes"])]),
+        ("gemini_proxy_log_records_dropped_total", "counter", "Log records dropped because the log queue was full.", (), [((), log_handler.dropped if log_handler else 0)]),
+    ]
+
+# --- Tracing ---
+# Per-request phase timings. With TRACING_ENABLED every request gets a RequestTrace: the
+# phases finished before the response headers are sent go into a Server-Timing header, and
+# sampled requests are exported as spans once their response has been sent (a root span plus
+# one child span per upstream attempt, so retries on other keys and hedges show up).
+
+# Phases in the order they appear in the Server-Timing header
+TRACE_PHASES = ("parse", "convert_request", "key_select", "upstream", "filter", "convert_response")
+
+def _otlp_attributes(attributes):
+    """Converts {name: value} into the OTLP JSON attribute list."""
+    converted = []
+    for name, value in attributes.items():
+        if isinstance(value, bool):
+            otlp_value = {"boolValue": value}
+        elif isinstance(value, int):
+            otlp_value = {"intValue": str(value)}
+        elif isinstance(value, float):
+            otlp_value = {"doubleValue": value}
+        else:
+            otlp_value = {"stringValue": str(value)}
+        converted.append({"key": name, "value": otlp_value})
+    return converted
+
+def _unix_nanos(timestamp):
+    return str(int(timestamp * 1e9))
+
+def parse_traceparent(value):
+    """Parses a W3C traceparent header into (trace id, parent span id, sampled), or None if absent or invalid."""
+    parts = value.strip().split('-') if value else ()
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or len(parts[3]) != 2:
+        return None
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return parts[1].lower(), parts[2].lower(), bool(flags & 1)
+
+class RequestTrace:
+    """Phase timings and upstream attempt spans of one request."""
+
+    def __init__(self, start_time, attributes, traceparent=None):
+        parent = parse_traceparent(traceparent)
+        if parent is not None:
+            self.trace_id, self.parent_span_id, parent_sampled = parent
+        else:
+            self.trace_id, self.parent_span_id, parent_sampled = f"{random.getrandbits(128):032x}", None, False
+        self.span_id = f"{random.getrandbits(64):016x}"
+        # A caller that samples its own trace raises the rate, but only up to TRACING_PARENT_SAMPLE_RATE
+        sample_rate = max(TRACING_SAMPLE_RATE, TRACING_PARENT_SAMPLE_RATE) if parent_sampled else TRACING_SAMPLE_RATE
+        self.sampled = random.random() < sample_rate
+        self.start_time = start_time
+        self.attributes = attributes
+        self.phases = {} # {phase: seconds}, summed over retries
+        self.attempt_spans = []
+        self.status_code = None
+        self.finished = False
+
+    def add_phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def add_attempt(self, api_key, started, status_code=None, error=None):
+        """Records an upstream attempt that began at `started` (time.time()) and just ended as a child span."""
+        if not self.sampled:
+            return
+        attributes = {"gemini.key": key_label(api_key), "gemini.attempt": len(self.attempt_spans) + 1}
+        if status_code is not None:
+            attributes["http.response.status_code"] = status_code
+        if error is not None:
+            attributes["error.type"] = error
+        failed = error is not None or status_code == 429 or (status_code or 0) >= 500
+        # list.append is atomic, so the concurrent attempts of a hedged request may record themselves
+        self.attempt_spans.append({
+            "traceId": self.trace_id, "spanId": f"{random.getrandbits(64):016x}", "parentSpanId": self.span_id,
+            "name": "upstream_attempt", "kind": 3, # SPAN_KIND_CLIENT
+            "startTimeUnixNano": _unix_nanos(started), "endTimeUnixNano": _unix_nanos(time.time()),
+            "attributes": _otlp_attributes(attributes), "status": {"code": 2 if failed else 0},
+        })
+
+    def server_timing(self):
+        """Returns the Server-Timing header value for the phases so far (durations in milliseconds)."""
+        metrics = [f"{name};dur={self.phases[name] * 1000:.3f}" for name in TRACE_PHASES if name in self.phases]
+        metrics.append(f"total;dur={(time.time() - self.start_time) * 1000:.3f}")
+        return ", ".join(metrics)
+
+    def finish(self):
+        """Ends the request; a sampled trace is queued for export. Later calls do nothing."""
+        if self.finished:
+            return
+        self.finished = True
+        if not self.sampled:
+            return
+        attributes = dict(self.attributes)
+        if self.status_code is not None:
+            attributes["http.response.status_code"] = self.status_code
+        for name, seconds in self.phases.items():
+            attributes[f"proxy.phase.{name}_ms"] = round(seconds * 1000, 3)
+        root = {
+            "traceId": self.trace_id, "spanId": self.span_id,
+            "name": "proxy_request", "kind": 2, # SPAN_KIND_SERVER
+            "startTimeUnixNano": _unix_nanos(self.start_time), "endTimeUnixNano": _unix_nanos(time.time()),
+            "attributes": _otlp_attributes(attributes), "status": {"code": 2 if (self.status_code or 0) >= 500 else 0},
+        }
+        if self.parent_span_id:
+            root["parentSpanId"] = self.parent_span_id
+        span_export_queue.submit([root] + self.attempt_spans)
+
+class _NullTrace:
+    """Stands in for RequestTrace while tracing is disabled."""
+    sampled = False
+    finished = True
+    status_code = None
+
+    def add_phase(self, name, seconds):
+        pass
+
+    def add_attempt(self, api_key, started, status_code=None, error=None):
+        pass
+
+    def server_timing(self):
+        return None
+
+    def finish(self):
+        pass
+
+NULL_TRACE = _NullTrace()
+
+def start_trace(proxy_req, traceparent=None):
+    """Returns the trace of `proxy_req` (NULL_TRACE if tracing is disabled)."""
+    if not TRACING_ENABLED:
+        return NULL_TRACE
+    attributes = {
+        "http.request.method": proxy_req.method, "url.path": "/" + proxy_req.path,
+        "gemini.model": proxy_req.model, "proxy.api": api_label(proxy_req.is_openai_format),
+        "proxy.request_id": request_id_var.get(),
+    }
+    return RequestTrace(proxy_req.start_time, attributes, traceparent)
+
+def response_headers_ready(proxy_req, status_code, streamed):
+    """
+    Called once the response to `proxy_req` is ready to be sent. Returns the Server-Timing
+    header value, or None. A buffered response ends the trace here, a streamed one once the
+    stream is done (see metered_stream()).
+    """
+    trace = proxy_req.trace
+    trace.status_code = status_code
+    server_timing = trace.server_timing() if TRACING_SERVER_TIMING else None
+    if not streamed:
+        trace.finish()
+    return server_timing
+
+class FileSpanExporter:
+    """
+    Appends spans to TRACING_FILE (in LOG_DIRECTORY), one OTLP JSON span per line. Like the log
+    file, it is rotated at TRACING_FILE_MAX_BYTES, keeping TRACING_FILE_BACKUP_COUNT old files.
+    """
+
+    def __init__(self):
+        self.path = os.path.join(LOG_DIRECTORY, TRACING_FILE)
+
+    def _rotate(self):
+        # Same scheme as RotatingFileHandler: traces.jsonl.1 is the newest old file
+        for index in range(TRACING_FILE_BACKUP_COUNT - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if TRACING_FILE_BACKUP_COUNT > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def export(self, spans):
+        data = "".join(json.dumps(span) + "\n" for span in spans)
+        try:
+            size = os.path.getsize(self.path)
+        except OSError: # Not created yet (or rotated away by another worker)
+            size = 0
+        if size and TRACING_FILE_MAX_BYTES > 0 and size + len(data) > TRACING_FILE_MAX_BYTES:
+            try:
+                self._rotate()
+            except FileNotFoundError: # Another worker rotated it first
+                pass
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(data)
+
+class OTLPJSONSpanExporter:
+    """Posts spans to an OTLP/HTTP collector (JSON encoding) at TRACING_OTLP_ENDPOINT."""
+
+    def __init__(self):
+        self.session = requests.Session() # Not the upstream pool: exports must not take Gemini connections
+        self.resource = {"attributes": _otlp_attributes({"service.name": TRACING_SERVICE_NAME})}
+
+    def export(self, spans):
+        payload = {"resourceSpans": [{
+            "resource": self.resource,
+            "scopeSpans": [{"scope": {"name": "gemini_key_manager"}, "spans": spans}],
+        }]}
+        resp = self.session.post(TRACING_OTLP_ENDPOINT, json=payload, timeout=10)
+        if resp.status_code >= 400:
+            logging.warning(f"OTLP collector rejected {len(spans)} spans: {resp.status_code} {resp.text[:200]}")
+
+# Span exporters selectable with TRACING_EXPORTER; each exports a list of OTLP JSON spans
+SPAN_EXPORTERS = {
+    "file": FileSpanExporter,
+    "otlp": OTLPJSONSpanExporter,
+}
+
+class SpanExportQueue:
+    """
+    Exports finished traces from a background thread in batches of TRACING_EXPORT_BATCH_SIZE
+    spans, at least every TRACING_EXPORT_INTERVAL seconds, so exporting never delays a
+    response. Spans beyond TRACING_MAX_QUEUED_SPANS are dropped (and counted).
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._spans = []
+        self._stopping = False
+        self._thread = None
+        self._owner_pid = None
+        self._atexit_registered = False
+        self._exporter = None
+        self.exported = 0
+        self.dropped = 0
+
+    def _ensure_started(self):
+        # Caller holds self._condition. Threads do not survive fork(), so each worker starts its own.
+        if self._thread is not None and self._owner_pid == os.getpid():
+            return
+        self._owner_pid = os.getpid()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+        self._thread.start()
+        if not self._atexit_registered:
+            atexit.register(self.stop)
+            self._atexit_registered = True
+
+    def submit(self, spans):
+        with self._condition:
+            self._ensure_started()
+            if len(self._spans) + len(spans) > TRACING_MAX_QUEUED_SPANS:
+                self.dropped += len(spans)
+                return
+            self._spans.extend(spans)
+            if len(self._spans) >= TRACING_EXPORT_BATCH_SIZE:
+                self._condition.notify()
+
+    def _get_exporter(self):
+        if self._exporter is None:
+            exporter_class = SPAN_EXPORTERS.get(TRACING_EXPORTER)
+            if exporter_class is None:
+                logging.warning(f"Unknown TRACING_EXPORTER '{TRACING_EXPORTER}', using 'file'. Available: {', '.join(SPAN_EXPORTERS)}")
+                exporter_class = FileSpanExporter
+            self._exporter = exporter_class()
+        return self._exporter
+
+    def _export(self, spans):
+        for start in range(0, len(spans), TRACING_EXPORT_BATCH_SIZE):
+            batch = spans[start:start + TRACING_EXPORT_BATCH_SIZE]
+            try:
+                self._get_exporter().export(batch)
+                self.exported += len(batch)
+            except Exception as e:
+                logging.error(f"Failed to export {len(batch)} spans with the '{TRACING_EXPORTER}' exporter: {e}")
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: len(self._spans) >= TRACING_EXPORT_BATCH_SIZE or self._stopping, timeout=TRACING_EXPORT_INTERVAL)
+                spans, self._spans = self._spans, []
+                stopping = self._stopping
+            if spans:
+                self._export(spans)
+            if stopping:
+                return
+
+    def stop(self):
+        """Stops the background exporter after exporting everything still queued."""
+        with self._condition:
+            thread = self._thread
+            if thread is None or self._owner_pid != os.getpid():
+                return
+            self._stopping = True
+            self._condition.notify()
+        thread.join(timeout=15)
+        self._thread = None
+        if self.dropped:
+            logging.warning(f"Tracing: {self.dropped} spans were dropped because the export queue was full.")
+
+span_export_queue = SpanExportQueue()
+
+# --- Helper Functions ---
+
+# Headers that only apply to a single connection (RFC 7230, section 6.1), plus Content-Length
+# which the upstream client recomputes for the body it actually sends
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-connection', 'proxy-authorization',
+                      'te', 'trailer', 'transfer-encoding', 'upgrade', 'content-length'}
+
+def is_openai_chat_request(path):
+    """Checks if the request path matches the OpenAI chat completions endpoint."""
+    return path.strip('/') == "v1/chat/completions"
+
+def is_openai_embeddings_request(path):
+    """Checks if the request path matches the OpenAI embeddings endpoint."""
+    return path.strip('/') == "v1/embeddings"
+
+def convert_openai_embedding_input(model, text, dimensions=None):
+    """Converts one OpenAI embeddings input to a Gemini EmbedContentRequest."""
+    embed_request = {"model": f"models/{model}", "content": {"parts": [{"text": text}]}}
+    if dimensions:
+        embed_request["outputDimensionality"] = dimensions
+    return embed_request
+
+def convert_gemini_embeddings_to_openai(embeddings, model, prompt_tokens, encoding_format=None):
+    """Converts Gemini embedding values to an OpenAI embeddings response body (bytes)."""
+    data = []
+    for index, values in enumerate(embeddings):
+        if encoding_format == "base64":
+            # Little-endian float32 values, as returned by the OpenAI API
+            values = base64.b64encode(struct.pack(f"<{len(values)}f", *values)).decode('ascii')
+        data.append({"object": "embedding", "index": index, "embedding": values})
+    # Gemini does not report token counts for embeddings, the usage is estimated
+    usage = {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens}
+    return json_dumps({"object": "list", "data": data, "model": model, "usage": usage})
+
+def convert_openai_to_gemini_request(openai_data):
+    """Converts OpenAI request JSON to Gemini request JSON."""
+    gemini_request = {"contents": [], "generationConfig": {}, "safetySettings": []}
+    target_model = "gemini-pro" # Default model, can be overridden
+
+    # --- Model Mapping (Simple: Use OpenAI model name directly for now) ---
+    # A more robust solution might involve explicit mapping or configuration
+    if "model" in openai_data:
+        # Assuming the model name provided is Gemini-compatible
+        # Remove potential prefix like "openai/" if present
+        target_model = openai_data["model"].split('/')[-1]
+        logging.debug("Using model from OpenAI request: %s", target_model)
+        # We won't put the model in the Gemini request body, it's part of the URL
+
+    # --- Message Conversion ---
+    system_prompt = None
+    gemini_contents = []
+    for message in openai_data.get("messages", []):
+        role = message.get("role")
+        content = message.get("content")
+
+        if not content: # Skip messages without content
+             continue
+
+        # Handle system prompt separately
+        if role == "system":
+            if isinstance(content, str):
+                 system_prompt = {"role": "system", "parts": [{"text": content}]}
+            # Note: Gemini API might prefer system prompt at the start or via specific field
+            continue # Don't add system prompt directly to contents here
+
+        # Map roles
+        gemini_role = "user" if role == "user" else "model" # Treat 'assistant' as 'model'
+
+        # Ensure content is in the correct parts format
+        if isinstance(content, str):
+            # Simple string content
+            gemini_contents.append({"role": gemini_role, "parts": [{"text": content}]})
+        elif isinstance(content, list):
+            # Handle list of parts (like from multimodal requests or specific clients)
+            combined_text = ""
+            # TODO: Handle non-text parts if necessary (e.g., images)
+            for part in content:
+                if isinstance(part, dict) and part.get("type") == "text":
+                    combined_text += part.get("text", "")
+            if combined_text: # Only add if we extracted some text
+                 gemini_contents.append({"role": gemini_role, "parts": [{"text": combined_text}]})
+            else:
+                 logging.warning(f"Message with role '{role}' had list content, but no text parts found: {content}")
+        else:
+             logging.warning(f"Unsupported content type for role '{role}': {type(content)}")
+
+    # Add system prompt if found (Gemini prefers it at the start or via systemInstruction)
+    # Let's try adding it via systemInstruction if present
+    if system_prompt:
+         gemini_request["systemInstruction"] = system_prompt
+         # Alternatively, prepend to contents: gemini_contents.insert(0, system_prompt)
+
+    gemini_request["contents"] = gemini_contents
+
+
+    # --- Generation Config Mapping ---
+    if "temperature" in openai_data:
+        gemini_request["generationConfig"]["temperature"] = openai_data["temperature"]
+    if "max_tokens" in openai_data:
+        gemini_request["generationConfig"]["maxOutputTokens"] = openai_data["max_tokens"]
+    if "stop" in openai_data:
+        # Gemini expects `stopSequences` which is an array of strings
+        stop_sequences = openai_data["stop"]
+        if isinstance(stop_sequences, str):
+            gemini_request["generationConfig"]["stopSequences"] = [stop_sequences]
+        elif isinstance(stop_sequences, list):
+            gemini_request["generationConfig"]["stopSequences"] = stop_sequences
+    # Add other mappings as needed (topP, topK etc.)
+    if "top_p" in openai_data:
+         gemini_request["generationConfig"]["topP"] = openai_data["top_p"]
+    # if "top_k" in openai_data: gemini_request["generationConfig"]["topK"] = openai_data["top_k"] # Map if needed
+
+    # --- Safety Settings (Optional: Default to BLOCK_NONE for compatibility) ---
+    # You might want to make this configurable or map from OpenAI safety params if they existed
+    gemini_request["safetySettings"] = [
+        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+    ]
+
+    # --- Streaming ---
+    # The actual Gemini endpoint URL will determine streaming, not a body parameter
+    is_streaming = openai_data.get("stream", False)
+
+    return gemini_request, target_model, is_streaming
+
+def map_gemini_finish_reason(gemini_finish_reason):
+    """Maps a Gemini finishReason to the closest OpenAI finish_reason."""
+    if gemini_finish_reason == "MAX_TOKENS":
+        return "length"
+    if gemini_finish_reason in ("SAFETY", "RECITATION", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII"):
+        return "content_filter"
+    return "stop"
+
+def map_gemini_usage(usage_metadata):
+    """Maps Gemini usageMetadata to an OpenAI usage object."""
+    usage = {
+        "prompt_tokens": usage_metadata.get("promptTokenCount", 0),
+        "completion_tokens": usage_metadata.get("candidatesTokenCount", 0),
+        "total_tokens": usage_metadata.get("totalTokenCount", 0)
+    }
+    if usage_metadata.get("cachedContentTokenCount"): # Prompt tokens read from a context cache
+        usage["prompt_tokens_details"] = {"cached_tokens": usage_metadata["cachedContentTokenCount"]}
+    return usage
+
+def extract_candidate_text(candidate):
+    """Concatenates the text parts of a Gemini candidate, skipping thought summaries."""
+    parts = candidate.get("content", {}).get("parts") or []
+    return "".join(part.get("text", "") for part in parts if isinstance(part, dict) and not part.get("thought"))
+
+class SSEParser:
+    """
+    Incremental Server-Sent Events parser. feed() takes raw bytes and returns the data
+    payload (bytes) of every event completed by them. Only the current, incomplete event
+    is buffered, so memory stays bounded by the size of a single event.
+    """
+
+    def __init__(self, max_event_bytes=None):
+        self.max_event_bytes = max_event_bytes or SSE_MAX_EVENT_BYTES
+        self._buffer = bytearray()
+        self._data_lines = []
+        self._event_size = 0
+
+    def _add_data_line(self, line):
+        value = line[5:]
+        self._data_lines.append(value[1:] if value.startswith(b" ") else value)
+        self._event_size += len(value)
+
+    def feed(self, chunk):
+        events = []
+        self._buffer += chunk
+        line_start = 0
+        while True:
+            newline = self._buffer.find(b"\n", line_start)
+            if newline == -1:
+                break
+            line = bytes(self._buffer[line_start:newline]).rstrip(b"\r")
+            line_start = newline + 1
+            if not line: # A blank line terminates the event
+                if self._data_lines:
+                    events.append(b"\n".join(self._data_lines))
+                    self._data_lines = []
+                    self._event_size = 0
+            elif line.startswith(b"data:"):
+                self._add_data_line(line)
+            elif not line.startswith(b":"): # Lines starting with ':' are SSE comments
+                logging.warning(f"Ignoring non-SSE line in upstream stream: {line[:500].decode('utf-8', errors='replace')}")
+        del self._buffer[:line_start]
+        if self._event_size + len(self._buffer) > self.max_event_bytes:
+            raise ValueError(f"Upstream SSE event exceeded {self.max_event_bytes} bytes.")
+        return events
+
+    def finish(self):
+        """Returns a final event that was not terminated by a blank line, if any."""
+        line = bytes(self._buffer).rstrip(b"\r\n")
+        self._buffer.clear()
+        if line.startswith(b"data:"):
+            self._add_data_line(line)
+        events = [b"\n".join(self._data_lines)] if self._data_lines else []
+        self._data_lines = []
+        return events
+
+def format_sse_event(payload):
+    """Serializes a JSON-compatible object as a single SSE 'data:' event."""
+    return b"data: " + json_dumps(payload) + b"\n\n"
+
+class GeminiToOpenAIStreamConverter:
+    """
+    Translates Gemini streamGenerateContent chunks into OpenAI chat.completion.chunk
+    objects one chunk at a time, remembering the finish reason and usage for the final chunk.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.completion_id = f"chatcmpl-{uuid.uuid4()}"
+        self.created = int(time.time())
+        self.finish_reason = None
+        self.usage = None
+        self.content_chunks = 0
+
+    def _chunk(self, delta, finish_reason=None):
+        return {
+            "id": self.completion_id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": self.model,
+            "choices": [{
+                "index": 0,
+                "delta": delta,
+                "finish_reason": finish_reason
+            }]
+        }
+
+    def convert(self, gemini_chunk):
+        """Returns the OpenAI chunks (possibly none) for one Gemini response chunk."""
+        if gemini_chunk.get("usageMetadata"):
+            self.usage = map_gemini_usage(gemini_chunk["usageMetadata"])
+        if gemini_chunk.get("promptFeedback", {}).get("blockReason"):
+            self.finish_reason = "content_filter"
+
+        candidates = gemini_chunk.get("candidates") or []
+        if not candidates:
+            return []
+        candidate = candidates[0]
+        if candidate.get("finishReason"):
+            self.finish_reason = map_gemini_finish_reason(candidate["finishReason"])
+        text_content = extract_candidate_text(candidate)
+        if not text_content: # Only emit chunks that carry content
+            return []
+        delta = {"content": text_content}
+        if self.content_chunks == 0:
+            delta = {"role": "assistant", "content": text_content}
+        self.content_chunks += 1
+        return [self._chunk(delta)]
+
+    def final_chunk(self):
+        """Returns the closing chunk carrying finish_reason and usage."""
+        chunk = self._chunk({}, self.finish_reason or "stop")
+        if self.usage:
+            chunk["usage"] = self.usage
+        return chunk
+
+def is_google_error_json(payload):
+    """Checks whether a parsed JSON value has the Google API error structure."""
+    return (isinstance(payload, dict) and isinstance(payload.get('error'), dict)
+            and 'code' in payload['error'] and 'status' in payload['error'])
+
+class TrailingErrorFilter:
+    """
+    Streaming filter that removes a Google API error JSON appended after a successful
+    (200) response body. Only the bytes from the last '\\n{' onwards (at most
+    TRAILING_ERROR_WINDOW_BYTES) are held back, everything before them is released
+    immediately, so memory stays constant and SSE events are not delayed.
+    """
+
+    def __init__(self, window_bytes=None):
+        self.window_bytes = window_bytes or TRAILING_ERROR_WINDOW_BYTES
+        self.filtered_error = None
+        self._pending = bytearray()
+        self._emitted = False
+        self._last_emitted_byte = b""
+
+    def _preceding_byte(self, index):
+        """Returns the last non-whitespace byte before `index`, looking into already released data."""
+        before = bytes(self._pending[:index]).rstrip()
+        return before[-1:] if before else self._last_emitted_byte
+
+    def feed(self, chunk):
+        """Adds upstream bytes and returns the part that can be sent to the client now."""
+        self._pending += chunk
+        hold_from = len(self._pending)
+        if self._pending.endswith(b"\n"):
+            hold_from -= 1 # The '{' of a '\n{' may arrive in the next chunk
+        block_start = self._pending.rfind(b"\n{")
+        # Blocks preceded by ',' are elements of a JSON array stream, not a trailing error
+        if block_start != -1 and self._preceding_byte(block_start) != b",":
+            hold_from = min(hold_from, block_start)
+        # An error object never gets this large, so older bytes can be released
+        hold_from = max(hold_from, len(self._pending) - self.window_bytes)
+        if hold_from <= 0:
+            return b""
+        released = bytes(self._pending[:hold_from])
+        del self._pending[:hold_from]
+        self._emitted = True
+        stripped = released.rstrip()
+        if stripped:
+            self._last_emitted_byte = stripped[-1:]
+        return released
+
+    def finish(self):
+        """Returns the held-back tail, without the trailing error JSON if one was found."""
+        tail = bytes(self._pending)
+        self._pending.clear()
+        stripped = tail.rstrip()
+        if not stripped.endswith(b"}"):
+            return tail
+        block_start = stripped.rfind(b"\n{")
+        if not self._emitted and not stripped[:block_start].strip():
+            block_start = -1 # The whole body is a single JSON object, not a trailing block
+        if block_start == -1:
+            logging.debug("Could not find a potential start ('\\n{') for a JSON block at the end.")
+            return tail
+        potential_error_json = stripped[block_start:].strip()
+        try:
+            error_json = json_loads(potential_error_json)
+        except ValueError:
+            logging.debug("String at end ending with '}' is not valid JSON.")
+            return tail
+        if not is_google_error_json(error_json):
+            logging.debug("Potential JSON at end doesn't match Google error structure.")
+            return tail
+        logging.warning(f"Detected and filtering out trailing Google API error JSON: {potential_error_json.decode('utf-8', errors='replace')}")
+        self.filtered_error = error_json
+        valid_content = stripped[:block_start].rstrip()
+        # Add back trailing newlines for SSE format consistency
+        return valid_content + b"\n\n" if (valid_content or self._emitted) else b""
+
+def filter_trailing_error(content):
+    """Applies the trailing Google API error filter to a fully buffered response body."""
+    error_filter = TrailingErrorFilter(window_bytes=max(len(content), 1))
+    return error_filter.feed(content) + error_filter.finish()
+
+def relay_upstream_response(upstream_resp, apply_error_filter, key_suffix, sink=None):
+    """
+    Generator relaying an upstream response body to the client chunk by chunk,
+    optionally through the TrailingErrorFilter. Closes the upstream response when done.
+    If a response `sink` is given, it receives the relayed body (see ResponseCacheFill).
+    """
+    error_filter = TrailingErrorFilter() if apply_error_filter else None
+    start_time = time.time()
+    first_byte_time = None
+    bytes_sent = 0
+    try:
+        for chunk in upstream_resp.iter_content(STREAM_READ_CHUNK_SIZE):
+            data = error_filter.feed(chunk) if error_filter else chunk
+            if data:
+                if first_byte_time is None:
+                    first_byte_time = time.time()
+                bytes_sent += len(data)
+                if sink:
+                    sink.add(data)
+                yield data
+        if error_filter:
+            tail = error_filter.finish()
+            if tail:
+                bytes_sent += len(tail)
+                if sink:
+                    sink.add(tail)
+                yield tail
+        if sink and not (error_filter and error_filter.filtered_error):
+            sink.commit()
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Error while relaying upstream response with key ...{key_suffix}: {e}")
+    finally:
+        upstream_resp.close()
+        if sink:
+            sink.close()
+    first_byte = f"{first_byte_time - start_time:.3f}s" if first_byte_time else "n/a"
+    logging.info(f"Relayed {bytes_sent} bytes to client with key ...{key_suffix}. First byte after {first_byte}, total {time.time() - start_time:.3f}s")
+
+# --- Compression ---
+# Content encodings asked of (and decodable from) the upstream: brotli needs `pip install brotli`
+UPSTREAM_CONTENT_ENCODINGS = ("gzip", "br") if any(importlib.util.find_spec(name) for name in ("brotli", "brotlicffi")) else ("gzip",)
+UPSTREAM_ACCEPT_ENCODING = ", ".join(UPSTREAM_CONTENT_ENCODINGS)
+# Media types worth compressing (besides text/* and */*+json)
+COMPRESSIBLE_CONTENT_TYPES = ("application/json", "application/x-ndjson", "application/javascript")
+
+class CompressionStats:
+    """Thread-safe counters of the bytes saved by compression, for each place it happens."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.compressed_responses = 0 # Responses gzip compressed for the client
+        self.response_bytes = 0
+        self.response_compressed_bytes = 0
+        self.passthrough_responses = 0 # Upstream responses relayed to the client still encoded
+        self.passthrough_bytes = 0
+        self.passthrough_saved_bytes = 0 # Known from the size in the gzip trailer (not for brotli)
+        self.compressed_requests = 0 # Request bodies gzip compressed for the upstream
+        self.request_bytes = 0
+        self.request_compressed_bytes = 0
+        self._last_log_time = time.time()
+
+    def record_response(self, size, compressed_size):
+        with self._lock:
+            self.compressed_responses += 1
+            self.response_bytes += size
+            self.response_compressed_bytes += compressed_size
+        self.maybe_log()
+
+    def record_passthrough(self, encoded_size, decoded_size=None):
+        with self._lock:
+            self.passthrough_responses += 1
+            self.passthrough_bytes += encoded_size
+            if decoded_size is not None:
+                self.passthrough_saved_bytes += max(0, decoded_size - encoded_size)
+        self.maybe_log()
+
+    def record_request(self, size, compressed_size):
+        with self._lock:
+            self.compressed_requests += 1
+            self.request_bytes += size
+            self.request_compressed_bytes += compressed_size
+        self.maybe_log()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "compressed_responses": self.compressed_responses,
+                "response_saved_bytes": self.response_bytes - self.response_compressed_bytes,
+                "response_bytes": self.response_bytes,
+                "response_compressed_bytes": self.response_compressed_bytes,
+                "passthrough_responses": self.passthrough_responses,
+                "passthrough_bytes": self.passthrough_bytes,
+                "passthrough_saved_bytes": self.passthrough_saved_bytes,
+                "compressed_requests": self.compressed_requests,
+                "request_saved_bytes": self.request_bytes - self.request_compressed_bytes,
+            }
+
+    def maybe_log(self, force=False):
+        """Logs a compression summary at most once every COMPRESSION_STATS_LOG_INTERVAL seconds."""
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_log_time < COMPRESSION_STATS_LOG_INTERVAL:
+                return
+            self._last_log_time = now
+        stats = self.snapshot()
+        if not (stats["compressed_responses"] or stats["passthrough_responses"] or stats["compressed_requests"]):
+            return
+        ratio = stats["response_compressed_bytes"] / max(1, stats["response_bytes"])
+        logging.info(
+            f"Compression: {stats['compressed_responses']} responses compressed to {ratio:.0%} of their size "
+            f"({stats['response_saved_bytes']} bytes saved), {stats['passthrough_responses']} relayed still encoded "
+            f"({stats['passthrough_bytes']} bytes, {stats['passthrough_saved_bytes']} bytes saved without decoding), "
+            f"{stats['compressed_requests']} upstream request bodies compressed ({stats['request_saved_bytes']} bytes saved).")
+
+compression_stats = CompressionStats()
+
+def accepts_encoding(accept_encoding, encoding):
+    """Checks if an Accept-Encoding header value allows the content coding `encoding` (q-values included)."""
+    wildcard = None
+    for item in (accept_encoding or "").split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding == encoding:
+            return quality > 0
+        if coding == "*":
+            wildcard = quality > 0
+    return bool(wildcard)
+
+def is_compressible_response(status_code, headers, body_size=None):
+    """
+    Checks if a response may be compressed for the client: a body of a compressible media type,
+    not encoded yet, not marked no-transform and (unless streamed) of at least COMPRESSION_MIN_BYTES.
+    """
+    if not COMPRESSION_ENABLED or status_code < 200 or status_code in (204, 304):
+        return False
+    if body_size is not None and body_size < COMPRESSION_MIN_BYTES:
+        return False
+    content_type = ""
+    for name, value in headers:
+        name = name.lower()
+        if name == "content-encoding" or (name == "cache-control" and "no-transform" in value.lower()):
+            return False
+        if name == "content-type":
+            content_type = value.partition(";")[0].strip().lower()
+    return content_type.startswith("text/") or content_type.endswith("+json") or content_type in COMPRESSIBLE_CONTENT_TYPES
+
+def gzip_compress(data):
+    """Returns `data` as a gzip member, at COMPRESSION_LEVEL."""
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31) # 31: gzip header and trailer
+    return compressor.compress(data) + compressor.flush()
+
+def gzip_stream(chunks):
+    """
+    Generator gzip compressing a streamed body. Every chunk is flushed (Z_SYNC_FLUSH), so the
+    client can decode each SSE event as soon as it arrives.
+    """
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+    size = compressed_size = 0
+    try:
+        for chunk in chunks:
+            if chunk:
+                data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                size += len(chunk)
+                compressed_size += len(data)
+                yield data
+        data = compressor.flush()
+        compressed_size += len(data)
+        yield data
+    finally:
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
+        compression_stats.record_response(size, compressed_size)
+
+async def async_gzip_stream(chunks):
+    """Async counterpart of gzip_stream()."""
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+    size = compressed_size = 0
+    try:
+        async for chunk in chunks:
+            if chunk:
+                data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                size += len(chunk)
+                compressed_size += len(data)
+                yield data
+        data = compressor.flush()
+        compressed_size += len(data)
+        yield data
+    finally:
+        await chunks.aclose()
+        compression_stats.record_response(size, compressed_size)
+
+def compress_response(accept_encoding, status_code, headers, body):
+    """
+    Gzip compresses a response for a client sending `accept_encoding`, if it is worth it (see
+    is_compressible_response()). `body` is bytes, an iterator or an async iterator of bytes.
+    Returns (headers, body), unchanged if the response is left as it is.
+    """
+    headers = list(headers)
+    streamed = not isinstance(body, bytes)
+    if not accepts_encoding(accept_encoding, "gzip") or not is_compressible_response(status_code, headers, None if streamed else len(body)):
+        return headers, body
+    headers = [h for h in headers if h[0].lower() != 'content-length'] + [('Content-Encoding', 'gzip'), ('Vary', 'Accept-Encoding')]
+    if hasattr(body, "__aiter__"):
+        return headers, async_gzip_stream(body)
+    if streamed:
+        return headers, gzip_stream(body)
+    compressed = gzip_compress(body)
+    compression_stats.record_response(len(body), len(compressed))
+    return headers, compressed
+
+def compress_flask_response(response, accept_encoding):
+    """Sync engine: applies compress_response() to a Flask response."""
+    body = response.response if response.is_streamed else response.get_data()
+    headers, compressed = compress_response(accept_encoding, response.status_code, response.headers.items(), body)
+    if compressed is body:
+        return response
+    return Response(compressed, response.status_code, headers)
+
+def passthrough_encoding(proxy_req, upstream_resp, sink):
+    """
+    Returns the content encoding in which a passthrough response can be relayed to the client as
+    received, without decoding it, or None. The body must be decoded for the response cache and
+    coalesced requests (`sink`), for the trailing error filter of a successful stream, and for
+    clients that don't accept the upstream encoding.
+    """
+    if not COMPRESSION_ENABLED or sink is not None or upstream_resp.content_read:
+        return None
+    encoding = (upstream_resp.headers.get('content-encoding') or '').strip().lower()
+    if encoding not in UPSTREAM_CONTENT_ENCODINGS:
+        return None
+    # Only streams end with a trailing error; a single JSON object passes the filter unchanged
+    if upstream_resp.status_code == 200 and proxy_req.target_path.endswith("streamGenerateContent"):
+        return None
+    return encoding if accepts_encoding(proxy_req.accept_encoding, encoding) else None
+
+def encoded_passthrough_headers(response_headers, encoding):
+    """Client headers of a passthrough response relayed still encoded (see passthrough_encoding())."""
+    return response_headers + [('Content-Encoding', encoding), ('Vary', 'Accept-Encoding')]
+
+def relay_encoded_response(upstream_resp, encoding, key_suffix):
+    """
+    Generator relaying an upstream body to the client exactly as received, still `encoding`
+    encoded. Closes the upstream response when done.
+    """
+    start_time = time.time()
+    bytes_sent = 0
+    trailer = b""
+    completed = False
+    try:
+        for chunk in upstream_resp.iter_raw(STREAM_READ_CHUNK_SIZE):
+            if chunk:
+                bytes_sent += len(chunk)
+                trailer = (trailer + chunk)[-8:]
+                yield chunk
+        completed = True
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Error while relaying upstream response with key ...{key_suffix}: {e}")
+    finally:
+        upstream_resp.close()
+        record_encoded_passthrough(encoding, bytes_sent, trailer, completed)
+    logging.info(f"Relayed {bytes_sent} {encoding} encoded bytes to client with key ...{key_suffix}, total {time.time() - start_time:.3f}s")
+
+def record_encoded_passthrough(encoding, bytes_sent, trailer, completed):
+    """Counts a body relayed still encoded; a complete gzip body ends with its decoded size (mod 2^32)."""
+    decoded_size = None
+    if encoding == "gzip" and completed and len(trailer) == 8:
+        decoded_size = int.from_bytes(trailer[4:], "little")
+    compression_stats.record_passthrough(bytes_sent, decoded_size)
+
+# --- Upstream HTTP Client ---
+class UpstreamPoolStats:
+    """Thread-safe counters describing how well upstream connections are being reused."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.requests = 0
+        self.new_connections = 0 # Every new HTTPS connection costs a TCP + TLS handshake
+        self.tls_handshakes = 0
+        self.checkouts = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.saturation_events = 0 # Checkouts that found every pooled connection busy
+        self.saturation_wait_seconds = 0.0
+        self._last_log_time = time.time()
+
+    def record_checkout(self, saturated, waited):
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            if saturated:
+                self.saturation_events += 1
+                self.saturation_wait_seconds += waited
+
+    def begin_checkout(self):
+        # Reset before the pool hands out a connection; _new_conn() sets it again if one is opened
+        self._local.new_connection = False
+
+    def record_checkin(self):
+        with self._lock:
+            self.in_use = max(0, self.in_use - 1)
+
+    def record_new_connection(self, tls=True):
+        with self._lock:
+            self.new_connections += 1
+            if tls:
+                self.tls_handshakes += 1
+        self._local.new_connection = True
+
+    def record_request(self):
+        """Counts a forwarded request and returns True if it had to open a new connection."""
+        with self._lock:
+            self.requests += 1
+        return getattr(self._local, "new_connection", False)
+
+    def snapshot(self):
+        with self._lock:
+            reused = max(0, self.requests - self.new_connections)
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "tls_handshakes": self.tls_handshakes,
+                "reused_connections": reused,
+                "reuse_ratio": round(reused / self.requests, 3) if self.requests else 0.0,
+                "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use,
+                "pool_size": UPSTREAM_POOL_MAXSIZE,
+                "saturation_events": self.saturation_events,
+                "saturation_wait_seconds": round(self.saturation_wait_seconds, 3),
+            }
+
+    def maybe_log(self, force=False):
+        """Logs a pool summary at most once every UPSTREAM_STATS_LOG_INTERVAL seconds."""
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_log_time < UPSTREAM_STATS_LOG_INTERVAL:
+                return
+            self._last_log_time = now
+        logging.info(f"Upstream connection pool stats: {self.snapshot()}")
+
+upstream_pool_stats = UpstreamPoolStats()
+
+class _PoolTrackingMixin:
+    """Hooks urllib3's connection pool to count handshakes, reuse and saturation."""
+    _is_tls = True
+
+    def _new_conn(self):
+        upstream_pool_stats.record_new_connection(tls=self._is_tls)
+        logging.debug(f"Opening new upstream connection to {self.host}:{self.port}")
+        return super()._new_conn()
+
+    def _get_conn(self, timeout=None):
+        # The pool queue is pre-filled with placeholders, so an empty queue means every slot is checked out
+        saturated = self.pool is not None and self.pool.empty()
+        wait_start = time.monotonic()
+        upstream_pool_stats.begin_checkout()
+        conn = super()._get_conn(timeout=timeout)
+        upstream_pool_stats.record_checkout(saturated, time.monotonic() - wait_start)
+        if saturated:
+            logging.warning(f"Upstream connection pool saturated ({self.pool.maxsize} connections busy); waited {time.monotonic() - wait_start:.3f}s for a free connection.")
+        return conn
+
+    def _put_conn(self, conn):
+        upstream_pool_stats.record_checkin()
+        return super()._put_conn(conn)
+
+class _TrackedHTTPConnectionPool(_PoolTrackingMixin, urllib3.HTTPConnectionPool):
+    _is_tls = False
+
+class _TrackedHTTPSConnectionPool(_PoolTrackingMixin, urllib3.HTTPSConnectionPool):
+    pass
+
+class PooledUpstreamAdapter(HTTPAdapter):
+    """HTTPAdapter that enables TCP keep-alive probes and connection pool tracking."""
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        socket_options = list(HTTPConnection.default_socket_options)
+        if UPSTREAM_KEEPALIVE:
+            socket_options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            if hasattr(socket, "TCP_KEEPIDLE"): # Not available on every platform (e.g. older macOS, Windows)
+                socket_options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60))
+        pool_kwargs["socket_options"] = socket_options
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TrackedHTTPConnectionPool,
+            "https": _TrackedHTTPSConnectionPool,
+        }
+
+class UpstreamResponse:
+    """Minimal response interface shared by the requests and httpx based clients."""
+
+    def __init__(self, status_code, headers, header_items, content_iter, close, raw_iter=None):
+        self.status_code = status_code
+        self.headers = headers
+        self._header_items = header_items
+        self._content_iter = content_iter
+        self._raw_iter = raw_iter
+        self._close = close
+        self._content = None
+
+    def header_items(self):
+        """Returns the raw (name, value) header pairs, preserving repeated headers."""
+        return list(self._header_items)
+
+    def iter_content(self, chunk_size=None):
+        if self._content is not None:
+            yield self._content
+            return
+        yield from self._content_iter(chunk_size or STREAM_READ_CHUNK_SIZE)
+
+    def iter_raw(self, chunk_size=None):
+        """Yields the body as received, without decoding its Content-Encoding."""
+        yield from self._raw_iter(chunk_size or STREAM_READ_CHUNK_SIZE)
+
+    @property
+    def content_read(self):
+        """True once the (decoded) body was read, after which it can't be relayed encoded."""
+        return self._content is not None
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = b"".join(self._content_iter(STREAM_READ_CHUNK_SIZE))
+            self.close()
+        return self._content
+
+    def close(self):
+        self._close()
+
+class UpstreamClient:
+    """
+    Shared, thread-safe HTTP client for all requests to the Gemini API.
+    Keeps a pool of keep-alive connections (optionally HTTP/2 multiplexed via httpx)
+    so that each forwarded call does not pay a fresh TCP + TLS handshake.
+    """
+
+    def __init__(self, base_url=GEMINI_API_BASE_URL):
+        self.base_url = base_url
+        self.http2 = False
+        self._httpx_client = None
+        self._session = None
+        if UPSTREAM_HTTP2:
+            try:
+                import httpx
+                import h2 # noqa: F401 - httpx needs the h2 package for HTTP/2
+                self._httpx = httpx
+                self._httpx_client = httpx.Client(
+                    http2=True,
+                    limits=httpx.Limits(
+                        max_connections=UPSTREAM_POOL_MAXSIZE,
+                        max_keepalive_connections=UPSTREAM_POOL_MAXSIZE if UPSTREAM_KEEPALIVE else 0,
+                        keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY),
+                    timeout=None)
+                self.http2 = True
+            except ImportError:
+                logging.warning("UPSTREAM_HTTP2 is enabled but httpx[http2] is not installed. Falling back to HTTP/1.1 connection pooling.")
+        if not self.http2:
+            session = requests.Session()
+            # Upstream cookies must never leak between clients sharing this session
+            session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            adapter = PooledUpstreamAdapter(
+                pool_connections=4, pool_maxsize=UPSTREAM_POOL_MAXSIZE, pool_block=UPSTREAM_POOL_BLOCK)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._session = session
+        logging.info(f"Upstream client initialized for {base_url}. HTTP/2: {self.http2}, pool size: {UPSTREAM_POOL_MAXSIZE}, keep-alive: {UPSTREAM_KEEPALIVE}")
+
+    def request(self, method, url, headers=None, params=None, data=None, stream=False, timeout=120):
+        """Sends a request upstream and returns an UpstreamResponse. Raises requests exceptions on failure."""
+        headers = dict(headers or {})
+        if not UPSTREAM_KEEPALIVE:
+            headers["connection"] = "close"
+        if self.http2:
+            return self._request_httpx(method, url, headers, params, data, timeout)
+
+        resp = self._session.request(
+            method=method, url=url, headers=headers, params=params,
+            data=data, stream=True, timeout=timeout)
+        reused = not upstream_pool_stats.record_request()
+        logging.debug("Upstream request to %s used a %s connection.", url, 'reused' if reused else 'new')
+        upstream_pool_stats.maybe_log()
+        def iter_raw(chunk_size):
+            try:
+                yield from resp.raw.stream(chunk_size, decode_content=False)
+            except urllib3.exceptions.HTTPError as e:
+                # Like iter_content(), report failures while reading the body as requests exceptions
+                raise requests.exceptions.ConnectionError(str(e)) from e
+        wrapped = UpstreamResponse(
+            resp.status_code, resp.headers, resp.raw.headers.items(),
+            lambda chunk_size: resp.iter_content(chunk_size=chunk_size), resp.close, iter_raw)
+        if not stream:
+            wrapped.content # Read the body now so the connection returns to the pool
+        return wrapped
+
+    def _request_httpx(self, method, url, headers, params, data, timeout):
+        connection_events = []
+        def trace(event_name, info):
+            if event_name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+                connection_events.append(event_name)
+        try:
+            req = self._httpx_client.build_request(
+                method, url, headers=headers, params=params, content=data,
+                timeout=timeout, extensions={"trace": trace})
+            resp = self._httpx_client.send(req, stream=True)
+        except self._httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e)) from e
+        except self._httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+
+        new_connection = "connection.connect_tcp.complete" in connection_events
+        if new_connection:
+            upstream_pool_stats.record_new_connection(tls="connection.start_tls.complete" in connection_events)
+        upstream_pool_stats.record_request()
+        logging.debug("Upstream %s request to %s used a %s connection.", resp.http_version, url, 'new' if new_connection else 'reused')
+        upstream_pool_stats.maybe_log()
+
+        def iter_bytes(chunk_size, raw=False):
+            try:
+                # httpx would re-buffer to exactly chunk_size; yield data as it arrives instead
+                yield from resp.iter_raw() if raw else resp.iter_bytes()
+            except self._httpx.TimeoutException as e:
+                raise requests.exceptions.Timeout(str(e)) from e
+            except self._httpx.TransportError as e:
+                raise requests.exceptions.ConnectionError(str(e)) from e
+            finally:
+                resp.close() # Return the connection to the pool as soon as the body is consumed
+        return UpstreamResponse(resp.status_code, resp.headers, resp.headers.multi_items(), iter_bytes, resp.close,
+                                lambda chunk_size: iter_bytes(chunk_size, raw=True))
+
+    def warm(self, count):
+        """Opens `count` upstream connections concurrently so the first client requests reuse them."""
+        if count <= 0:
+            return
+        if self.http2:
+            count = 1 # A single HTTP/2 connection is multiplexed across all requests
+        def open_connection(_):
+            try:
+                self.request("HEAD", f"{self.base_url}/", timeout=10)
+                return True
+            except requests.exceptions.RequestException as e:
+                logging.warning(f"Upstream connection warm-up request failed: {e}")
+                return False
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            opened = sum(executor.map(open_connection, range(count)))
+        logging.info(f"Warmed {opened}/{count} upstream connections in {time.time() - start:.2f}s.")
+
+    def close(self):
+        if self._httpx_client is not None:
+            self._httpx_client.close()
+        if self._session is not None:
+            self._session.close()
+
+_upstream_client_lock = threading.Lock()
+
+def get_upstream_client():
+    """Returns the shared upstream client, creating it on first use."""
+    global upstream_client
+    if upstream_client is None:
+        with _upstream_client_lock:
+            if upstream_client is None:
+                upstream_client = UpstreamClient(GEMINI_API_BASE_URL)
+    return upstream_client
+
+# --- Request Processing ---
+# Engine-independent steps of handling a proxied request. The Flask view and the ASGI
+# engine only differ in how they read the request, call upstream and write the response.
+class ProxyRequestError(Exception):
+    """Raised while preparing a request that must be rejected with `status` and `message`."""
+
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after # Seconds for a Retry-After header, if any
+
+class ProxyRequest:
+    """A validated incoming request, ready to be forwarded upstream with any key."""
+
+    def __init__(self, path, method, is_openai_format, target_path, model, outgoing_headers,
+                 query_params, gemini_request_body_json, native_request_body, use_stream_endpoint, start_time,
+                 estimated_tokens=0):
+        self.path = path
+        self.method = method
+        self.is_openai_format = is_openai_format
+        self.target_path = target_path
+        self.target_url = f"{GEMINI_API_BASE_URL}/{target_path}"
+        self.model = model
+        self.outgoing_headers = outgoing_headers
+        self.query_params = query_params
+        self.gemini_request_body_json = gemini_request_body_json
+        self.native_request_body = native_request_body
+        self.use_stream_endpoint = use_stream_endpoint
+        self.start_time = start_time
+        self.estimated_tokens = estimated_tokens # Rough prompt size, charged against local TPM limits
+        # Identity of the upstream response (see request_fingerprint()), used by the response
+        # cache and request coalescing; None if the request can't share a response
+        self.fingerprint = None
+        self.fingerprint_kind = None
+        self.cache_ttl = None # Seconds the response may be cached, None if it must not be
+        self.cached_entry = None # Cached upstream response found for this request, if any
+        self.flight = None # _Flight this request leads (request coalescing), if any
+        self.trace = NULL_TRACE # Phase timings and spans (see RequestTrace)
+        self.log_bodies = False # Whether bodies and headers of this request are logged (see should_log_bodies())
+        self._request_body = None # Serialized gemini_request_body_json, see request_body()
+        self.context_cache_plan = None # Cacheable prompt prefixes (see ContextCache), if any
+        self.context_cache_refs = {} # {api_key: prefix hash} of the attempts that referenced a context cache
+        self.context_cache_hit = False
+        self._key_request_bodies = {} # {api_key: body} of attempts while context caching applies
+        self.admission = None # AdmissionTicket of the upstream call, if admission control applies
+        self.deadline = start_time + REQUEST_DEADLINE_SECONDS # Time (time.time()) by which every attempt must be done
+        self.accept_encoding = None # The client's Accept-Encoding header (see compress_response())
+        self._compressed_bodies = {} # {body: gzip compressed body} (see UPSTREAM_REQUEST_COMPRESSION)
+
+    def request_body(self, api_key=None):
+        """
+        Returns the body sent upstream. A converted body is serialized once and reused by every
+        attempt; with a context cache of `api_key` for its prompt prefix, the body references it.
+        """
+        if not self.is_openai_format:
+            return self.native_request_body
+        if self._request_body is None:
+            self._request_body = json_dumps(self.gemini_request_body_json) if self.gemini_request_body_json else b''
+        if api_key is not None and self.context_cache_plan is not None:
+            body = self._key_request_bodies.get(api_key)
+            if body is None:
+                body = self._key_request_bodies[api_key] = context_cache.body_for(self, api_key) or self._request_body
+            return body
+        return self._request_body
+
+    def compressed_body(self, body):
+        """Returns `body` gzip compressed; each distinct body is compressed once, whatever the number of attempts."""
+        compressed = self._compressed_bodies.get(body)
+        if compressed is None:
+            compressed = self._compressed_bodies[body] = gzip_compress(body)
+            compression_stats.record_request(len(body), len(compressed))
+        return compressed
+
+    def release_admission(self):
+        """Frees the request's upstream call slot (see AdmissionController); safe to call twice."""
+        admission_controller.release(self.admission)
+
+    def attempt_timeout(self):
+        """Timeout of the next upstream attempt: UPSTREAM_TIMEOUT, or less if the deadline is nearer."""
+        return max(0.1, min(UPSTREAM_TIMEOUT, self.deadline - time.time()))
+
+    def forward_params(self):
+        """Returns the query parameters of the upstream request."""
+        # Pass query params only if it wasn't an OpenAI request (OpenAI params are in body)
+        if not self.is_openai_format:
+            return self.query_params
+        if self.use_stream_endpoint:
+            # Ask Gemini for Server-Sent Events so chunks can be translated as they arrive
+            return {"alt": "sse"}
+        return None
+
+    def build_attempt(self, api_key):
+        """Returns the keyword arguments of the upstream request using `api_key`."""
+        logging.info(f"Attempting request for model '{self.model}' with key ending ...{api_key[-4:]}")
+        outgoing_headers = dict(self.outgoing_headers)
+        outgoing_headers['x-goog-api-key'] = api_key # Set the actual Gemini key for the upstream request
+
+        # Use the converted JSON body for OpenAI requests, the untouched original bytes otherwise
+        request_body_to_send = self.request_body(api_key)
+
+        logging.debug("Forwarding request body size: %d bytes", len(request_body_to_send))
+        if self.log_bodies and request_body_to_send:
+            logging.debug("Forwarding request body: %s", LogPayload(request_body_to_send))
+
+        # Determine method - OpenAI endpoint is always POST
+        forward_method = 'POST' if self.is_openai_format else self.method
+        logging.info(f"Forwarding {forward_method} request to: {self.target_url} with key ...{api_key[-4:]}")
+        logging.debug("Forwarding with Query Params: %s", self.query_params)
+        if UPSTREAM_REQUEST_COMPRESSION and len(request_body_to_send) >= UPSTREAM_REQUEST_COMPRESSION_MIN_BYTES \
+                and 'content-encoding' not in outgoing_headers:
+            request_body_to_send = self.compressed_body(request_body_to_send)
+            outgoing_headers['content-encoding'] = 'gzip'
+        if self.log_bodies:
+            logging.debug("Forwarding with Headers: %s", redact_headers(outgoing_headers))
+
+        forward_params = self.forward_params()
+        # Determine if the *forwarded* request should be streaming based on Gemini endpoint.
+        # Native requests are always relayed as a stream in passthrough mode.
+        forward_stream = self.target_path.endswith("streamGenerateContent") or (NATIVE_PASSTHROUGH and not self.is_openai_format)
+        return {
+            "method": forward_method,
+            "url": self.target_url,
+            "headers": outgoing_headers,
+            "params": forward_params,
+            "data": request_body_to_send,
+            "stream": forward_stream,
+            "timeout": self.attempt_timeout(),
+        }
+
+    def response_mode(self, status_code):
+        """Decides how the upstream response is returned: 'openai_stream', 'passthrough' or 'buffered'."""
+        if self.is_openai_format and self.use_stream_endpoint and status_code == 200:
+            return "openai_stream"
+        if not self.is_openai_format and NATIVE_PASSTHROUGH:
+            return "passthrough"
+        return "buffered"
+
+def validate_placeholder_token(incoming_headers, is_openai_format):
+    """
+    Checks the placeholder token of a request: 'Authorization: Bearer <token>' for the OpenAI
+    endpoints, 'x-goog-api-key: <token>' otherwise. Raises ProxyRequestError if it is missing or wrong.
+    """
+    auth_header_openai = 'authorization'
+    api_key_header_gemini = 'x-goog-api-key'
+
+    # --- API Key Validation (Handles both OpenAI and Gemini style auth to the proxy) ---
+    placeholder_token_provided = None
+    if is_openai_format:
+        # Expect OpenAI style "Authorization: Bearer PLACEHOLDER_TOKEN"
+        auth_value = incoming_headers.get(auth_header_openai)
+        if not auth_value:
+            logging.warning(f"OpenAI Request rejected: Missing '{auth_header_openai}' header.")
+            raise ProxyRequestError(401, f"Missing '{auth_header_openai}' header")
+        parts = auth_value.split()
+        if len(parts) != 2 or parts[0].lower() != 'bearer':
+            logging.warning(f"OpenAI Request rejected: Invalid '{auth_header_openai}' header format. Expected 'Bearer <token>'.")
+            raise ProxyRequestError(401, f"Invalid '{auth_header_openai}' header format.")
+        placeholder_token_provided = parts[1]
+    else:
+        # Expect Gemini style "x-goog-api-key: PLACEHOLDER_TOKEN"
+        if api_key_header_gemini not in incoming_headers:
+            logging.warning(f"Gemini Request rejected: Missing '{api_key_header_gemini}' header.")
+            raise ProxyRequestError(400, f"Missing '{api_key_header_gemini}' header") # Bad Request might be more appropriate
+        placeholder_token_provided = incoming_headers[api_key_header_gemini]
+
+    # Validate the provided token against the configured placeholder
+    if placeholder_token_provided != PLACEHOLDER_TOKEN:
+        logging.warning(f"Request rejected: Invalid placeholder token provided. Received: '{placeholder_token_provided}', Expected: '{PLACEHOLDER_TOKEN}'")
+        raise ProxyRequestError(401, "Invalid API key/token provided.") # Unauthorized
+
+    logging.debug("Placeholder token validated successfully.")
+
+def prepare_proxy_request(path, method, header_items, query_params, request_data_bytes, start_time=None):
+    """
+    Validates the placeholder token, converts OpenAI requests to Gemini format and
+    determines the model used for exhaustion tracking. Raises ProxyRequestError on failure.
+    """
+    original_request_path = path
+    is_openai_format = is_openai_chat_request(original_request_path)
+    logging.info(f"Request received for path: {original_request_path}. OpenAI format detected: {is_openai_format}")
+    REQUEST_BYTES.inc((api_label(is_openai_format),), len(request_data_bytes or b""))
+
+    log_bodies = should_log_bodies()
+
+    # --- Daily Usage Reset Check ---
+    check_daily_reset()
+
+    # Ensure keys were loaded and the key pool is available
+    if not all_api_keys or key_pool is None: # Check all_api_keys as well
+        logging.error("API keys not loaded or key pool not initialized. Cannot process request.")
+        raise ProxyRequestError(503, "Proxy server error: API keys not loaded.") # Service Unavailable
+
+    # --- Request Body Handling & Potential Conversion ---
+    gemini_request_body_json = None
+    native_request_body = b'' # Original bytes of a direct Gemini request, forwarded as-is
+    conversion_seconds = 0.0
+    target_gemini_model = None
+    use_stream_endpoint = False
+    target_path = path # Default to original path
+
+    if is_openai_format:
+        if method != 'POST':
+             raise ProxyRequestError(405, "OpenAI compatible endpoint only supports POST.")
+        try:
+            openai_request_data = json_loads(request_data_bytes)
+            if log_bodies:
+                logging.debug("Original OpenAI request data: %s", LogPayload(openai_request_data))
+            conversion_start = time.perf_counter()
+            gemini_request_body_json, target_gemini_model, use_stream_endpoint = convert_openai_to_gemini_request(openai_request_data)
+            conversion_seconds = time.perf_counter() - conversion_start
+            CONVERSION_DURATION.observe(conversion_seconds, ("request",))
+            if log_bodies:
+                logging.debug("Converted Gemini request data: %s", LogPayload(gemini_request_body_json))
+            logging.info(f"OpenAI request mapped to Gemini model: {target_gemini_model}, Streaming: {use_stream_endpoint}")
+
+            # Determine target Gemini endpoint
+            action = "streamGenerateContent" if use_stream_endpoint else "generateContent"
+            # Construct the Gemini API path using the extracted/defaulted model
+            target_path = f"v1beta/models/{target_gemini_model}:{action}"
+
+        except json.JSONDecodeError:
+            logging.error("Failed to decode OpenAI request body as JSON.")
+            raise ProxyRequestError(400, "Invalid JSON in request body.")
+        except Exception as e:
+            logging.error(f"Error during OpenAI request conversion: {e}", exc_info=True)
+            raise ProxyRequestError(500, "Error processing OpenAI request.")
+    else:
+        # Assume it's a direct Gemini request, pass the original body bytes through unchanged (if method allows)
+        if request_data_bytes and method in ['POST', 'PUT', 'PATCH']:
+             native_request_body = request_data_bytes
+             logging.debug("Direct Gemini request body (%d bytes) will be forwarded unchanged.", len(request_data_bytes))
+        target_path = path # Use original path for direct Gemini requests
+
+    logging.debug("Target Gemini URL: %s/%s", GEMINI_API_BASE_URL, target_path)
+    # Query parameters are passed through but not used for key auth
+    logging.debug("Incoming query parameters: %s", query_params)
+
+    # Prepare headers for the outgoing request
+    # Copy headers from incoming request, excluding 'Host'
+    # Use lowercase keys for case-insensitive lookup
+    incoming_headers = {key.lower(): value for key, value in header_items if key.lower() != 'host'}
+    if log_bodies:
+        logging.debug("Incoming headers (excluding Host): %s", redact_headers(incoming_headers))
+
+    # Start with a copy of incoming headers for the outgoing request
+    # Hop-by-hop headers describe the client's connection and must not be forwarded,
+    # otherwise e.g. a client's 'Connection: close' would tear down our pooled upstream connection
+    outgoing_headers = {key: value for key, value in incoming_headers.items() if key not in HOP_BY_HOP_HEADERS}
+    # Only ask for encodings the proxy can decode, whatever the client accepts (see passthrough_encoding())
+    outgoing_headers['accept-encoding'] = UPSTREAM_ACCEPT_ENCODING
+    auth_header_openai = 'authorization' # Define variable *before* use
+
+    # If the original request was OpenAI format, remove the Authorization header
+    # as we will use x-goog-api-key for the upstream request.
+    if is_openai_format and auth_header_openai in outgoing_headers:
+        del outgoing_headers[auth_header_openai]
+        logging.debug("Removed '%s' header before forwarding.", auth_header_openai)
+
+    validate_placeholder_token(incoming_headers, is_openai_format)
+
+    # --- Determine Effective Model for Exhaustion Logic ---
+    effective_model_for_request = None
+    if is_openai_format:
+        effective_model_for_request = target_gemini_model # Determined during OpenAI to Gemini conversion
+    else: # Direct Gemini request
+        try:
+            # target_path is like "v1beta/models/gemini-pro:generateContent" or "v1/models/gemini-1.5-flash"
+            path_segments = target_path.split('/')
+            if 'models' in path_segments:
+                models_idx = path_segments.index('models')
+                if models_idx + 1 < len(path_segments):
+                    effective_model_for_request = path_segments[models_idx + 1].split(':')[0]
+                elif method == 'GET':
+                    # Listing models (e.g. GET v1beta/models) is not tied to one model; it is
+                    # tracked under the pseudo-model "models"
+                    effective_model_for_request = "models"
+
+            if not effective_model_for_request: # Fallback for slightly different structures if needed
+                 logging.warning(f"Could not determine model from direct Gemini path structure: {target_path}")
+
+        except ValueError: # 'models' not in path_segments
+            logging.warning(f"Path structure for direct Gemini request does not contain 'models' segment: {target_path}")
+        except Exception as e:
+            logging.error(f"Error parsing model from direct Gemini path {target_path}: {e}", exc_info=True)
+
+    if not effective_model_for_request:
+        logging.error(f"Critical: Model for request could not be determined for path '{original_request_path}' (target: '{target_path}'). Cannot apply model-specific exhaustion logic.")
+        raise ProxyRequestError(500, "Proxy error: Could not determine model for request to apply exhaustion rules.")
+
+    logging.info(f"Effective model for this request (for exhaustion logic): {effective_model_for_request}")
+
+    proxy_req = ProxyRequest(
+        path=original_request_path, method=method, is_openai_format=is_openai_format,
+        target_path=target_path, model=effective_model_for_request, outgoing_headers=outgoing_headers,
+        query_params=query_params, gemini_request_body_json=gemini_request_body_json,
+        native_request_body=native_request_body, use_stream_endpoint=use_stream_endpoint,
+        start_time=start_time or time.time(),
+        estimated_tokens=max(1, len(request_data_bytes or b"") // 4))
+    proxy_req.log_bodies = log_bodies
+    proxy_req.accept_encoding = incoming_headers.get('accept-encoding')
+    proxy_req.deadline = proxy_req.start_time + request_deadline_seconds(incoming_headers)
+    if is_openai_format:
+        # Serialize the converted body now, counted as request conversion, rather than on each attempt
+        serialize_start = time.perf_counter()
+        proxy_req.request_body()
+        if CONTEXT_CACHE_ENABLED:
+            proxy_req.context_cache_plan = context_cache.plan(proxy_req)
+        conversion_seconds += time.perf_counter() - serialize_start
+
+    if RESPONSE_CACHE_ENABLED or REQUEST_COALESCING_ENABLED:
+        proxy_req.fingerprint, proxy_req.fingerprint_kind = request_fingerprint(proxy_req)
+    # A cached response is served even if every key is exhausted, it costs no quota
+    proxy_req.cache_ttl = response_cache.ttl_for(proxy_req)
+    if proxy_req.cache_ttl is not None:
+        proxy_req.cached_entry = response_cache.get(proxy_req.fingerprint)
+
+    # Check if all keys are already exhausted (or cooling down) for this specific model before trying any key
+    if proxy_req.cached_entry is None and all_keys_exhausted_for_model(effective_model_for_request):
+        raise no_usable_key_error(effective_model_for_request)
+
+    proxy_req.trace = start_trace(proxy_req, incoming_headers.get('traceparent'))
+    proxy_req.trace.add_phase("parse", time.time() - proxy_req.start_time - conversion_seconds)
+    if is_openai_format:
+        proxy_req.trace.add_phase("convert_request", conversion_seconds)
+    return proxy_req
+
+class EmbeddingRequest:
+    """A validated OpenAI embeddings request, its inputs converted to Gemini EmbedContentRequests."""
+
+    is_openai_format = True # Counted as an OpenAI request in the metrics
+
+    def __init__(self, model, texts, dimensions, encoding_format, start_time):
+        self.model = model
+        self.dimensions = dimensions
+        self.encoding_format = encoding_format
+        self.start_time = start_time
+        self.requests = [convert_openai_embedding_input(model, text, dimensions) for text in texts]
+        self.tokens = [max(1, len(text) // 4) for text in texts] # Rough size of each input
+
+def prepare_embedding_request(path, method, header_items, request_data_bytes, start_time=None):
+    """
+    Validates the placeholder token and the body of an OpenAI embeddings request.
+    Returns an EmbeddingRequest, raises ProxyRequestError on failure.
+    """
+    logging.info(f"Request received for path: {path}. OpenAI embeddings request.")
+    REQUEST_BYTES.inc((api_label(True),), len(request_data_bytes or b""))
+    check_daily_reset()
+    if not all_api_keys or key_pool is None:
+        logging.error("API keys not loaded or key pool not initialized. Cannot process request.")
+        raise ProxyRequestError(503, "Proxy server error: API keys not loaded.")
+    if method != 'POST':
+        raise ProxyRequestError(405, "OpenAI compatible endpoint only supports POST.")
+    validate_placeholder_token({key.lower(): value for key, value in header_items}, True)
+
+    try:
+        openai_request_data = json_loads(request_data_bytes)
+    except ValueError:
+        logging.error("Failed to decode OpenAI embeddings request body as JSON.")
+        raise ProxyRequestError(400, "Invalid JSON in request body.")
+    if not isinstance(openai_request_data, dict):
+        raise ProxyRequestError(400, "Request body must be a JSON object.")
+    texts = openai_request_data.get("input")
+    if isinstance(texts, str):
+        texts = [texts]
+    # Token arrays can't be embedded by Gemini, which only takes text
+    if not isinstance(texts, list) or not texts or not all(isinstance(text, str) and text for text in texts):
+        raise ProxyRequestError(400, "'input' must be a non-empty string or a list of non-empty strings (token arrays are not supported).")
+    dimensions = openai_request_data.get("dimensions")
+    if dimensions is not None and (not isinstance(dimensions, int) or isinstance(dimensions, bool) or dimensions < 1):
+        raise ProxyRequestError(400, "'dimensions' must be a positive integer.")
+    encoding_format = openai_request_data.get("encoding_format") or "float"
+    if encoding_format not in ("float", "base64"):
+        raise ProxyRequestError(400, "'encoding_format' must be 'float' or 'base64'.")
+    model = str(openai_request_data.get("model") or EMBEDDING_DEFAULT_MODEL).split('/')[-1]
+    logging.debug("Embeddings request for model %s with %d inputs", model, len(texts))
+
+    if all_keys_exhausted_for_model(model):
+        raise no_usable_key_error(model)
+    return EmbeddingRequest(model, texts, dimensions, encoding_format, start_time or time.time())
+
+def build_embeddings_response(emb_req, parts):
+    """
+    Returns (status, headers, body) of `emb_req` once the batches its inputs joined (see
+    EmbeddingBatcher.join()) are done. Raises ProxyRequestError if a batch got no upstream response.
+    """
+    embeddings = []
+    for batch, index, count, _ in parts:
+        if batch.error is not None:
+            raise batch.error
+        if batch.status != 200:
+            # Relay the upstream error as-is, like a failed chat completion
+            return batch.status, [('Content-Type', 'application/json')], batch.body
+        embeddings.extend(batch.embeddings[index:index + count])
+    body = convert_gemini_embeddings_to_openai(embeddings, emb_req.model, sum(emb_req.tokens), emb_req.encoding_format)
+    record_response_sent(emb_req, len(body))
+    return 200, [('Content-Type', 'application/json')], body
+
+def no_usable_key_error(model, pacing_retry_after=None):
+    """
+    Returns the ProxyRequestError for a request that found no usable key for `model`: 429 with
+    Retry-After while keys are over their local limits or cooling down, 503 once every key
+    has reached its daily limit.
+    """
+    if pacing_retry_after is not None:
+        rate_pacer.record_rejection()
+    retry_after = pacing_retry_after
+    cooldown_wait = key_cooldowns.seconds_until_available(model)
+    if cooldown_wait is not None:
+        retry_after = cooldown_wait if retry_after is None else min(retry_after, cooldown_wait)
+    if retry_after is not None:
+        retry_after = max(1, math.ceil(retry_after))
+        logging.warning(f"All API keys are rate limited (local limits or cooldown) for model '{model}'. Rejecting request, retry after {retry_after}s.")
+        return ProxyRequestError(429, f"All available API keys are rate limited for model '{model}'. Retry after {retry_after} seconds.", retry_after)
+    if all_keys_exhausted_for_model(model):
+        logging.warning(f"All API keys are marked as exhausted for model '{model}' today. Rejecting request.")
+        return ProxyRequestError(503, f"All available API keys have reached their daily limit for model '{model}'.")
+    # The loop finished without returning (all keys were tried and failed)
+    logging.error("Failed to forward request after trying all available API keys.")
+    return ProxyRequestError(503, "Proxy error: Failed to find a usable API key.")
+
+def build_client_response_headers(upstream_header_items):
+    """Returns the upstream response headers that can be forwarded to the client."""
+    # The serving server (uvicorn, gunicorn, ...) sends its own Server and Date headers;
+    # forwarding the upstream ones would make them appear twice
+    excluded_headers = ['content-encoding', 'content-length', 'transfer-encoding', 'connection', 'server', 'date']
+    response_headers = [
+        (key, value) for key, value in upstream_header_items
+        if key.lower() not in excluded_headers
+    ]
+    logging.debug("Forwarding response headers to client: %s", response_headers)
+    return response_headers
+
+def openai_stream_headers(response_headers):
+    """Headers for an OpenAI SSE stream, keeping the forwardable upstream headers."""
+    return [('Content-Type', 'text/event-stream'), ('Cache-Control', 'no-cache'), ('X-Accel-Buffering', 'no')] + [h for h in response_headers if h[0].lower() not in ['content-type', 'content-length', 'transfer-encoding', 'cache-control']]
+
+class GeminiSSEToOpenAIStream:
+    """
+    Turns raw Gemini SSE bytes into OpenAI SSE bytes incrementally: feed() upstream chunks
+    as they arrive and send whatever it returns, then send finish().
+    """
+
+    def __init__(self, model, request_start_time):
+        self.converter = GeminiToOpenAIStreamConverter(model)
+        self.parser = SSEParser()
+        self.request_start_time = request_start_time
+        self.first_chunk_time = None
+        self.stopped = False # Set when the upstream stream reported an error
+        self.conversion_seconds = 0.0 # Time spent converting, recorded in CONVERSION_DURATION by finish()
+
+    def _translate(self, events):
+        output = []
+        for event_data in events:
+            try:
+                gemini_chunk = json_loads(event_data)
+            except json.JSONDecodeError:
+                logging.error(f"Failed to decode Gemini SSE event: {event_data[:500]!r}")
+                continue
+            if not isinstance(gemini_chunk, dict):
+                continue
+            # Check for errors within the stream itself
+            if gemini_chunk.get("candidates") is None and gemini_chunk.get("error"):
+                logging.error(f"Error object found within Gemini stream: {gemini_chunk['error']}")
+                self.stopped = True
+                break
+            for openai_chunk in self.converter.convert(gemini_chunk):
+                if self.first_chunk_time is None:
+                    self.first_chunk_time = time.time()
+                output.append(format_sse_event(openai_chunk))
+        return b"".join(output)
+
+    def feed(self, chunk):
+        """Returns the OpenAI SSE bytes for the events completed by `chunk` (may be empty). Raises ValueError on oversized events."""
+        if self.stopped:
+            return b""
+        conversion_start = time.perf_counter()
+        try:
+            return self._translate(self.parser.feed(chunk))
+        finally:
+            self.conversion_seconds += time.perf_counter() - conversion_start
+
+    def finish(self, completed=True):
+        """Returns the closing bytes: the final chunk (if the stream completed) and [DONE]."""
+        output = b""
+        conversion_start = time.perf_counter()
+        if completed:
+            if not self.stopped:
+                output += self._translate(self.parser.finish())
+            output += format_sse_event(self.converter.final_chunk())
+        self.conversion_seconds += time.perf_counter() - conversion_start
+        CONVERSION_DURATION.observe(self.conversion_seconds, ("stream",))
+        # Send the final [DONE] signal
+        output += "data: [DONE]\n\n".encode('utf-8')
+        time_to_first_token = f"{self.first_chunk_time - self.request_start_time:.3f}s" if self.first_chunk_time else "n/a"
+        logging.info(f"Finished streaming conversion, sent {self.converter.content_chunks} content chunks. Time to first token: {time_to_first_token}, total: {time.time() - self.request_start_time:.3f}s")
+        return output
+
+def stream_openai_from_gemini_sse(upstream_resp, proxy_req, key_suffix, sink=None):
+    """
+    Generator translating a Gemini SSE response into an OpenAI stream for the sync engine.
+    If a response `sink` is given, it receives the upstream SSE body (see ResponseCacheFill).
+    """
+    translator = GeminiSSEToOpenAIStream(proxy_req.model, proxy_req.start_time)
+    completed = False
+    try:
+        for chunk in upstream_resp.iter_content(STREAM_READ_CHUNK_SIZE):
+            if sink:
+                sink.add(chunk)
+            data = translator.feed(chunk)
+            if data:
+                yield data
+            if translator.stopped:
+                break
+        completed = True
+        if sink and not translator.stopped:
+            sink.commit()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logging.error(f"Error while streaming Gemini response with key ...{key_suffix}: {e}")
+    finally:
+        upstream_resp.close()
+        if sink:
+            sink.close()
+    tail = translator.finish(completed)
+    proxy_req.trace.add_phase("convert_response", translator.conversion_seconds)
+    yield tail
 
-    # --- API Key Validation (Handles both OpenAI and Gemini style auth to the proxy) ---
-    placeholder_token_provided = None
-    if is_openai_format:
-        # Expect OpenAI style "Authorization: Bearer PLACEHOLDER_TOKEN"
-        auth_value = incoming_headers.get(auth_header_openai)
-        if not auth_value:
-            logging.warning(f"OpenAI Request rejected: Missing '{auth_header_openai}' header.")
-            return Response(f"Missing '{auth_header_openai}' header", status=401, mimetype='text/plain')
-        parts = auth_value.split()
-        if len(parts) != 2 or parts[0].lower() != 'bearer':
-            logging.warning(f"OpenAI Request rejected: Invalid '{auth_header_openai}' header format. Expected 'Bearer <token>'.")
-            return Response(f"Invalid '{auth_header_openai}' header format.", status=401, mimetype='text/plain')
-        placeholder_token_provided = parts[1]
+def convert_gemini_response_to_openai(raw_response_content, model):
+    """Converts a complete (non-streaming) Gemini response body to an OpenAI chat.completion body."""
+    try:
+        gemini_full_response = json_loads(raw_response_content)
+    except UnicodeDecodeError:
+        gemini_full_response = json_loads(raw_response_content.decode('utf-8', errors='replace'))
+    # Extract text content (simplified)
+    full_text = ""
+    openai_finish_reason = "stop" # Default
+
+    if gemini_full_response.get("candidates"):
+         candidate = gemini_full_response["candidates"][0]
+         full_text = extract_candidate_text(candidate)
+         # Map finish reason
+         openai_finish_reason = map_gemini_finish_reason(candidate.get("finishReason", "STOP"))
+    elif gemini_full_response.get("promptFeedback", {}).get("blockReason"):
+         openai_finish_reason = "content_filter"
+
+    openai_response = {
+        "id": f"chatcmpl-{uuid.uuid4()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {
+                "role": "assistant",
+                "content": full_text,
+            },
+            "finish_reason": openai_finish_reason # Use mapped reason
+        }],
+        "usage": map_gemini_usage(gemini_full_response.get("usageMetadata", {}))
+    }
+    return json_dumps(openai_response)
+
+def build_buffered_response(proxy_req, final_status_code, response_headers, raw_response_content):
+    """
+    Filters a fully read upstream response and converts it for OpenAI requests.
+    Returns (content, headers) to send to the client.
+    """
+    final_headers_to_client = response_headers
+
+    # --- Filter out trailing Google API error JSON (if applicable and status was 200) ---
+    if final_status_code == 200 and raw_response_content:
+        filter_start = time.perf_counter()
+        try:
+            raw_response_content = filter_trailing_error(raw_response_content)
+        except Exception as filter_err:
+            logging.error(f"Error occurred during revised response filtering: {filter_err}", exc_info=True)
+            # Keep raw_response_content as is if filtering fails
+        proxy_req.trace.add_phase("filter", time.perf_counter() - filter_start)
+    # --- End Filtering ---
+
+    final_content_to_client = raw_response_content
+    # --- Convert OpenAI response format (Non-Streaming) ---
+    if proxy_req.is_openai_format and final_status_code == 200:
+         try:
+              logging.debug("Attempting to convert Gemini response to OpenAI format.")
+              conversion_start = time.perf_counter()
+              final_content_to_client = convert_gemini_response_to_openai(raw_response_content, proxy_req.model)
+              conversion_seconds = time.perf_counter() - conversion_start
+              CONVERSION_DURATION.observe(conversion_seconds, ("response",))
+              proxy_req.trace.add_phase("convert_response", conversion_seconds)
+              # Update headers for JSON
+              final_headers_to_client = [('Content-Type', 'application/json')] + [h for h in response_headers if h[0].lower() not in ['content-type', 'content-length', 'transfer-encoding']]
+              logging.info("Successfully converted non-streaming Gemini response to OpenAI format.")
+         except Exception as convert_err:
+              logging.error(f"Error converting Gemini response to OpenAI format: {convert_err}", exc_info=True)
+              # Fallback: return the filtered Gemini content with original headers/status
+              final_content_to_client = raw_response_content
+
+    logging.debug("Final response body size sent to client: %d bytes", len(final_content_to_client))
+    # Log the final response body (cut to LOG_BODY_MAX_CHARS) for sampled requests
+    if proxy_req.log_bodies and final_content_to_client:
+        logging.debug("Response body sent to client: %s", LogPayload(final_content_to_client))
+
+    return final_content_to_client, final_headers_to_client
+
+def build_cached_response(proxy_req):
+    """
+    Builds the client response from the cached upstream response of `proxy_req`, the same way
+    a live response would be returned. Returns (status, headers, body bytes).
+    """
+    entry = proxy_req.cached_entry
+    logging.info(f"Serving request for model '{proxy_req.model}' from the response cache ({len(entry.body)} bytes), no API key used.")
+    response_headers = entry.headers + [('X-Cache', 'HIT')]
+    response_mode = proxy_req.response_mode(entry.status)
+    if response_mode == "openai_stream":
+        translator = GeminiSSEToOpenAIStream(proxy_req.model, proxy_req.start_time)
+        status, headers, body = entry.status, openai_stream_headers(response_headers), translator.feed(entry.body) + translator.finish()
+        proxy_req.trace.add_phase("convert_response", translator.conversion_seconds)
+    elif response_mode == "passthrough":
+        status, headers, body = entry.status, response_headers, entry.body
     else:
-        # Expect Gemini style "x-goog-api-key: PLACEHOLDER_TOKEN"
-        if api_key_header_gemini not in incoming_headers:
-            logging.warning(f"Gemini Request rejected: Missing '{api_key_header_gemini}' header.")
-            return Response(f"Missing '{api_key_header_gemini}' header", status=400, mimetype='text/plain') # Bad Request might be more appropriate
-        placeholder_token_provided = incoming_headers[api_key_header_gemini]
+        final_content_to_client, final_headers_to_client = build_buffered_response(proxy_req, entry.status, response_headers, entry.body)
+        status, headers, body = entry.status, final_headers_to_client, final_content_to_client
+    record_response_sent(proxy_req, len(body))
+    return status, headers, body
 
-    # Validate the provided token against the configured placeholder
-    if placeholder_token_provided != PLACEHOLDER_TOKEN:
-        logging.warning(f"Request rejected: Invalid placeholder token provided. Received: '{placeholder_token_provided}', Expected: '{PLACEHOLDER_TOKEN}'")
-        return Response(f"Invalid API key/token provided.", status=401, mimetype='text/plain') # Unauthorized
+def start_response_sink(proxy_req, status_code, response_headers):
+    """
+    Returns the sink that receives the upstream body for the response cache and for requests
+    coalesced with this one (see ResponseCacheFill and _Flight), or None if nobody needs it.
+    """
+    sink = response_cache.start_fill(proxy_req, status_code, response_headers)
+    if proxy_req.flight is not None:
+        sink = proxy_req.flight.publish(status_code, response_headers, sink)
+    return sink
 
-    logging.debug("Placeholder token validated successfully.")
+def share_buffered_response(proxy_req, status_code, response_headers, raw_response_content):
+    """Passes a fully read upstream response to the response cache and coalesced requests."""
+    sink = start_response_sink(proxy_req, status_code, response_headers)
+    if sink:
+        sink.add(raw_response_content)
+        sink.commit()
 
-    # --- Determine Effective Model for Exhaustion Logic ---
-    effective_model_for_request = None
-    if is_openai_format:
-        effective_model_for_request = target_gemini_model # Determined during OpenAI to Gemini conversion
-    else: # Direct Gemini request
+def follower_response_headers(proxy_req, flight):
+    """Returns (response mode, client headers) for a request coalesced into `flight`."""
+    response_mode = proxy_req.response_mode(flight.status)
+    headers = flight.headers + [('X-Coalesced', 'true')]
+    if response_mode == "openai_stream":
+        headers = openai_stream_headers(headers)
+    return response_mode, headers
+
+def build_follower_buffered_response(proxy_req, flight, headers, content):
+    """Builds (status, headers, body) for a follower from the complete shared upstream body."""
+    if flight.state != "completed":
+        return 502, [('Content-Type', 'text/plain; charset=utf-8')], b"Proxy error: The shared upstream response was interrupted."
+    final_content_to_client, final_headers_to_client = build_buffered_response(proxy_req, flight.status, headers, content)
+    record_response_sent(proxy_req, len(final_content_to_client))
+    return flight.status, final_headers_to_client, final_content_to_client
+
+def follow_flight_stream(proxy_req, flight, response_mode):
+    """Generator streaming the shared upstream body of `flight` to a follower (sync engine)."""
+    converter = FollowerResponseConverter(proxy_req, flight, response_mode)
+    for chunk in flight.iter_chunks():
+        data = converter.feed(chunk)
+        if data:
+            yield data
+    tail = converter.finish()
+    if tail:
+        yield tail
+
+def build_follower_response(proxy_req, flight):
+    """Sync engine: returns (status, headers, body) for a request coalesced into `flight`."""
+    response_mode, headers = follower_response_headers(proxy_req, flight)
+    if response_mode in ("openai_stream", "passthrough"):
+        return flight.status, headers, metered_stream(proxy_req, follow_flight_stream(proxy_req, flight, response_mode))
+    return build_follower_buffered_response(proxy_req, flight, headers, b"".join(flight.iter_chunks()))
+
+def is_metrics_request(path, method):
+    """Checks if the request asks for the metrics (GET METRICS_PATH)."""
+    return METRICS_ENABLED and method == 'GET' and path.strip('/') == METRICS_PATH.strip('/')
+
+def build_metrics_response(header_items):
+    """Returns (status, headers, body) with the metrics in the Prometheus text format."""
+    if METRICS_REQUIRE_TOKEN:
+        incoming_headers = {key.lower(): value for key, value in header_items}
+        auth_value = incoming_headers.get('authorization', '')
+        token = incoming_headers.get('x-goog-api-key') or (auth_value[7:] if auth_value.lower().startswith('bearer ') else None)
+        if token != PLACEHOLDER_TOKEN:
+            logging.warning("Metrics request rejected: Invalid placeholder token provided.")
+            return 401, [('Content-Type', 'text/plain; charset=utf-8')], b"Invalid API key/token provided."
+    return 200, [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')], metrics_registry.render()
+
+# --- Flask Application ---
+app = Flask(__name__)
+
+@app.after_request
+def count_client_request(response):
+    if not is_metrics_request(request.path, request.method):
+        record_client_request(request.path, response.status_code)
+    return response
+
+def proxy_error_response(error):
+    """Builds the plain-text Flask response for a ProxyRequestError."""
+    headers = {'Retry-After': str(error.retry_after)} if error.retry_after is not None else None
+    return Response(error.message, status=error.status, mimetype='text/plain', headers=headers)
+
+@app.route('/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'OPTIONS'])
+def proxy(path):
+    """
+    Handles incoming requests, validates placeholder token, selects an available API key
+    (skipping exhausted ones), tracks usage, handles 429 errors by marking keys
+    as exhausted for the day, forwards the request (potentially converting formats),
+    and returns the response (potentially converting formats).
+    """
+    if is_metrics_request(path, request.method):
+        status, headers, body = build_metrics_response(request.headers.items())
+        return Response(body, status, headers)
+    request_id_var.set(f"{random.getrandbits(64):016x}")
+    request_start_time = time.time()
+    if is_openai_embeddings_request(path):
         try:
-            # target_path is like "v1beta/models/gemini-pro:generateContent" or "v1/models/gemini-1.5-flash"
-            path_segments = target_path.split('/')
-            if 'models' in path_segments:
-                models_idx = path_segments.index('models')
-                if models_idx + 1 < len(path_segments):
-                    effective_model_for_request = path_segments[models_idx + 1].split(':')[0]
-            
-            if not effective_model_for_request: # Fallback for slightly different structures if needed
-                 logging.warning(f"Could not determine model from direct Gemini path structure: {target_path}")
+            emb_req = prepare_embedding_request(path, request.method, request.headers.items(), request.get_data(), request_start_time)
+            status, headers, body = serve_embeddings_request(emb_req)
+        except ProxyRequestError as e:
+            return proxy_error_response(e)
+        headers, body = compress_response(request.headers.get('Accept-Encoding'), status, headers, body)
+        return Response(body, status, headers)
+    try:
+        proxy_req = prepare_proxy_request(
+            path, request.method, request.headers.items(), request.args.to_dict(),
+            request.get_data(), request_start_time)
+    except ProxyRequestError as e:
+        return proxy_error_response(e)
+    response = serve_proxy_request(proxy_req)
+    server_timing = response_headers_ready(proxy_req, response.status_code, response.is_streamed)
+    if server_timing:
+        response.headers['Server-Timing'] = server_timing
+    return compress_flask_response(response, proxy_req.accept_encoding)
 
-        except ValueError: # 'models' not in path_segments
-            logging.warning(f"Path structure for direct Gemini request does not contain 'models' segment: {target_path}")
-        except Exception as e:
-            logging.error(f"Error parsing model from direct Gemini path {target_path}: {e}", exc_info=True)
+def serve_proxy_request(proxy_req):
+    """Answers `proxy_req` from the response cache, an identical in-flight request or upstream. Returns the Flask response."""
+    if proxy_req.cached_entry is not None:
+        status, headers, body = build_cached_response(proxy_req)
+        return Response(body, status, headers)
 
-    if not effective_model_for_request:
-        logging.error(f"Critical: Model for request could not be determined for path '{original_request_path}' (target: '{target_path}'). Cannot apply model-specific exhaustion logic.")
-        return Response("Proxy error: Could not determine model for request to apply exhaustion rules.", status=500, mimetype='text/plain')
-    
-    logging.info(f"Effective model for this request (for exhaustion logic): {effective_model_for_request}")
+    # --- Request Coalescing: share the upstream call of an identical in-flight request ---
+    flight, is_leader = request_coalescer.join(proxy_req)
+    if flight is not None and not is_leader:
+        served = flight.wait_published()
+        request_coalescer.record_follower(proxy_req.model, served)
+        if served:
+            logging.info(f"Request for model '{proxy_req.model}' coalesced with an identical in-flight request, no API key used.")
+            status, headers, body = build_follower_response(proxy_req, flight)
+            return Response(body, status, headers)
+        flight = None # The identical request got no upstream response, send our own
+    proxy_req.flight = flight
+    streamed = False
+    try:
+        proxy_req.admission = admission_controller.acquire(proxy_req.model)
+        response = forward_request(proxy_req)
+        streamed = response.is_streamed # A streamed response keeps its slot until it ends
+        return response
+    except ProxyRequestError as e:
+        return proxy_error_response(e)
+    finally:
+        if not streamed:
+            proxy_req.release_admission()
+        if flight is not None:
+            flight.release_unpublished()
+
+# Runs the attempts of hedged requests. Sized like the upstream pool, which limits the
+# number of concurrent upstream requests anyway.
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+
+def get_hedge_executor():
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _hedge_executor_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(max_workers=UPSTREAM_POOL_MAXSIZE, thread_name_prefix="hedge")
+    return _hedge_executor
+
+def _timed_upstream_request(proxy_req, api_key):
+    """Sends one attempt and records its outcome in key_stats. Returns (response, seconds until the headers arrived)."""
+    key_stats.start(api_key, proxy_req.model)
+    started = time.monotonic()
+    started_at = time.time()
+    try:
+        resp = get_upstream_client().request(**proxy_req.build_attempt(api_key))
+    except Exception as e:
+        key_stats.finish(api_key, proxy_req.model, None, error=True)
+        circuit_breakers.record(api_key, failed=True)
+        UPSTREAM_RESPONSES.inc((proxy_req.model, "error"))
+        proxy_req.trace.add_attempt(api_key, started_at, error=type(e).__name__)
+        raise
+    elapsed = time.monotonic() - started
+    UPSTREAM_RESPONSES.inc((proxy_req.model, str(resp.status_code)))
+    proxy_req.trace.add_attempt(api_key, started_at, resp.status_code)
+    UPSTREAM_TTFB.observe(elapsed, (proxy_req.model,))
+    key_stats.finish(api_key, proxy_req.model, elapsed, error=resp.status_code == 429 or resp.status_code >= 500)
+    circuit_breakers.record(api_key, failed=resp.status_code >= 500)
+    return resp, elapsed
+
+def settle_hedge_loser(model, api_key, resp):
+    """
+    Accounts for the attempt that lost a hedge race (it reached upstream) and discards its
+    response. Like a primary attempt, an upstream 5xx is not key usage; _timed_upstream_request()
+    has already counted it as a failure in key_stats and circuit_breakers.
+    """
+    try:
+        if resp.status_code == 429:
+            handle_rate_limited_key(api_key, model, resp.content)
+        elif resp.status_code < 500:
+            record_key_usage(api_key, model)
+        else:
+            logging.debug(f"Losing hedged attempt with key ...{api_key[-4:]} got upstream status {resp.status_code}")
+    finally:
+        resp.close()
+
+def _settle_hedge_loser_future(model, api_key, future):
+    try:
+        resp, _ = future.result()
+    except Exception as e:
+        logging.debug(f"Losing hedged attempt with key ...{api_key[-4:]} failed: {e}")
+        return
+    settle_hedge_loser(model, api_key, resp)
+
+def send_upstream_attempt(proxy_req, api_key, key_iter):
+    """
+    Sends `proxy_req` upstream with `api_key` and returns (api_key, response). With hedging,
+    a duplicate is sent with the next key of `key_iter` if no answer arrived within the hedge
+    delay; then (key, response) of the first answer is returned. A 429 does not count as an
+    answer while the other attempt is still running. The losing attempt cannot be interrupted
+    on the sync engine: it finishes in the background and is then discarded and accounted for.
+    """
+    if not hedge_policy.hedgeable(proxy_req):
+        return api_key, _timed_upstream_request(proxy_req, api_key)[0]
+    model = proxy_req.model
+    hedge_delay = hedge_policy.start_request(model)
+    if hedge_delay is None: # Not enough latency samples yet, just measure this attempt
+        resp, elapsed = _timed_upstream_request(proxy_req, api_key)
+        if resp.status_code != 429:
+            hedge_policy.record_latency(model, elapsed)
+        return api_key, resp
+
+    executor = get_hedge_executor()
+    # Attempts run in the request's context, so their log records keep its request id
+    attempts = {executor.submit(contextvars.copy_context().run, _timed_upstream_request, proxy_req, api_key): api_key}
+    done, _ = wait(attempts, timeout=hedge_delay)
+    if not done and hedge_policy.try_acquire():
+        hedge_key = next(key_iter, None)
+        if hedge_key is None:
+            hedge_policy.release()
+        else:
+            logging.info(f"No answer for model '{model}' after {hedge_delay:.2f}s, hedging with key ...{hedge_key[-4:]}")
+            attempts[executor.submit(contextvars.copy_context().run, _timed_upstream_request, proxy_req, hedge_key)] = hedge_key
+
+    winner = None
+    first_error = None
+    pending = set(attempts)
+    while pending and winner is None:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            attempt_key = attempts[future]
+            try:
+                resp, elapsed = future.result()
+            except Exception as e: # Re-raised below if no attempt answers
+                first_error = first_error or e
+                continue
+            if winner is not None: # Both answered at once, keep the first
+                settle_hedge_loser(model, attempt_key, resp)
+            elif resp.status_code == 429 and pending:
+                # Rate limited while the other attempt may still answer
+                handle_rate_limited_key(attempt_key, model, resp.content)
+            else:
+                if resp.status_code != 429:
+                    hedge_policy.record_latency(model, elapsed)
+                winner = (attempt_key, resp)
+    for future in pending:
+        future.add_done_callback(lambda f, key=attempts[future]: _settle_hedge_loser_future(model, key, f))
+    if winner is None:
+        raise first_error
+    if len(attempts) > 1 and winner[0] != api_key:
+        logging.info(f"Hedged attempt with key ...{winner[0][-4:]} answered first for model '{model}'.")
+        hedge_policy.record_win()
+    return winner
 
+def forward_request(proxy_req):
+    """Sends `proxy_req` upstream with the next usable keys and returns the Flask response."""
     # --- Key Selection and Request Loop (Selects actual Gemini key for upstream) ---
-    max_retries = len(all_api_keys) # Max attempts = number of keys
-    keys_tried_this_request = 0
-
-    # Check if all keys are already exhausted for this specific model before starting the loop
-    if not all_api_keys: # Should be caught by earlier check, but defensive
-        logging.error("API keys not loaded. Cannot process request.")
-        return Response("Proxy server error: API keys not loaded.", status=503)
-
-    all_keys_exhausted_for_model = True
-    for key_in_list in all_api_keys:
-        if effective_model_for_request not in exhausted_keys_today.get(key_in_list, set()):
-            all_keys_exhausted_for_model = False
-            break
-    if all_keys_exhausted_for_model:
-        logging.warning(f"All API keys are marked as exhausted for model '{effective_model_for_request}' today. Rejecting request.")
-        return Response(f"All available API keys have reached their daily limit for model '{effective_model_for_request}'.", status=503, mimetype='text/plain')
-
-    while keys_tried_this_request < max_retries:
-        try:
-            next_key = next(key_cycler)
-            keys_tried_this_request += 1
-
-            # Skip if key is already known to be exhausted for this specific model today
-            if effective_model_for_request in exhausted_keys_today.get(next_key, set()):
-                logging.debug(f"Skipping key ending ...{next_key[-4:]} for model '{effective_model_for_request}' as it's marked exhausted today.")
-                continue # Try the next key in the cycle
-
-            logging.info(f"Attempting request for model '{effective_model_for_request}' with key ending ...{next_key[-4:]}")
-            outgoing_headers[api_key_header_gemini] = next_key # Set the actual Gemini key for the upstream request
-
-            # --- Request Forwarding ---
-            # Use the potentially converted JSON body
-            request_body_to_send = json.dumps(gemini_request_body_json).encode('utf-8') if gemini_request_body_json else b''
-
-            logging.debug(f"Forwarding request body size: {len(request_body_to_send)} bytes")
-            if LOG_LEVEL == logging.DEBUG and request_body_to_send:
-                 try:
-                      logging.debug(f"Forwarding request body: {request_body_to_send.decode('utf-8', errors='ignore')}")
-                 except Exception:
-                      logging.debug("Could not decode forwarding request body for logging.")
-
-            # Determine method - OpenAI endpoint is always POST
-            forward_method = 'POST' if is_openai_format else request.method
-            logging.info(f"Forwarding {forward_method} request to: {target_url} with key ...{next_key[-4:]}")
-            logging.debug(f"Forwarding with Query Params: {query_params}")
-            logging.debug(f"Forwarding with Headers: {outgoing_headers}")
-
-            # Make the request to the actual Google Gemini API
-            # Pass query params only if it wasn't an OpenAI request (OpenAI params are in body)
-            forward_params = query_params if not is_openai_format else None
-            # Determine if the *forwarded* request should be streaming based on Gemini endpoint
-            forward_stream = target_path.endswith("streamGenerateContent")
-
-            resp = requests.request(
-                method=forward_method,
-                url=target_url,
-                headers=outgoing_headers,
-                params=forward_params,
-                data=request_body_to_send,
-                stream=forward_stream, # Use stream based on Gemini target path
-                timeout=120
-            )
-
-            logging.info(f"Received response Status: {resp.status_code} from {target_url} using key ...{next_key[-4:]}")
+    next_key = None
+    candidates = KeyCandidates(proxy_req.model, proxy_req.estimated_tokens, context_cache.preferred_keys(proxy_req))
+    key_iter = iter(candidates)
+    retries = 0
+    failure = None # Response to the last transient failure, returned if no key is left to retry on
+    phase_start = time.perf_counter()
+    for next_key in key_iter:
+        upstream_start = time.perf_counter()
+        proxy_req.trace.add_phase("key_select", upstream_start - phase_start)
+        try:
+            # With hedging, the answer may have come from another key
+            next_key, resp = send_upstream_attempt(proxy_req, next_key, key_iter)
+            if resp.status_code in CONTEXT_CACHE_REJECTION_STATUSES and proxy_req.context_cache_refs.get(next_key) \
+                    and context_cache.rejected(proxy_req, next_key, resp.status_code, resp.content):
+                # The referenced context cache is gone upstream: resend in full with the same key
+                next_key, resp = send_upstream_attempt(proxy_req, next_key, key_iter)
+            phase_start = time.perf_counter()
+            proxy_req.trace.add_phase("upstream", phase_start - upstream_start)
+            logging.info(f"Received response Status: {resp.status_code} from {proxy_req.target_url} using key ...{next_key[-4:]}",
+                         extra={"fields": {"model": proxy_req.model, "key": key_label(next_key), "status": resp.status_code}})
 
             # --- Handle 429 Rate Limit Error ---
             if resp.status_code == 429:
-                logging.warning(f"Key ending ...{next_key[-4:]} hit rate limit (429) for model '{effective_model_for_request}'. Marking this model as exhausted for this key today.")
-                exhausted_keys_today.setdefault(next_key, set()).add(effective_model_for_request)
-                save_usage_data() # Save the updated exhausted list
-
-                # Check if all keys are now exhausted for this specific model after this failure
-                all_now_exhausted_for_model = True
-                for key_in_all_keys in all_api_keys:
-                    if effective_model_for_request not in exhausted_keys_today.get(key_in_all_keys, set()):
-                        all_now_exhausted_for_model = False
-                        break
-                if all_now_exhausted_for_model:
-                    logging.warning(f"All API keys are now exhausted for model '{effective_model_for_request}' after 429 error. Last key tried: ...{next_key[-4:]}")
-                    return Response(f"All available API keys have reached their daily limit for model '{effective_model_for_request}'.", status=503, mimetype='text/plain')
-                
+                # Reading the small error body also returns the connection to the pool
+                handle_rate_limited_key(next_key, proxy_req.model, resp.content)
                 continue # Continue the loop to try the next available key
 
-            # --- Success or Other Error ---
-            # Increment usage count ONLY if the request didn't result in 429
-            current_total_count = key_usage_counts.get(next_key, 0) + 1
-            key_usage_counts[next_key] = current_total_count
-
-            # Determine the model used for this request (for usage logging, distinct from effective_model_for_request used for exhaustion)
-            # `effective_model_for_request` is already determined and should be the same as `actual_model_used` here.
-            actual_model_used = effective_model_for_request 
-            # The old logic for actual_model_used is fine, but effective_model_for_request is already available and more robustly determined earlier.
-
-            # Update model-specific usage count
-            if next_key not in model_usage_counts:
-                model_usage_counts[next_key] = {}
-            current_model_count = model_usage_counts[next_key].get(actual_model_used, 0) + 1
-            model_usage_counts[next_key][actual_model_used] = current_model_count
-
-            logging.info(f"Key ending ...{next_key[-4:]} used for model '{actual_model_used}'. Today's model usage: {current_model_count}. Total usage for key: {current_total_count}")
-            save_usage_data() # Save updated counts, model counts, and potentially exhausted list
-
-            # --- Response Handling ---
-            logging.debug(f"Response Headers from Google: {dict(resp.headers)}")
-            excluded_headers = ['content-encoding', 'content-length', 'transfer-encoding', 'connection']
-            response_headers = [
-                (key, value) for key, value in resp.raw.headers.items()
-                if key.lower() not in excluded_headers
-            ]
-            logging.debug(f"Forwarding response headers to client: {response_headers}")
+            # --- Retry transient upstream errors on another key ---
+            if resp.status_code in RETRY_STATUSES:
+                delay = retry_policy.next_delay(proxy_req, retries, f"status {resp.status_code}", next_key)
+                if delay is not None:
+                    resp.close()
+                    retries += 1
+                    time.sleep(delay)
+                    phase_start = time.perf_counter()
+                    continue
+            else:
+                # --- Success or Other Error (upstream 5xx don't count as usage) ---
+                record_key_usage(next_key, proxy_req.model)
 
             # --- Response Handling & Potential Conversion ---
+            if proxy_req.log_bodies:
+                logging.debug("Response Headers from Google: %s", dict(resp.headers))
+            response_headers = build_client_response_headers(resp.header_items())
+            response_mode = proxy_req.response_mode(resp.status_code)
 
-            final_headers_to_client = response_headers
-            final_status_code = resp.status_code
+            # Translate each Gemini SSE event into an OpenAI chunk as soon as it arrives
+            if response_mode == "openai_stream":
+                sink = start_response_sink(proxy_req, resp.status_code, response_headers)
+                body = metered_stream(proxy_req, stream_openai_from_gemini_sse(resp, proxy_req, next_key[-4:], sink))
+                return Response(body, status=resp.status_code, headers=openai_stream_headers(response_headers))
+            # Relay the upstream body chunk by chunk; only a small tail is held back to filter trailing errors
+            if response_mode == "passthrough":
+                sink = start_response_sink(proxy_req, resp.status_code, response_headers)
+                # Without any need to look into the body, relay it still compressed
+                encoding = passthrough_encoding(proxy_req, resp, sink)
+                if encoding:
+                    body = metered_stream(proxy_req, relay_encoded_response(resp, encoding, next_key[-4:]))
+                    return Response(body, status=resp.status_code, headers=encoded_passthrough_headers(response_headers, encoding))
+                body = metered_stream(proxy_req, relay_upstream_response(resp, resp.status_code == 200, next_key[-4:], sink))
+                return Response(body, status=resp.status_code, headers=response_headers)
 
-            # --- Handle Non-Streaming and Direct Gemini Requests / Read Content ---
-            # Read the raw content for all non-streaming cases or direct Gemini requests
-            raw_response_content = resp.content
-            final_content_to_client = raw_response_content # Default
+            share_buffered_response(proxy_req, resp.status_code, response_headers, resp.content)
+            final_content_to_client, final_headers_to_client = build_buffered_response(proxy_req, resp.status_code, response_headers, resp.content)
+            record_response_sent(proxy_req, len(final_content_to_client))
+            return Response(final_content_to_client, resp.status_code, final_headers_to_client)
 
-            # --- Filter out trailing Google API error JSON (if applicable and status was 200) ---
-            if final_status_code == 200 and raw_response_content:
-                try:
-                    # Decode the whole content
-                    decoded_content = raw_response_content.decode('utf-8', errors='replace').strip()
-
-                    # Check if it potentially ends with a JSON object
-                    if decoded_content.endswith('}'):
-                        # Find the start of the last potential JSON object (look for the last '{' preceded by a newline)
-                        # This is heuristic, assuming the error JSON is the last significant block.
-                        last_block_start = decoded_content.rfind('\n{') # Find last occurrence
-                        if last_block_start == -1:
-                             last_block_start = decoded_content.rfind('\n\n{') # Try double newline just in case
-
-                        if last_block_start != -1:
-                            potential_error_json_str = decoded_content[last_block_start:].strip()
-                            try:
-                                error_json = json.loads(potential_error_json_str)
-                                # Check if it matches the Google error structure
-                                if isinstance(error_json, dict) and 'error' in error_json and isinstance(error_json['error'], dict) and 'code' in error_json['error'] and 'status' in error_json['error']:
-                                    logging.warning(f"Detected and filtering out trailing Google API error JSON: {potential_error_json_str}")
-                                    # Truncate the content *before* the start of this detected error block
-                                    valid_content = decoded_content[:last_block_start].strip()
-                                    # Add back trailing newline(s) for SSE format consistency
-                                    if valid_content:
-                                         valid_content += '\n\n' # Add double newline typical for SSE
-
-                                    raw_response_content = valid_content.encode('utf-8') # Update raw_response_content
-                                else:
-                                    logging.debug("Potential JSON at end doesn't match Google error structure.")
-                            except json.JSONDecodeError:
-                                logging.debug("String at end ending with '}' is not valid JSON.")
-                        else:
-                             logging.debug("Could not find a potential start ('\\n{') for a JSON block at the end.")
-                    else:
-                        logging.debug("Content does not end with '}'.")
-
-                except Exception as filter_err:
-                    logging.error(f"Error occurred during revised response filtering: {filter_err}", exc_info=True)
-                    # Keep raw_response_content as is if filtering fails
-            # --- End Filtering ---
-
-            # --- Convert OpenAI response format (Streaming or Non-Streaming) ---
-            if is_openai_format and final_status_code == 200:
-                 try:
-                      logging.debug("Attempting to convert Gemini response to OpenAI format (Streaming or Non-Streaming).")
-                      # Use the potentially filtered raw_response_content here
-                      decoded_gemini_content = raw_response_content.decode('utf-8', errors='replace')
-
-                      # --- Streaming Conversion (from JSON Array) ---
-                      if use_stream_endpoint:
-                           def stream_converter_from_array():
-                                chunk_id_counter = 0
-                                created_timestamp = int(time.time())
-                                try:
-                                     gemini_response_array = json.loads(decoded_gemini_content)
-                                     if not isinstance(gemini_response_array, list):
-                                          logging.error("Gemini stream response was not a JSON array as expected.")
-                                          # Optionally yield an error chunk?
-                                          yield "data: [DONE]\n\n".encode('utf-8') # Send DONE anyway?
-                                          return
-
-                                     for gemini_chunk in gemini_response_array:
-                                          # Extract text content from Gemini chunk
-                                          text_content = ""
-                                          # Check for potential errors within the stream itself
-                                          if gemini_chunk.get("candidates") is None and gemini_chunk.get("error"):
-                                               logging.error(f"Error object found within Gemini response array: {gemini_chunk['error']}")
-                                               # Stop processing this stream
-                                               break
-
-                                          if gemini_chunk.get("candidates"):
-                                               content = gemini_chunk["candidates"][0].get("content", {})
-                                               if content.get("parts"):
-                                                    text_content = content["parts"][0].get("text", "")
-
-                                          if text_content: # Only yield if there's content
-                                               # Construct OpenAI SSE chunk
-                                               openai_chunk = {
-                                                    "id": f"chatcmpl-{uuid.uuid4()}",
-                                                    "object": "chat.completion.chunk",
-                                                    "created": created_timestamp,
-                                                    "model": target_gemini_model,
-                                                    "choices": [{
-                                                         "index": 0,
-                                                         "delta": { "content": text_content },
-                                                         "finish_reason": None
-                                                    }]
-                                               }
-                                               sse_data = f"data: {json.dumps(openai_chunk, ensure_ascii=False)}\n\n"
-                                               yield sse_data.encode('utf-8')
-                                               chunk_id_counter += 1
-
-                                except json.JSONDecodeError:
-                                     logging.error(f"Failed to decode Gemini response array: {decoded_gemini_content}")
-                                     # Optionally yield an error chunk?
-                                except Exception as e:
-                                     logging.error(f"Error processing Gemini response array: {e}", exc_info=True)
-
-                                # Send the final [DONE] signal
-                                yield "data: [DONE]\n\n".encode('utf-8')
-                                logging.info(f"Finished streaming conversion from array, sent {chunk_id_counter} content chunks.")
-
-                           # Set the response to use the generator and correct headers
-                           final_headers_to_client = [('Content-Type', 'text/event-stream'), ('Cache-Control', 'no-cache')] + [h for h in response_headers if h[0].lower() not in ['content-type', 'content-length', 'transfer-encoding']]
-                           # Return the generator directly
-                           return Response(stream_converter_from_array(), status=final_status_code, headers=final_headers_to_client)
-
-                      # --- Non-Streaming Conversion ---
-                      else:
-                           gemini_full_response = json.loads(decoded_gemini_content)
-                      # Extract text content (simplified)
-                      full_text = ""
-                      openai_finish_reason = "stop" # Default
-
-                      if gemini_full_response.get("candidates"):
-                           candidate = gemini_full_response["candidates"][0]
-                           full_text = candidate.get("content", {}).get("parts", [{}])[0].get("text", "")
-                           # Map finish reason
-                           gemini_finish_reason = candidate.get("finishReason", "STOP")
-                           if gemini_finish_reason == "MAX_TOKENS":
-                                openai_finish_reason = "length"
-                           elif gemini_finish_reason == "SAFETY":
-                                openai_finish_reason = "content_filter"
-                           # Add other mappings if needed (RECITATION, OTHER)
-
-                      # Corrected structure for openai_response
-                      openai_response = {
-                          "id": f"chatcmpl-{uuid.uuid4()}",
-                          "object": "chat.completion",
-                          "created": int(time.time()),
-                          "model": target_gemini_model,
-                          "choices": [{
-                              "index": 0,
-                              "message": {
-                                  "role": "assistant",
-                                  "content": full_text,
-                              },
-                              "finish_reason": openai_finish_reason # Use mapped reason
-                          }],
-                          "usage": { # Map from Gemini usageMetadata
-                              "prompt_tokens": gemini_full_response.get("usageMetadata", {}).get("promptTokenCount", 0),
-                              "completion_tokens": gemini_full_response.get("usageMetadata", {}).get("candidatesTokenCount", 0),
-                              "total_tokens": gemini_full_response.get("usageMetadata", {}).get("totalTokenCount", 0)
-                          }
-                      }
-                      final_content_to_client = json.dumps(openai_response, ensure_ascii=False).encode('utf-8') # Use correct variable
-                      # Update headers for JSON
-                      final_headers_to_client = [('Content-Type', 'application/json')] + [h for h in response_headers if h[0].lower() not in ['content-type', 'content-length', 'transfer-encoding']]
-
-                      logging.info("Successfully converted non-streaming Gemini response to OpenAI format.")
-
-                 except Exception as convert_err:
-                      logging.error(f"Error converting Gemini response to OpenAI format: {convert_err}", exc_info=True)
-                      # Fallback: Return original Gemini content but maybe signal error?
-                      # For now, just return the filtered Gemini content with original headers/status
-                      final_content_to_client = raw_response_content # Use the (potentially filtered) raw content
-                      final_headers_to_client = response_headers
-                      # Consider changing status code? Maybe 500?
-                      # final_status_code = 500 # Indicate conversion failure
+        except requests.exceptions.Timeout:
+            logging.error(f"Timeout error when forwarding request to {proxy_req.target_url} with key ...{next_key[-4:]}")
+            # Don't mark key as exhausted for timeout; retried on another key while the deadline allows
+            failure = Response("Proxy error: Upstream request timed out.", status=504, mimetype='text/plain')
+            reason = "timeout"
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Error forwarding request to {proxy_req.target_url} with key ...{next_key[-4:]}: {e}", exc_info=True)
+            # Don't mark key as exhausted; retried on another key while the deadline allows
+            failure = Response(f"Proxy error: Could not connect to upstream server. {e}", status=502, mimetype='text/plain')
+            reason = "connection error"
+        except Exception as e:
+            logging.error(f"An unexpected error occurred in the proxy function with key ...{next_key[-4:]}: {e}", exc_info=True)
+            # Stop trying for this request.
+            return Response("Proxy server internal error.", status=500, mimetype='text/plain')
+
+        # Only a timeout or connection error gets here
+        delay = retry_policy.next_delay(proxy_req, retries, reason, next_key)
+        if delay is None:
+            return failure
+        retries += 1
+        time.sleep(delay)
+        phase_start = time.perf_counter()
 
+    if failure is not None: # The keys left after a transient failure were unusable
+        return failure
+    # If the loop finishes without returning (all keys were tried, exhausted or over their local limits)
+    return proxy_error_response(no_usable_key_error(proxy_req.model, candidates.retry_after))
+
+def serve_embeddings_request(emb_req):
+    """
+    Adds the inputs of `emb_req` to embedding batches, sends the batches it leads and waits for
+    the others. Returns (status, headers, body).
+    """
+    parts = embedding_batcher.join(emb_req)
+    for batch, _, _, is_leader in parts:
+        if is_leader:
+            lead_embedding_batch(batch)
+    for batch, _, _, _ in parts:
+        batch.wait(lambda batch=batch: batch.state == "done")
+    return build_embeddings_response(emb_req, parts)
+
+def lead_embedding_batch(batch):
+    """Waits for the batching window (or a full batch), then sends `batch` upstream."""
+    batch.wait(lambda: batch.state != "open", embedding_batcher.window_seconds())
+    embedding_batcher.seal(batch)
+    ticket = None
+    try:
+        ticket = admission_controller.acquire(batch.model)
+        send_embedding_batch(batch)
+    except ProxyRequestError as e:
+        batch.finish(error=e)
+    finally:
+        admission_controller.release(ticket)
+        # Never leave the other requests of the batch waiting
+        batch.finish(error=ProxyRequestError(500, "Proxy server internal error."))
+        embedding_batcher.maybe_log()
+
+def send_embedding_batch(batch):
+    """Sends `batch` upstream as one batchEmbedContents call with the next usable keys and stores the result."""
+    proxy_req = batch.upstream_request()
+    next_key = None
+    candidates = KeyCandidates(batch.model, batch.estimated_tokens)
+    key_iter = iter(candidates)
+    retries = 0
+    failure = None # ProxyRequestError of the last timeout or connection error
+    for next_key in key_iter:
+        try:
+            # With hedging, the answer may have come from another key
+            next_key, resp = send_upstream_attempt(proxy_req, next_key, key_iter)
+            logging.info(f"Received response Status: {resp.status_code} for a batch of {len(batch.requests)} embeddings using key ...{next_key[-4:]}",
+                         extra={"fields": {"model": batch.model, "key": key_label(next_key), "status": resp.status_code}})
+            if resp.status_code == 429:
+                handle_rate_limited_key(next_key, batch.model, resp.content)
+                continue # Try the next available key
+            if resp.status_code in RETRY_STATUSES:
+                delay = retry_policy.next_delay(proxy_req, retries, f"status {resp.status_code}", next_key)
+                if delay is not None:
+                    resp.close()
+                    retries += 1
+                    time.sleep(delay)
+                    continue
             else:
-                 # Use the potentially filtered content directly for non-OpenAI requests or errors
-                 final_content_to_client = raw_response_content
+                # One request of the key's quota for the whole batch
+                record_key_usage(next_key, batch.model)
+            batch.set_response(resp.status_code, resp.content)
+            return
+        except requests.exceptions.Timeout:
+            logging.error(f"Timeout error when forwarding request to {proxy_req.target_url} with key ...{next_key[-4:]}")
+            failure = ProxyRequestError(504, "Proxy error: Upstream request timed out.")
+            reason = "timeout"
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Error forwarding request to {proxy_req.target_url} with key ...{next_key[-4:]}: {e}", exc_info=True)
+            failure = ProxyRequestError(502, f"Proxy error: Could not connect to upstream server. {e}")
+            reason = "connection error"
+        delay = retry_policy.next_delay(proxy_req, retries, reason, next_key)
+        if delay is None:
+            break
+        retries += 1
+        time.sleep(delay)
+    batch.finish(error=failure or no_usable_key_error(batch.model, candidates.retry_after))
 
+# --- Asyncio / ASGI Engine ---
+# Serves the same routes with the same key rotation, exhaustion tracking and usage
+# accounting as proxy(), but on one event loop with an async upstream client, so a
+# long-running generation holds a coroutine instead of a whole thread.
+async def key_state_call(func, *args):
+    """
+    Calls a key state function (key selection, usage accounting, ...) from the event loop. With
+    the "sqlite" backend it may wait for another worker's write transaction, so it runs in a
+    thread instead of stalling every connection of the process; in memory it is cheap enough.
+    """
+    if USAGE_STATE_BACKEND == "sqlite":
+        return await asyncio.to_thread(func, *args)
+    return func(*args)
 
-            # --- Create final response (only if not streaming OpenAI, which returns earlier) ---
-            response = Response(final_content_to_client, final_status_code, final_headers_to_client)
+class AsyncUpstreamResponse:
+    """Async counterpart of UpstreamResponse wrapping an httpx response."""
 
-            # Logging the final response size might be misleading for streams handled by the generator
-            if not (is_openai_format and use_stream_endpoint):
-                 logging.debug(f"Final response body size sent to client: {len(final_content_to_client)} bytes")
-            # Log the full final response body if debug level is enabled
-            if LOG_LEVEL == logging.DEBUG and final_content_to_client:
-                try:
-                    # Attempt to decode for readability, log raw bytes on failure
-                    # Use final_content_to_client here
-                    decoded_body = final_content_to_client.decode('utf-8', errors='replace')
-                    logging.debug(f"Full Response body sent to client (decoded): {decoded_body}")
-                except Exception as log_err:
-                    # Log the correct variable in the error message too
-                    logging.debug(f"Could not decode final response body for logging, logging raw bytes: {final_content_to_client!r}. Error: {log_err}")
-            elif final_content_to_client: # Log first 500 chars if not in DEBUG mode but content exists
-                 try:
-                      logging.info(f"Response body sent to client (first 500 chars): {final_content_to_client[:500].decode('utf-8', errors='ignore')}")
-                 except Exception:
-                      logging.info("Could not decode start of final response body for logging.")
-
-
-            return response # Return the potentially filtered response
+    def __init__(self, httpx_module, resp):
+        self._httpx = httpx_module
+        self._resp = resp
+        self.status_code = resp.status_code
+        self.headers = resp.headers
+        self._content = None
+
+    def header_items(self):
+        return self._resp.headers.multi_items()
+
+    async def aiter_content(self, raw=False):
+        """Yields the body as it arrives; with `raw`, without decoding its Content-Encoding."""
+        try:
+            async for chunk in (self._resp.aiter_raw() if raw else self._resp.aiter_bytes()):
+                yield chunk
+        except self._httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e)) from e
+        except self._httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+        finally:
+            await self._resp.aclose()
+
+    @property
+    def content_read(self):
+        return self._content is not None
+
+    async def aread(self):
+        """Reads (once) and returns the complete response body."""
+        if self._content is None:
+            self._content = b"".join([chunk async for chunk in self.aiter_content()])
+        return self._content
+
+    async def aclose(self):
+        await self._resp.aclose()
+
+class AsyncUpstreamClient:
+    """
+    Shared httpx.AsyncClient for the asyncio engine. Raises the same requests exception
+    types as UpstreamClient so both engines handle upstream failures identically.
+    """
+
+    def __init__(self, base_url=GEMINI_API_BASE_URL):
+        import httpx
+        self._httpx = httpx
+        self.base_url = base_url
+        http2 = False
+        if UPSTREAM_HTTP2:
+            try:
+                import h2 # noqa: F401 - httpx needs the h2 package for HTTP/2
+                http2 = True
+            except ImportError:
+                logging.warning("UPSTREAM_HTTP2 is enabled but the h2 package is not installed. Falling back to HTTP/1.1.")
+        self.http2 = http2
+        self._client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=ASYNC_UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=UPSTREAM_POOL_MAXSIZE if UPSTREAM_KEEPALIVE else 0,
+                keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY),
+            timeout=None)
+        logging.info(f"Async upstream client initialized for {base_url}. HTTP/2: {http2}, max connections: {ASYNC_UPSTREAM_MAX_CONNECTIONS}")
+
+    async def request(self, method, url, headers=None, params=None, data=None, stream=False, timeout=120):
+        headers = dict(headers or {})
+        if not UPSTREAM_KEEPALIVE:
+            headers["connection"] = "close"
+        connection_events = []
+        async def trace(event_name, info):
+            if event_name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+                connection_events.append(event_name)
+        try:
+            req = self._client.build_request(
+                method, url, headers=headers, params=params, content=data,
+                timeout=timeout, extensions={"trace": trace})
+            resp = await self._client.send(req, stream=True)
+        except self._httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e)) from e
+        except self._httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+
+        if "connection.connect_tcp.complete" in connection_events:
+            upstream_pool_stats.record_new_connection(tls="connection.start_tls.complete" in connection_events)
+        upstream_pool_stats.record_request()
+        upstream_pool_stats.maybe_log()
+        wrapped = AsyncUpstreamResponse(self._httpx, resp)
+        if not stream:
+            await wrapped.aread() # Read the body now so the connection returns to the pool
+        return wrapped
+
+    async def warm(self, count):
+        """Opens `count` upstream connections concurrently before the first request."""
+        if count <= 0:
+            return
+        if self.http2:
+            count = 1 # A single HTTP/2 connection is multiplexed across all requests
+        async def open_connection():
+            try:
+                await self.request("HEAD", f"{self.base_url}/", timeout=10)
+                return True
+            except requests.exceptions.RequestException as e:
+                logging.warning(f"Upstream connection warm-up request failed: {e}")
+                return False
+        start = time.time()
+        opened = sum(await asyncio.gather(*(open_connection() for _ in range(count))))
+        logging.info(f"Warmed {opened}/{count} async upstream connections in {time.time() - start:.2f}s.")
+
+    async def aclose(self):
+        await self._client.aclose()
+
+async_upstream_client = None
+
+def get_async_upstream_client():
+    """Returns the shared async upstream client, creating it on first use (event loop thread only)."""
+    global async_upstream_client
+    if async_upstream_client is None:
+        async_upstream_client = AsyncUpstreamClient(GEMINI_API_BASE_URL)
+    return async_upstream_client
+
+async def async_stream_openai_from_gemini_sse(upstream_resp, proxy_req, key_suffix, sink=None):
+    """Async generator translating a Gemini SSE response into an OpenAI stream."""
+    translator = GeminiSSEToOpenAIStream(proxy_req.model, proxy_req.start_time)
+    completed = False
+    try:
+        async for chunk in upstream_resp.aiter_content():
+            if sink:
+                sink.add(chunk)
+            data = translator.feed(chunk)
+            if data:
+                yield data
+            if translator.stopped:
+                break
+        completed = True
+        if sink and not translator.stopped:
+            sink.commit()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logging.error(f"Error while streaming Gemini response with key ...{key_suffix}: {e}")
+    finally:
+        await upstream_resp.aclose()
+        if sink:
+            sink.close()
+    tail = translator.finish(completed)
+    proxy_req.trace.add_phase("convert_response", translator.conversion_seconds)
+    yield tail
+
+async def async_relay_upstream_response(upstream_resp, apply_error_filter, key_suffix, sink=None):
+    """Async counterpart of relay_upstream_response()."""
+    error_filter = TrailingErrorFilter() if apply_error_filter else None
+    start_time = time.time()
+    first_byte_time = None
+    bytes_sent = 0
+    try:
+        async for chunk in upstream_resp.aiter_content():
+            data = error_filter.feed(chunk) if error_filter else chunk
+            if data:
+                if first_byte_time is None:
+                    first_byte_time = time.time()
+                bytes_sent += len(data)
+                if sink:
+                    sink.add(data)
+                yield data
+        if error_filter:
+            tail = error_filter.finish()
+            if tail:
+                bytes_sent += len(tail)
+                if sink:
+                    sink.add(tail)
+                yield tail
+        if sink and not (error_filter and error_filter.filtered_error):
+            sink.commit()
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Error while relaying upstream response with key ...{key_suffix}: {e}")
+    finally:
+        await upstream_resp.aclose()
+        if sink:
+            sink.close()
+    first_byte = f"{first_byte_time - start_time:.3f}s" if first_byte_time else "n/a"
+    logging.info(f"Relayed {bytes_sent} bytes to client with key ...{key_suffix}. First byte after {first_byte}, total {time.time() - start_time:.3f}s")
+
+async def async_relay_encoded_response(upstream_resp, encoding, key_suffix):
+    """Async counterpart of relay_encoded_response()."""
+    start_time = time.time()
+    bytes_sent = 0
+    trailer = b""
+    completed = False
+    try:
+        async for chunk in upstream_resp.aiter_content(raw=True):
+            if chunk:
+                bytes_sent += len(chunk)
+                trailer = (trailer + chunk)[-8:]
+                yield chunk
+        completed = True
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Error while relaying upstream response with key ...{key_suffix}: {e}")
+    finally:
+        await upstream_resp.aclose()
+        record_encoded_passthrough(encoding, bytes_sent, trailer, completed)
+    logging.info(f"Relayed {bytes_sent} {encoding} encoded bytes to client with key ...{key_suffix}, total {time.time() - start_time:.3f}s")
+
+async def async_follow_flight_stream(proxy_req, flight, response_mode):
+    """Async counterpart of follow_flight_stream()."""
+    converter = FollowerResponseConverter(proxy_req, flight, response_mode)
+    async for chunk in flight.aiter_chunks():
+        data = converter.feed(chunk)
+        if data:
+            yield data
+    tail = converter.finish()
+    if tail:
+        yield tail
+
+async def async_build_follower_response(proxy_req, flight):
+    """Async counterpart of build_follower_response()."""
+    response_mode, headers = follower_response_headers(proxy_req, flight)
+    if response_mode in ("openai_stream", "passthrough"):
+        return flight.status, headers, async_metered_stream(proxy_req, async_follow_flight_stream(proxy_req, flight, response_mode))
+    content = b"".join([chunk async for chunk in flight.aiter_chunks()])
+    return build_follower_buffered_response(proxy_req, flight, headers, content)
+
+def _text_response(status, message, retry_after=None):
+    headers = [('Content-Type', 'text/plain; charset=utf-8')]
+    if retry_after is not None:
+        headers.append(('Retry-After', str(retry_after)))
+    return status, headers, message.encode('utf-8')
+
+async def async_proxy(path, method, header_items, query_params, request_data_bytes):
+    """
+    Asyncio version of proxy(). Returns (status, headers, body) where body is bytes or an
+    async iterator of bytes for streamed responses.
+    """
+    request_id_var.set(f"{random.getrandbits(64):016x}")
+    request_start_time = time.time()
+    if is_openai_embeddings_request(path):
+        try:
+            emb_req = await key_state_call(prepare_embedding_request, path, method, header_items, request_data_bytes, request_start_time)
+            status, headers, body = await async_serve_embeddings_request(emb_req)
+        except ProxyRequestError as e:
+            return _text_response(e.status, e.message, e.retry_after)
+        accept_encoding = next((value for name, value in header_items if name.lower() == 'accept-encoding'), None)
+        headers, body = compress_response(accept_encoding, status, headers, body)
+        return status, headers, body
+    try:
+        proxy_req = await key_state_call(prepare_proxy_request, path, method, header_items, query_params, request_data_bytes, request_start_time)
+    except ProxyRequestError as e:
+        return _text_response(e.status, e.message, e.retry_after)
+    status, headers, body = await async_serve_proxy_request(proxy_req)
+    server_timing = response_headers_ready(proxy_req, status, not isinstance(body, bytes))
+    if server_timing:
+        headers = headers + [('Server-Timing', server_timing)]
+    headers, body = compress_response(proxy_req.accept_encoding, status, headers, body)
+    return status, headers, body
+
+async def async_serve_proxy_request(proxy_req):
+    """Async counterpart of serve_proxy_request(). Returns (status, headers, body)."""
+    if proxy_req.cached_entry is not None:
+        return build_cached_response(proxy_req)
+
+    # --- Request Coalescing: share the upstream call of an identical in-flight request ---
+    flight, is_leader = request_coalescer.join(proxy_req)
+    if flight is not None and not is_leader:
+        served = await flight.async_wait_published()
+        request_coalescer.record_follower(proxy_req.model, served)
+        if served:
+            logging.info(f"Request for model '{proxy_req.model}' coalesced with an identical in-flight request, no API key used.")
+            return await async_build_follower_response(proxy_req, flight)
+        flight = None # The identical request got no upstream response, send our own
+    proxy_req.flight = flight
+    streamed = False
+    try:
+        proxy_req.admission = await admission_controller.async_acquire(proxy_req.model)
+        status, headers, body = await async_forward_request(proxy_req)
+        streamed = not isinstance(body, bytes)
+        return status, headers, body
+    except ProxyRequestError as e:
+        return _text_response(e.status, e.message, e.retry_after)
+    finally:
+        if not streamed:
+            proxy_req.release_admission()
+        if flight is not None:
+            flight.release_unpublished()
+
+async def _async_timed_upstream_request(proxy_req, api_key):
+    """Async counterpart of _timed_upstream_request()."""
+    key_stats.start(api_key, proxy_req.model)
+    started = time.monotonic()
+    started_at = time.time()
+    try:
+        resp = await get_async_upstream_client().request(**proxy_req.build_attempt(api_key))
+    except asyncio.CancelledError: # A hedged attempt that lost the race
+        key_stats.finish(api_key, proxy_req.model, None, error=False)
+        proxy_req.trace.add_attempt(api_key, started_at, error="cancelled")
+        raise
+    except Exception as e:
+        key_stats.finish(api_key, proxy_req.model, None, error=True)
+        circuit_breakers.record(api_key, failed=True)
+        UPSTREAM_RESPONSES.inc((proxy_req.model, "error"))
+        proxy_req.trace.add_attempt(api_key, started_at, error=type(e).__name__)
+        raise
+    elapsed = time.monotonic() - started
+    UPSTREAM_RESPONSES.inc((proxy_req.model, str(resp.status_code)))
+    proxy_req.trace.add_attempt(api_key, started_at, resp.status_code)
+    UPSTREAM_TTFB.observe(elapsed, (proxy_req.model,))
+    key_stats.finish(api_key, proxy_req.model, elapsed, error=resp.status_code == 429 or resp.status_code >= 500)
+    circuit_breakers.record(api_key, failed=resp.status_code >= 500)
+    return resp, elapsed
+
+async def async_settle_hedge_loser(model, api_key, resp):
+    """Async counterpart of settle_hedge_loser()."""
+    try:
+        if resp.status_code == 429:
+            await key_state_call(handle_rate_limited_key, api_key, model, await resp.aread())
+        elif resp.status_code < 500:
+            await key_state_call(record_key_usage, api_key, model)
+        else:
+            logging.debug(f"Losing hedged attempt with key ...{api_key[-4:]} got upstream status {resp.status_code}")
+    finally:
+        await resp.aclose()
+
+async def async_send_upstream_attempt(proxy_req, api_key, key_iter):
+    """
+    Async counterpart of send_upstream_attempt(). Here the losing attempt is cancelled; as it
+    was already sent (and is charged by upstream), it still counts as a use of its key.
+    """
+    if not hedge_policy.hedgeable(proxy_req):
+        return api_key, (await _async_timed_upstream_request(proxy_req, api_key))[0]
+    model = proxy_req.model
+    hedge_delay = hedge_policy.start_request(model)
+    if hedge_delay is None: # Not enough latency samples yet, just measure this attempt
+        resp, elapsed = await _async_timed_upstream_request(proxy_req, api_key)
+        if resp.status_code != 429:
+            hedge_policy.record_latency(model, elapsed)
+        return api_key, resp
+
+    attempts = {asyncio.ensure_future(_async_timed_upstream_request(proxy_req, api_key)): api_key}
+    done, _ = await asyncio.wait(attempts, timeout=hedge_delay)
+    if not done and hedge_policy.try_acquire():
+        hedge_key = await key_state_call(next, key_iter, None)
+        if hedge_key is None:
+            hedge_policy.release()
+        else:
+            logging.info(f"No answer for model '{model}' after {hedge_delay:.2f}s, hedging with key ...{hedge_key[-4:]}")
+            attempts[asyncio.ensure_future(_async_timed_upstream_request(proxy_req, hedge_key))] = hedge_key
+
+    winner = None
+    first_error = None
+    pending = set(attempts)
+    while pending and winner is None:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            attempt_key = attempts[task]
+            try:
+                resp, elapsed = task.result()
+            except Exception as e: # Re-raised below if no attempt answers
+                first_error = first_error or e
+                continue
+            if winner is not None: # Both answered at once, keep the first
+                await async_settle_hedge_loser(model, attempt_key, resp)
+            elif resp.status_code == 429 and pending:
+                # Rate limited while the other attempt may still answer
+                await key_state_call(handle_rate_limited_key, attempt_key, model, await resp.aread())
+            else:
+                if resp.status_code != 429:
+                    hedge_policy.record_latency(model, elapsed)
+                winner = (attempt_key, resp)
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+    for task in pending:
+        if task.cancelled():
+            logging.debug(f"Cancelled the slower hedged attempt with key ...{attempts[task][-4:]}")
+            await key_state_call(record_key_usage, attempts[task], model)
+        elif task.exception() is None: # It answered before the cancellation took effect
+            await async_settle_hedge_loser(model, attempts[task], task.result()[0])
+    if winner is None:
+        raise first_error
+    if len(attempts) > 1 and winner[0] != api_key:
+        logging.info(f"Hedged attempt with key ...{winner[0][-4:]} answered first for model '{model}'.")
+        hedge_policy.record_win()
+    return winner
+
+async def async_forward_request(proxy_req):
+    """Async counterpart of forward_request(). Returns (status, headers, body)."""
+    # --- Key Selection and Request Loop (Selects actual Gemini key for upstream) ---
+    next_key = None
+    candidates = KeyCandidates(proxy_req.model, proxy_req.estimated_tokens, context_cache.preferred_keys(proxy_req))
+    key_iter = iter(candidates)
+    retries = 0
+    failure = None # (status, headers, body) of the last transient failure
+    phase_start = time.perf_counter()
+    while (next_key := await key_state_call(next, key_iter, None)) is not None:
+        upstream_start = time.perf_counter()
+        proxy_req.trace.add_phase("key_select", upstream_start - phase_start)
+        try:
+            # With hedging, the answer may have come from another key
+            next_key, resp = await async_send_upstream_attempt(proxy_req, next_key, key_iter)
+            if resp.status_code in CONTEXT_CACHE_REJECTION_STATUSES and proxy_req.context_cache_refs.get(next_key) \
+                    and context_cache.rejected(proxy_req, next_key, resp.status_code, await resp.aread()):
+                # The referenced context cache is gone upstream: resend in full with the same key
+                next_key, resp = await async_send_upstream_attempt(proxy_req, next_key, key_iter)
+            phase_start = time.perf_counter()
+            proxy_req.trace.add_phase("upstream", phase_start - upstream_start)
+            logging.info(f"Received response Status: {resp.status_code} from {proxy_req.target_url} using key ...{next_key[-4:]}",
+                         extra={"fields": {"model": proxy_req.model, "key": key_label(next_key), "status": resp.status_code}})
+
+            # --- Handle 429 Rate Limit Error ---
+            if resp.status_code == 429:
+                # Reading the small error body also returns the connection to the pool
+                await key_state_call(handle_rate_limited_key, next_key, proxy_req.model, await resp.aread())
+                continue # Continue the loop to try the next available key
+
+            # --- Retry transient upstream errors on another key ---
+            if resp.status_code in RETRY_STATUSES:
+                delay = retry_policy.next_delay(proxy_req, retries, f"status {resp.status_code}", next_key)
+                if delay is not None:
+                    await resp.aclose()
+                    retries += 1
+                    await asyncio.sleep(delay)
+                    phase_start = time.perf_counter()
+                    continue
+            else:
+                # --- Success or Other Error (upstream 5xx don't count as usage) ---
+                await key_state_call(record_key_usage, next_key, proxy_req.model)
+
+            # --- Response Handling & Potential Conversion ---
+            if proxy_req.log_bodies:
+                logging.debug("Response Headers from Google: %s", dict(resp.headers))
+            response_headers = build_client_response_headers(resp.header_items())
+            response_mode = proxy_req.response_mode(resp.status_code)
+
+            if response_mode == "openai_stream":
+                sink = start_response_sink(proxy_req, resp.status_code, response_headers)
+                return resp.status_code, openai_stream_headers(response_headers), async_metered_stream(proxy_req, async_stream_openai_from_gemini_sse(resp, proxy_req, next_key[-4:], sink))
+            if response_mode == "passthrough":
+                sink = start_response_sink(proxy_req, resp.status_code, response_headers)
+                encoding = passthrough_encoding(proxy_req, resp, sink)
+                if encoding:
+                    return resp.status_code, encoded_passthrough_headers(response_headers, encoding), async_metered_stream(proxy_req, async_relay_encoded_response(resp, encoding, next_key[-4:]))
+                return resp.status_code, response_headers, async_metered_stream(proxy_req, async_relay_upstream_response(resp, resp.status_code == 200, next_key[-4:], sink))
+
+            raw_response_content = await resp.aread()
+            share_buffered_response(proxy_req, resp.status_code, response_headers, raw_response_content)
+            final_content_to_client, final_headers_to_client = build_buffered_response(proxy_req, resp.status_code, response_headers, raw_response_content)
+            record_response_sent(proxy_req, len(final_content_to_client))
+            return resp.status_code, final_headers_to_client, final_content_to_client
 
         except requests.exceptions.Timeout:
-            logging.error(f"Timeout error when forwarding request to {target_url} with key ...{next_key[-4:]}")
-            # Don't mark key as exhausted for timeout, but stop trying for this request.
-            return Response("Proxy error: Upstream request timed out.", status=504, mimetype='text/plain')
+            logging.error(f"Timeout error when forwarding request to {proxy_req.target_url} with key ...{next_key[-4:]}")
+            failure = _text_response(504, "Proxy error: Upstream request timed out.")
+            reason = "timeout"
         except requests.exceptions.RequestException as e:
-            logging.error(f"Error forwarding request to {target_url} with key ...{next_key[-4:]}: {e}", exc_info=True)
-            # Don't mark key as exhausted, stop trying for this request.
-            return Response(f"Proxy error: Could not connect to upstream server. {e}", status=502, mimetype='text/plain')
-        except StopIteration:
-             # This should theoretically not be reached due to the keys_tried_this_request check, but handle defensively.
-             logging.error("Key cycler unexpectedly exhausted during request processing.")
-             return Response("Proxy server error: Key rotation failed.", status=500, mimetype='text/plain')
+            logging.error(f"Error forwarding request to {proxy_req.target_url} with key ...{next_key[-4:]}: {e}", exc_info=True)
+            failure = _text_response(502, f"Proxy error: Could not connect to upstream server. {e}")
+            reason = "connection error"
         except Exception as e:
             logging.error(f"An unexpected error occurred in the proxy function with key ...{next_key[-4:]}: {e}", exc_info=True)
-            # Stop trying for this request.
-            return Response("Proxy server internal error.", status=500, mimetype='text/plain')
+            return _text_response(500, "Proxy server internal error.")
 
-    # If the loop finishes without returning (meaning all keys were tried and failed or were exhausted)
-    logging.error("Failed to forward request after trying all available API keys.")
-    return Response("Proxy error: Failed to find a usable API key.", status=503, mimetype='text/plain') # Service Unavailable
+        delay = retry_policy.next_delay(proxy_req, retries, reason, next_key)
+        if delay is None:
+            return failure
+        retries += 1
+        await asyncio.sleep(delay)
+        phase_start = time.perf_counter()
 
-    # --- Request Forwarding --- (This section is now inside the loop)
-    # Get the request body data once before the loop
-    data = request.get_data()
+    if failure is not None:
+        return failure
+    error = await key_state_call(no_usable_key_error, proxy_req.model, candidates.retry_after)
+    return _text_response(error.status, error.message, error.retry_after)
 
+async def async_serve_embeddings_request(emb_req):
+    """Async counterpart of serve_embeddings_request(); the batches it leads are sent concurrently."""
+    parts = embedding_batcher.join(emb_req)
+    led = [batch for batch, _, _, is_leader in parts if is_leader]
+    if led:
+        await asyncio.gather(*(async_lead_embedding_batch(batch) for batch in led))
+    for batch, _, _, _ in parts:
+        await batch.async_wait(lambda batch=batch: batch.state == "done")
+    return build_embeddings_response(emb_req, parts)
+
+async def async_lead_embedding_batch(batch):
+    """Async counterpart of lead_embedding_batch()."""
+    await batch.async_wait(lambda: batch.state != "open", embedding_batcher.window_seconds())
+    embedding_batcher.seal(batch)
+    ticket = None
+    try:
+        ticket = await admission_controller.async_acquire(batch.model)
+        await async_send_embedding_batch(batch)
+    except ProxyRequestError as e:
+        batch.finish(error=e)
+    finally:
+        admission_controller.release(ticket)
+        batch.finish(error=ProxyRequestError(500, "Proxy server internal error."))
+        embedding_batcher.maybe_log()
+
+async def async_send_embedding_batch(batch):
+    """Async counterpart of send_embedding_batch()."""
+    proxy_req = batch.upstream_request()
+    next_key = None
+    candidates = KeyCandidates(batch.model, batch.estimated_tokens)
+    key_iter = iter(candidates)
+    retries = 0
+    failure = None
+    while (next_key := await key_state_call(next, key_iter, None)) is not None:
+        try:
+            next_key, resp = await async_send_upstream_attempt(proxy_req, next_key, key_iter)
+            logging.info(f"Received response Status: {resp.status_code} for a batch of {len(batch.requests)} embeddings using key ...{next_key[-4:]}",
+                         extra={"fields": {"model": batch.model, "key": key_label(next_key), "status": resp.status_code}})
+            if resp.status_code == 429:
+                await key_state_call(handle_rate_limited_key, next_key, batch.model, await resp.aread())
+                continue
+            if resp.status_code in RETRY_STATUSES:
+                delay = retry_policy.next_delay(proxy_req, retries, f"status {resp.status_code}", next_key)
+                if delay is not None:
+                    await resp.aclose()
+                    retries += 1
+                    await asyncio.sleep(delay)
+                    continue
+            else:
+                await key_state_call(record_key_usage, next_key, batch.model)
+            batch.set_response(resp.status_code, await resp.aread())
+            return
+        except requests.exceptions.Timeout:
+            logging.error(f"Timeout error when forwarding request to {proxy_req.target_url} with key ...{next_key[-4:]}")
+            failure = ProxyRequestError(504, "Proxy error: Upstream request timed out.")
+            reason = "timeout"
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Error forwarding request to {proxy_req.target_url} with key ...{next_key[-4:]}: {e}", exc_info=True)
+            failure = ProxyRequestError(502, f"Proxy error: Could not connect to upstream server. {e}")
+            reason = "connection error"
+        delay = retry_policy.next_delay(proxy_req, retries, reason, next_key)
+        if delay is None:
+            break
+        retries += 1
+        await asyncio.sleep(delay)
+    batch.finish(error=failure or await key_state_call(no_usable_key_error, batch.model, candidates.retry_after))
+
+async def _send_asgi_response(receive, send, status, headers, body):
+    """Writes a response to the ASGI server, streaming async iterators until the client disconnects."""
+    raw_headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+    if isinstance(body, bytes):
+        raw_headers.append((b"content-length", str(len(body)).encode('latin-1')))
+    await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+    if isinstance(body, bytes):
+        await send({"type": "http.response.body", "body": body})
+        return
+
+    async def pump():
+        async for chunk in body:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def wait_for_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        if not pump_task.done(): # A draining server closes the connection right after the last chunk
+            logging.info("Client disconnected before the response finished streaming.")
+
+    pump_task = asyncio.ensure_future(pump())
+    disconnect_task = asyncio.ensure_future(wait_for_disconnect())
+    try:
+        await asyncio.wait({pump_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in (pump_task, disconnect_task):
+            task.cancel()
+        await asyncio.gather(pump_task, disconnect_task, return_exceptions=True)
+        await body.aclose() # Closes the upstream response if the stream was cut short
+    if pump_task.done() and not pump_task.cancelled() and pump_task.exception():
+        raise pump_task.exception()
+
+async def asgi_app(scope, receive, send):
+    """ASGI application serving every path through async_proxy()."""
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await get_async_upstream_client().warm(UPSTREAM_WARM_CONNECTIONS)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if async_upstream_client is not None:
+                    await async_upstream_client.aclose()
+                shutdown_proxy()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    path = scope["path"].lstrip('/')
+    if not path:
+        status, headers, body = _text_response(404, "Not Found")
+        record_client_request(path, status)
+        await _send_asgi_response(receive, send, status, headers, body)
+        return
+    if is_metrics_request(path, scope["method"]):
+        header_items = [(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope["headers"]]
+        status, headers, body = await key_state_call(build_metrics_response, header_items)
+        await _send_asgi_response(receive, send, status, headers, body)
+        return
+
+    # Read the complete request body (it may be replayed across several keys)
+    body_parts = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+        body_parts.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    header_items = [(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope["headers"]]
+    query_params = {}
+    for name, value in parse_qsl(scope.get("query_string", b"").decode('latin-1'), keep_blank_values=True):
+        query_params.setdefault(name, value) # Keep the first value, like Flask's request.args.to_dict()
+
+    status, headers, body = await async_proxy(path, scope["method"], header_items, query_params, b"".join(body_parts))
+    record_client_request(path, status)
+    await _send_asgi_response(receive, send, status, headers, body)
+
+def require_async_dependencies():
+    """Exits with an explanation if uvicorn or httpx (needed by the async engine) is not installed."""
+    try:
+        import uvicorn # noqa: F401
+        import httpx # noqa: F401 - required by AsyncUpstreamClient
+    except ImportError as e:
+        logging.critical(f"SERVER_ENGINE is 'async' but a dependency is missing ({e}). Install it with: pip install uvicorn httpx")
+        sys.exit(1)
+
+def run_async_server():
+    """Runs asgi_app on uvicorn in this process (pip install uvicorn httpx). uvicorn drains requests on SIGTERM."""
+    require_async_dependencies()
+    import uvicorn
+    uvicorn.run(
+        asgi_app, host=LISTEN_HOST, port=LISTEN_PORT, log_config=None,
+        backlog=SERVER_BACKLOG, timeout_keep_alive=SERVER_KEEPALIVE_TIMEOUT,
+        timeout_graceful_shutdown=SERVER_GRACEFUL_TIMEOUT)
+
+# --- Server Launch ---
+# Extra seconds the gunicorn master gives a draining worker to flush its usage data before killing it
+GUNICORN_EXIT_MARGIN = 10
+# Process that already ran shutdown_proxy()
+_shutdown_pid = None
+
+def shutdown_proxy():
+    """
+    Flushes pending usage data, logs the final statistics of every feature and stops the span
+    exporter and the log writer. Runs once per process (each gunicorn worker runs it when it exits).
+    """
+    global _shutdown_pid
+    if _shutdown_pid == os.getpid():
+        return
+    _shutdown_pid = os.getpid()
+    usage_persister.stop()
+    upstream_pool_stats.maybe_log(force=True)
+    rate_pacer.maybe_log(force=True)
+    response_cache.maybe_log(force=True)
+    request_coalescer.maybe_log(force=True)
+    hedge_policy.maybe_log(force=True)
+    context_cache.maybe_log(force=True)
+    embedding_batcher.maybe_log(force=True)
+    admission_controller.maybe_log(force=True)
+    retry_policy.maybe_log(force=True)
+    compression_stats.maybe_log(force=True)
+    span_export_queue.stop()
+    # uvicorn ends its process with the SIGTERM it received once it has shut down, so atexit
+    # handlers may never run: write the queued log records now
+    if log_handler is not None:
+        log_handler.stop()
+
+class InFlightRequests:
+    """
+    WSGI middleware counting the requests in progress (a streamed response until the server
+    closes it), so the waitress and development servers can wait for them on SIGTERM.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self._condition = threading.Condition()
+        self._active = 0
+
+    def __call__(self, environ, start_response):
+        with self._condition:
+            self._active += 1
+        try:
+            return ClosingIterator(self.wsgi_app(environ, start_response), self._finished)
+        except BaseException:
+            self._finished()
+            raise
+
+    def _finished(self):
+        with self._condition:
+            self._active -= 1
+            if not self._active:
+                self._condition.notify_all()
+
+    def wait_idle(self, timeout):
+        """Waits up to `timeout` seconds for the requests in progress; returns how many are left."""
+        with self._condition:
+            self._condition.wait_for(lambda: not self._active, timeout)
+            return self._active
+
+def drain_requests(tracker, deadline):
+    """Waits until the requests counted by `tracker` have finished, or `deadline` (time.monotonic()) passes."""
+    logging.info(f"SIGTERM received: stopped accepting connections, waiting up to {SERVER_GRACEFUL_TIMEOUT}s for requests in progress...")
+    remaining = tracker.wait_idle(max(deadline - time.monotonic(), 0))
+    if remaining:
+        logging.warning(f"{remaining} requests were still in progress after {SERVER_GRACEFUL_TIMEOUT}s; exiting anyway.")
+    else:
+        logging.info("All requests in progress have finished.")
+
+def run_gunicorn_server():
+    """
+    Runs SERVER_WORKERS gunicorn worker processes: gthread workers for the sync engine, uvicorn
+    workers for the async engine. They are forked after the keys and usage data were loaded
+    (preload), so that happens once. On SIGTERM gunicorn stops accepting connections, each worker
+    finishes its requests in progress (up to SERVER_GRACEFUL_TIMEOUT) and flushes its usage data.
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError as e:
+        logging.critical(f"SERVER_BACKEND is 'gunicorn' but it is not installed ({e}). Install it with: pip install gunicorn")
+        sys.exit(1)
+    if SERVER_ENGINE == "async":
+        require_async_dependencies()
+        try:
+            from uvicorn_worker import UvicornWorker
+        except ImportError:
+            from uvicorn.workers import UvicornWorker
+
+        class ProxyUvicornWorker(UvicornWorker):
+            # The lifespan events warm the upstream connections and run shutdown_proxy()
+            CONFIG_KWARGS = dict(UvicornWorker.CONFIG_KWARGS, lifespan="on", timeout_graceful_shutdown=SERVER_GRACEFUL_TIMEOUT)
+
+        worker_class, application = ProxyUvicornWorker, asgi_app
+    else:
+        worker_class, application = "gthread", app
+
+    def post_fork(server, worker):
+        # The master waits a little longer than its workers, so they can flush usage data after draining
+        worker.cfg.set("graceful_timeout", SERVER_GRACEFUL_TIMEOUT)
+        if SERVER_ENGINE != "async":
+            get_upstream_client().warm(UPSTREAM_WARM_CONNECTIONS)
+
+    def worker_exit(server, worker):
+        shutdown_proxy()
+
+    settings = {
+        "bind": f"[{LISTEN_HOST}]:{LISTEN_PORT}" if ":" in LISTEN_HOST else f"{LISTEN_HOST}:{LISTEN_PORT}",
+        "workers": SERVER_WORKERS,
+        "threads": SERVER_THREADS,
+        "worker_class": worker_class,
+        "timeout": SERVER_WORKER_TIMEOUT,
+        "graceful_timeout": SERVER_GRACEFUL_TIMEOUT + GUNICORN_EXIT_MARGIN,
+        "keepalive": SERVER_KEEPALIVE_TIMEOUT,
+        "backlog": SERVER_BACKLOG,
+        "preload_app": True,
+        "proc_name": TRACING_SERVICE_NAME,
+        "post_fork": post_fork,
+        "worker_exit": worker_exit,
+    }
+
+    class ProxyApplication(BaseApplication):
+        def load_config(self):
+            for name, value in settings.items():
+                self.cfg.set(name, value)
+
+        def load(self):
+            return application
+
+    # Nothing may be left for the master to write once the workers own the usage data
+    usage_persister.flush()
+    ProxyApplication().run()
+
+def run_waitress_server():
+    """Runs the sync engine on waitress with SERVER_THREADS threads and drains requests on SIGTERM."""
+    try:
+        import waitress
+        from waitress import wasyncore
+        from waitress.server import BaseWSGIServer, MultiSocketServer
+    except ImportError as e:
+        logging.critical(f"SERVER_BACKEND is 'waitress' but it is not installed ({e}). Install it with: pip install waitress")
+        sys.exit(1)
+    tracker = InFlightRequests(app)
+    server = waitress.create_server(
+        tracker, host=LISTEN_HOST, port=LISTEN_PORT, threads=SERVER_THREADS, backlog=SERVER_BACKLOG,
+        channel_timeout=SERVER_KEEPALIVE_TIMEOUT, ident=TRACING_SERVICE_NAME)
+    socket_map = server.map if isinstance(server, MultiSocketServer) else server._map
+    listeners = [dispatcher for dispatcher in socket_map.values() if isinstance(dispatcher, BaseWSGIServer)]
+    get_upstream_client().warm(UPSTREAM_WARM_CONNECTIONS)
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    loop_thread = threading.Thread(target=server.run, name="waitress", daemon=True)
+    loop_thread.start()
+    while loop_thread.is_alive() and not stopping.wait(1):
+        pass
+    if not loop_thread.is_alive():
+        return
+
+    # The socket map belongs to the loop thread: changes are handed to it through the trigger
+    deadline = time.monotonic() + SERVER_GRACEFUL_TIMEOUT
+    listeners[0].trigger.pull_trigger(lambda: [wasyncore.dispatcher.close(listener) for listener in listeners])
+    drain_requests(tracker, deadline)
+    # Responses are complete once the loop has sent what they left in the channels' buffers
+    while time.monotonic() < deadline and any(
+            channel.total_outbufs_len for listener in listeners for channel in list(listener.active_channels.values())):
+        time.sleep(0.05)
+    listeners[0].trigger.pull_trigger(lambda: wasyncore.close_all(socket_map))
+    loop_thread.join(timeout=5)
+    server.task_dispatcher.shutdown(timeout=1)
+
+def run_development_server():
+    """Runs the sync engine on the Flask (werkzeug) development server and drains requests on SIGTERM."""
+    from werkzeug.serving import make_server
+    tracker = InFlightRequests(app)
+    server = make_server(LISTEN_HOST, LISTEN_PORT, tracker, threaded=True)
+    get_upstream_client().warm(UPSTREAM_WARM_CONNECTIONS)
+    stopping = []
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, so it cannot run on this (the serving) thread
+        stopping.append(time.monotonic() + SERVER_GRACEFUL_TIMEOUT)
+        threading.Thread(target=server.shutdown, name="server-shutdown", daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    server.serve_forever()
+    server.server_close()
+    if stopping:
+        drain_requests(tracker, stopping[0])
+
+def resolve_server_backend():
+    """Returns the server SERVER_BACKEND selects for SERVER_ENGINE ("auto": the best one installed)."""
+    if SERVER_BACKEND != "auto":
+        return SERVER_BACKEND
+    if os.name != "nt" and importlib.util.find_spec("gunicorn") is not None:
+        return "gunicorn"
+    if SERVER_ENGINE == "async":
+        return "uvicorn"
+    return "waitress" if importlib.util.find_spec("waitress") is not None else "development"
+
+def run_server():
+    """Serves the proxy with the server chosen by SERVER_BACKEND until it is stopped, then runs shutdown_proxy()."""
+    backend = resolve_server_backend()
+    supported = ("gunicorn", "uvicorn") if SERVER_ENGINE == "async" else ("gunicorn", "waitress", "development")
+    if SERVER_ENGINE not in ("sync", "async"):
+        logging.critical(f"Unknown SERVER_ENGINE '{SERVER_ENGINE}'; use 'sync' or 'async'.")
+        sys.exit(1)
+    if backend not in supported:
+        logging.critical(f"SERVER_BACKEND '{backend}' cannot run the '{SERVER_ENGINE}' engine; use one of: auto, {', '.join(supported)}.")
+        sys.exit(1)
+    if SERVER_WORKERS > 1 and backend != "gunicorn":
+        logging.warning(f"SERVER_WORKERS is {SERVER_WORKERS} but {backend} runs a single process; only gunicorn starts several workers.")
+    elif SERVER_WORKERS > 1 and USAGE_STATE_BACKEND == "memory":
+        logging.warning(f"{SERVER_WORKERS} workers with USAGE_STATE_BACKEND 'memory': each worker keeps its own key state "
+                        "and they overwrite each other's usage file. Set USAGE_STATE_BACKEND to 'sqlite' to share it.")
+    if backend == "development":
+        logging.warning("Using the Flask development server. For production, install gunicorn (Linux/macOS) or waitress.")
+    server_name = "the Flask development server" if backend == "development" else backend
+    if backend == "gunicorn":
+        server_name += f" ({SERVER_WORKERS} worker processes)"
+    logging.info(f"Serving the '{SERVER_ENGINE}' engine with {server_name}. Ready to process requests...")
+    if backend == "gunicorn":
+        # Every worker runs shutdown_proxy() itself when it exits
+        run_gunicorn_server()
+        return
+    try:
+        if backend == "uvicorn":
+            # Upstream connections are warmed by the ASGI lifespan startup event
+            run_async_server()
+        elif backend == "waitress":
+            run_waitress_server()
+        else:
+            run_development_server()
+    finally:
+        shutdown_proxy()
 
 # --- Main Execution ---
 if __name__ == '__main__':
     setup_logging() # Configure logging first
+    # Re-select the JSON library now that logging is set up, so a missing orjson is reported
+    logging.info(f"Using the '{configure_json_codec()}' JSON codec.")
 
     # Load API keys from the specified file
     api_keys = load_api_keys(API_KEY_FILE)
 
     if api_keys:
-        # Initialize the key cycler if keys were loaded successfully
-        key_cycler = cycle(api_keys)
-
-        # Load usage data after keys are loaded but before starting server
-        load_usage_data()
+        # Set up the key state and load usage data once, before the server (and its workers) start
+        init_key_state(api_keys)
 
         logging.info(f"Starting Gemini proxy server on http://{LISTEN_HOST}:{LISTEN_PORT}")
         logging.info(f"Proxy configured to use placeholder token: {PLACEHOLDER_TOKEN}")
         logging.info(f"Requests will be forwarded to: {GEMINI_API_BASE_URL}")
-        logging.info(f"Ready to process requests...")
-        # Run the Flask development server
-        # For production, consider using a proper WSGI server like Gunicorn or Waitress
-        app.run(host=LISTEN_HOST, port=LISTEN_PORT)
+        run_server()
     else:
         logging.critical("Proxy server failed to start: Could not load API keys.")
         sys.exit(1) # Exit if keys could not be loaded